@@ -1,4 +1,4 @@
 #!/bin/sh
 
 echo "------ Running celery instance -----"
-celery worker --app=hypermap.celeryapp:app -B -l INFO
+celery worker --app=hypermap.celeryapp:app -B -l INFO -Q celery,interactive,harvest,check,index,rebuild,thumbnail
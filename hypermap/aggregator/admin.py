@@ -1,12 +1,29 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 from djcelery.models import TaskMeta
 
+from spatial import filter_by_bbox, parse_bbox
+
 from models import (Service, Layer, Check, SpatialReferenceSystem, EndpointList,
-                    Endpoint, LayerDate, LayerWM, TaskError, Catalog)
+                    Endpoint, LayerDate, LayerWM, TaskError, Catalog, IndexingRun)
+
+
+class BboxSearchMixin(object):
+    """
+    Searching "bbox:minx,miny,maxx,maxy" lists the resources intersecting the bbox, using the spatial index.
+    """
 
+    def get_search_results(self, request, queryset, search_term):
+        if search_term.startswith('bbox:'):
+            bbox = parse_bbox(search_term[len('bbox:'):])
+            if bbox:
+                return filter_by_bbox(queryset, bbox), False
+            self.message_user(request, 'Invalid bbox, expected bbox:minx,miny,maxx,maxy', level=messages.ERROR)
+            return queryset.none(), False
+        return super(BboxSearchMixin, self).get_search_results(request, queryset, search_term)
 
-class ServiceAdmin(admin.ModelAdmin):
+
+class ServiceAdmin(BboxSearchMixin, admin.ModelAdmin):
     model = Service
     list_display = ('id', 'type', 'title', 'active', 'url', )
     list_display_links = ('id', )
@@ -21,14 +38,14 @@ class SpatialReferenceSystemAdmin(admin.ModelAdmin):
 
 class LayerDateAdmin(admin.ModelAdmin):
     model = LayerDate
-    list_display = ('date', 'type', 'layer', 'layer_abstract')
+    list_display = ('date', 'type', 'parsed_date', 'is_bc', 'layer', 'layer_abstract')
     list_filter = ('type', )
 
     def layer_abstract(self, instance):
         return instance.layer.abstract
 
 
-class LayerAdmin(admin.ModelAdmin):
+class LayerAdmin(BboxSearchMixin, admin.ModelAdmin):
     model = Layer
     list_display = ('name', 'title', 'service', )
     search_fields = ['name', 'title', ]
@@ -71,6 +88,12 @@ class CatalogAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug')
 
 
+class IndexingRunAdmin(admin.ModelAdmin):
+    model = IndexingRun
+    list_display = ('started_datetime', 'finished_datetime', 'indexed', 'removed')
+    date_hierarchy = 'started_datetime'
+
+
 admin.site.register(Service, ServiceAdmin)
 admin.site.register(Check, CheckAdmin)
 admin.site.register(SpatialReferenceSystem, SpatialReferenceSystemAdmin)
@@ -81,6 +104,7 @@ admin.site.register(EndpointList, EndpointListAdmin)
 admin.site.register(Endpoint, EndpointAdmin)
 admin.site.register(TaskError, TaskErrorAdmin)
 admin.site.register(Catalog, CatalogAdmin)
+admin.site.register(IndexingRun, IndexingRunAdmin)
 
 
 # we like to see celery results using the admin
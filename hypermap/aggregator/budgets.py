@@ -0,0 +1,76 @@
+"""
+Time budgets of the operations calling upstream services (checks, harvests, thumbnails, indexing).
+Within an operation, the calls of the HTTP client get the (connect, read) timeouts of the operation,
+the libraries calling urllib2 directly (arcrest) get its read timeout as default socket timeout, and
+owslib is given it explicitly. The tasks have soft and hard time limits on top of this
+(settings.TASK_TIME_LIMITS): a check interrupted by its limit or by a timeout is recorded as timed out.
+"""
+
+import socket
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.packages.urllib3.exceptions import TimeoutError as PoolTimeoutError
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.conf import settings
+
+TIMEOUT_ERRORS = (socket.timeout, requests.Timeout, PoolTimeoutError, SoftTimeLimitExceeded)
+
+_local = threading.local()
+
+
+def get_timeout(name=None):
+    """
+    Returns the (connect, read) timeouts of an operation, by default of the current one.
+    Outside of any operation, the default HTTP timeouts apply.
+    """
+    if name is None:
+        name = get_current_operation()
+    if name in settings.OPERATION_TIMEOUTS:
+        return tuple(settings.OPERATION_TIMEOUTS[name])
+    return (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+
+
+def get_read_timeout(name=None):
+    """
+    Returns the read timeout of an operation, for the libraries accepting a single timeout.
+    """
+    return get_timeout(name)[1]
+
+
+def get_current_operation():
+    operations = getattr(_local, 'operations', None)
+    if operations:
+        return operations[-1]
+    return None
+
+
+@contextmanager
+def operation(name):
+    """
+    Run a block of code within the time budget of an operation.
+    """
+    if not hasattr(_local, 'operations'):
+        _local.operations = []
+    _local.operations.append(name)
+    default_timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(get_read_timeout(name))
+    try:
+        yield
+    finally:
+        socket.setdefaulttimeout(default_timeout)
+        _local.operations.pop()
+
+
+def is_timeout(err):
+    """
+    Tell if an error is a timeout, also when wrapped by urllib2 or by the retries of requests.
+    """
+    if isinstance(err, TIMEOUT_ERRORS):
+        return True
+    reason = getattr(err, 'reason', None)
+    if reason is None and err.args:
+        reason = getattr(err.args[0], 'reason', None)
+    return isinstance(reason, TIMEOUT_ERRORS)
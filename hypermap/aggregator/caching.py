@@ -0,0 +1,58 @@
+"""
+Shared cache of the processes (memcached), falling back to an in-process cache while memcached is
+not reachable, and generation counter of the catalogue. The counter is incremented at every change
+of a layer or a service: responses computed from the catalogue are cached under the generation they
+were computed at, so a change makes them stale without having to find and delete them.
+"""
+
+import time
+
+from django.core.cache import caches
+
+GENERATION_KEY = 'catalogue-generation'
+
+# how often the shared cache is checked to be reachable, in seconds
+CHECK_INTERVAL = 30
+CHECK_KEY = 'shared-cache-check'
+
+_shared_cache = {'checked': 0, 'available': True}
+
+
+def is_available(cache):
+    try:
+        cache.set(CHECK_KEY, 1)
+        return cache.get(CHECK_KEY) == 1
+    except Exception:
+        return False
+
+
+def get_shared_cache():
+    """
+    Returns the shared cache, or the in-process cache while the shared one is not reachable.
+    """
+    now = time.time()
+    if now - _shared_cache['checked'] > CHECK_INTERVAL:
+        _shared_cache['available'] = is_available(caches['default'])
+        _shared_cache['checked'] = now
+    if _shared_cache['available']:
+        return caches['default']
+    return caches['local']
+
+
+def get_generation():
+    cache = get_shared_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # a lost counter starts again from the time, past the values it may have had
+        cache.add(GENERATION_KEY, int(time.time()), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def increment_generation():
+    cache = get_shared_cache()
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:
+        # not set yet
+        return get_generation()
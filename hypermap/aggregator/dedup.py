@@ -0,0 +1,145 @@
+"""
+Deduplication of the tasks run on a resource: a task holds a lock in the shared cache, keyed by its name
+and by the id of the resource it is run on, from the time it is queued until it returns. The same task
+queued again for the same resource meanwhile is dropped, i.e. the index_layer tasks queued by the check
+of a layer and by its save, or the checks of a layer queued again by the next sweep.
+A task queued on the interactive queue (from the pages) takes the lock over instead of being dropped
+behind a task waiting in a long queue.
+The lock of a queued task lasts for the depth of its queue, the lock of a running task for its time
+limit, refreshed at each progress report (see heartbeat), so the lock of a task lost with its worker
+expires. Revoked tasks release their lock.
+"""
+
+import time
+
+from celery import Task
+from celery.signals import task_prerun, task_revoked
+from celery.utils import uuid
+
+from django.conf import settings
+
+from hypermap.aggregator import caching, progress
+
+# how long the depth of a queue is reused by a process, in seconds
+QUEUE_DEPTH_INTERVAL = 10
+
+_queue_depths = {}
+
+
+def get_queue_depth(app, queue):
+    """
+    Returns the number of tasks waiting in a queue, read from the broker at most once every
+    QUEUE_DEPTH_INTERVAL seconds. Queues not declared yet, or brokers not telling it, count as empty.
+    """
+    depth, checked = _queue_depths.get(queue, (0, 0))
+    now = time.time()
+    if now - checked < QUEUE_DEPTH_INTERVAL:
+        return depth
+    try:
+        with app.connection_or_acquire() as connection:
+            depth = connection.default_channel.queue_declare(queue=queue, passive=True)[1]
+    except Exception:
+        depth = 0
+    _queue_depths[queue] = (depth, now)
+    return depth
+
+
+class DeduplicatedTask(Task):
+    abstract = True
+
+    def get_lock_key(self, args):
+        """
+        Returns the key of the lock of the task, by the id of its first argument (a model instance or an id).
+        Tasks without arguments (the sweeps) are locked by their name only.
+        """
+        if not args:
+            return 'task-lock-%s' % self.name
+        object_id = getattr(args[0], 'pk', args[0])
+        return 'task-lock-%s-%s' % (self.name, object_id)
+
+    def get_queue(self, options):
+        return (options.get('queue') or settings.CELERY_ROUTES.get(self.name, {}).get('queue') or
+                settings.CELERY_DEFAULT_QUEUE)
+
+    def get_queued_lock_timeout(self, queue):
+        """
+        Returns how long the lock of the task lasts while queued, by the number of tasks before it.
+        """
+        if self.app.conf.CELERY_ALWAYS_EAGER:
+            return settings.TASK_LOCK_TIMEOUT
+        depth = get_queue_depth(self.app, queue)
+        return settings.TASK_LOCK_TIMEOUT + int(depth * settings.TASK_LOCK_QUEUED_SECONDS)
+
+    def get_running_lock_timeout(self):
+        """
+        Returns how long the lock of the running task lasts without heartbeat: its hard time limit if any.
+        """
+        return self.request.timelimit and self.request.timelimit[0] or self.time_limit or settings.TASK_LOCK_TIMEOUT
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        """
+        Queue the task, unless it is already queued or running for the same resource.
+        Returns the result of the task queued, or of the one already queued.
+        """
+        key = self.get_lock_key(args)
+        cache = caching.get_shared_cache()
+        task_id = task_id or uuid()
+        queue = self.get_queue(options)
+        timeout = self.get_queued_lock_timeout(queue)
+        if queue == settings.INTERACTIVE_QUEUE:
+            # the task queued from a page runs anyway, the one queued before it does not release its lock
+            cache.set(key, task_id, timeout)
+        elif not cache.add(key, task_id, timeout):
+            queued_task_id = cache.get(key)
+            if queued_task_id is not None:
+                print 'Skipping %s, already queued as %s' % (key, queued_task_id)
+                # a dropped child task counts as done in the progress of its parent
+                progress.child_done((kwargs or {}).get('progress_id'))
+                return self.AsyncResult(queued_task_id)
+            # released meanwhile
+            cache.set(key, task_id, timeout)
+        try:
+            return super(DeduplicatedTask, self).apply_async(args, kwargs, task_id=task_id, **options)
+        except Exception:
+            cache.delete(key)
+            raise
+
+    def heartbeat(self):
+        """
+        Extend the lock of the running task, unless it was taken over.
+        """
+        if self.request.called_directly:
+            return
+        key = self.get_lock_key(self.request.args)
+        cache = caching.get_shared_cache()
+        if cache.get(key) in (None, self.request.id):
+            cache.set(key, self.request.id, self.get_running_lock_timeout())
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        release_lock(self, task_id, args)
+
+
+def release_lock(task, task_id, args):
+    key = task.get_lock_key(args)
+    cache = caching.get_shared_cache()
+    # tasks run directly (not queued) do not hold the lock
+    if cache.get(key) == task_id:
+        cache.delete(key)
+
+
+@task_prerun.connect
+def task_prerun_handler(sender=None, **kwargs):
+    """
+    Extend the lock of a task starting to run, from the depth of its queue to its time limit.
+    """
+    if isinstance(sender, DeduplicatedTask):
+        sender.heartbeat()
+
+
+@task_revoked.connect
+def task_revoked_handler(sender=None, request=None, **kwargs):
+    """
+    Release the lock of a task revoked, while queued or running.
+    """
+    if isinstance(sender, DeduplicatedTask) and request is not None:
+        release_lock(sender, request.id, request.args)
@@ -1,17 +1,14 @@
+import re
 import sys
 import logging
-import math
 import json
+import datetime
 
-from urlparse import urlparse
 from django.conf import settings
-from django.utils.html import strip_tags
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 
-from hypermap.aggregator.utils import mercator_to_llbbox
-
-from hypermap.aggregator.solr import get_date
+from hypermap.aggregator.indexing import get_layer_document
 
 
 class ESHypermap(object):
@@ -21,115 +18,53 @@ class ESHypermap(object):
     index_name = 'hypermap'
     logger = logging.getLogger("hypermap")
 
-    def __init__(self):
+    def __init__(self, url=None, index_name=None):
+        # by default we write to the alias searched by clients
+        if url:
+            self.es_url = url
+            self.es = Elasticsearch(hosts=[url])
+        if index_name:
+            self.index_name = index_name
         self.create_indices()
         super(ESHypermap, self).__init__()
 
     @staticmethod
-    def good_coords(coords):
-        """ passed a string array """
-        if (len(coords) != 4):
-            return False
-        for coord in coords[0:3]:
-            try:
-                num = float(coord)
-                if (math.isnan(num)):
-                    return False
-                if (math.isinf(num)):
-                    return False
-            except ValueError:
-                return False
-        return True
-
-    @staticmethod
-    def get_domain(url):
-        urlParts = urlparse(url)
-        hostname = urlParts.hostname
-        if hostname == "localhost":
-            return "Harvard"  # assumption
-        return hostname
-
-    @staticmethod
-    def layer_to_es(layer):
-        category = None
-        username = None
-
-        ESHypermap.logger.info("Elasticsearch: record to save: %s" % layer.id)
-
-        try:
-            bbox = [float(layer.bbox_x0), float(layer.bbox_y0), float(layer.bbox_x1), float(layer.bbox_y1)]
-            for proj in layer.srs.values():
-                if proj['code'] in ('102113', '102100'):
-                    bbox = mercator_to_llbbox(bbox)
-            if (ESHypermap.good_coords(bbox)) is False:
-                print 'Elasticsearch: There are not valid coordinates for this layer ', layer.title
-                ESHypermap.logger.error('Elasticsearch: There are not valid coordinates for layer id: %s' % layer.id)
-                return False
-            if (ESHypermap.good_coords(bbox)):
-                minX = bbox[0]
-                minY = bbox[1]
-                maxX = bbox[2]
-                maxY = bbox[3]
-                if (minY > maxY):
-                    minY, maxY = maxY, minY
-                if (minX > maxX):
-                    minX, maxX = maxX, minX
-                centerY = (maxY + minY) / 2.0
-                centerX = (maxX + minX) / 2.0
-                halfWidth = (maxX - minX) / 2.0
-                halfHeight = (maxY - minY) / 2.0
-                area = (halfWidth * 2) * (halfHeight * 2)
-                if (minX < -180):
-                    minX = -180
-                if (maxX > 180):
-                    maxX = 180
-                if (minY < -90):
-                    minY = -90
-                if (maxY > 90):
-                    maxY = 90
-                wkt = "ENVELOPE({:f},{:f},{:f},{:f})".format(minX, maxX, maxY, minY)
-                domain = ESHypermap.get_domain(layer.service.url)
-                if hasattr(layer, 'layerwm'):
-                    category = layer.layerwm.category
-                    username = layer.layerwm.username
-                abstract = layer.abstract
-                if abstract:
-                    abstract = strip_tags(layer.abstract)
-                else:
-                    abstract = ''
-                if layer.service.type == "WM":
-                    originator = username
-                else:
-                    originator = domain
-                # we need to remove the exising index in case there is already one
-                # ESHypermap.es.delete('hypermap', 'layer', layer.id)
-                # now we add the index
-                es_record = {
-                                "LayerId": str(layer.id),
-                                "LayerName": layer.name,
-                                "LayerTitle": layer.title,
-                                "Originator": originator,
-                                "ServiceId": str(layer.service.id),
-                                "ServiceType": layer.service.type,
-                                "LayerCategory": category,
-                                "LayerUsername": username,
-                                "LayerUrl": layer.url,
-                                "LayerReliability": layer.reliability,
-                                "Is_Public": layer.is_public,
-                                "Availability": "Online",
-                                "Location": '{"layerInfoPage": "' + layer.get_absolute_url() + '"}',
-                                "Abstract": abstract,
-                                # "SrsProjectionCode": layer.srs.values_list('code', flat=True),
+    def document_to_es(document):
+        """
+        Translate a canonical layer document to an es record.
+        """
+        es_record = {
+                        "LayerId": str(document['id']),
+                        "LayerName": document['name'],
+                        "LayerTitle": document['title'],
+                        "Originator": document['originator'],
+                        "ServiceId": str(document['service_id']),
+                        "ServiceType": document['service_type'],
+                        "LayerCategory": document['category'],
+                        "LayerUsername": document['username'],
+                        "LayerUrl": document['url'],
+                        "LayerReliability": document['reliability'],
+                        "Is_Public": document['is_public'],
+                        "Availability": "Online",
+                        "Location": document['location'],
+                        "Abstract": document['abstract'],
+                        # "SrsProjectionCode": document['srs'],
+                        "DomainName": document['domain_name'],
+                        }
+        bbox = document['bbox']
+        if bbox is not None:
+            minX, minY, maxX, maxY = bbox['min_x'], bbox['min_y'], bbox['max_x'], bbox['max_y']
+            es_record.update({
                                 "MinY": minY,
                                 "MinX": minX,
                                 "MaxY": maxY,
                                 "MaxX": maxX,
-                                "CenterY": centerY,
-                                "CenterX": centerX,
-                                "HalfWidth": halfWidth,
-                                "HalfHeight": halfHeight,
-                                "Area": area,
-                                "bbox": wkt,
+                                "CenterY": bbox['center_y'],
+                                "CenterX": bbox['center_x'],
+                                "HalfWidth": bbox['half_width'],
+                                "HalfHeight": bbox['half_height'],
+                                "Area": bbox['area'],
+                                "bbox": bbox['wkt'],
                                 "GeoShape": {
                                   "type": "polygon",
                                   "orientation": "clockwise",
@@ -137,36 +72,120 @@ class ESHypermap(object):
                                     [[minX, minY], [minX, maxY], [maxX, maxY], [maxX, minY], [minX, minY]]
                                   ]
                                 },
-                                "DomainName": layer.service.get_domain,
-                                }
-
-                slugs = layer.get_catalogs_slugs()
-                if slugs:
-                    es_record["Catalogs"] = slugs
-
-                es_date, type = get_date(layer)
-                if es_date is not None:
-                    es_record['LayerDate'] = es_date
-                    es_record['LayerDateType'] = type
-                ESHypermap.logger.info(es_record)
-                ESHypermap.es.index(ESHypermap.index_name, 'layer', json.dumps(es_record), id=layer.id,
-                                    request_timeout=20)
-                ESHypermap.logger.info("Elasticsearch: record saved for layer with id: %s" % layer.id)
-                return True, None
+                                })
+        if document['catalogs']:
+            es_record["Catalogs"] = document['catalogs']
+        if document['date'] is not None:
+            es_record['LayerDate'] = document['date']
+            es_record['LayerDateType'] = document['date_type']
+        return es_record
+
+    def layer_to_es(self, layer):
+        return self.index_document(get_layer_document(layer))
+
+    def index_document(self, document):
+        self.logger.info("Elasticsearch: record to save: %s" % document['id'])
+        try:
+            es_record = self.document_to_es(document)
+            self.logger.info(es_record)
+            self.es.index(self.index_name, 'layer', json.dumps(es_record), id=document['id'], request_timeout=20)
+            self.logger.info("Elasticsearch: record saved for layer with id: %s" % document['id'])
+            return True, None
         except Exception:
-            ESHypermap.logger.error(sys.exc_info())
-            ESHypermap.logger.error("Elasticsearch: Error saving record for layer with id: %s - %s"
-                                    % (layer.id, sys.exc_info()[1]))
+            self.logger.error(sys.exc_info())
+            self.logger.error("Elasticsearch: Error saving record for layer with id: %s - %s"
+                              % (document['id'], sys.exc_info()[1]))
             return False, sys.exc_info()[1]
 
-    @staticmethod
-    def clear_es():
+    def index_documents(self, documents, commit=False):
+        """
+        Send many layer documents to es with a single bulk request.
+        """
+        actions = []
+        for document in documents:
+            actions.append({
+                '_index': self.index_name,
+                '_type': 'layer',
+                '_id': document['id'],
+                '_source': self.document_to_es(document),
+            })
+        helpers.bulk(self.es, actions, request_timeout=60)
+        if commit:
+            self.commit()
+        self.logger.info("Elasticsearch: %s records saved" % len(actions))
+        return len(actions)
+
+    def remove_layer(self, layer_id):
+        """Remove a layer from the es index"""
+        try:
+            self.es.delete(self.index_name, 'layer', layer_id, ignore=[404])
+            self.logger.info("Elasticsearch: record removed for layer with id: %s" % layer_id)
+            return True, None
+        except Exception:
+            self.logger.error("Elasticsearch: Error removing record for layer with id: %s - %s"
+                              % (layer_id, sys.exc_info()[1]))
+            return False, sys.exc_info()[1]
+
+    def commit(self):
+        """Make indexed documents searchable"""
+        self.es.indices.refresh(self.index_name)
+
+    def clear_es(self):
         """Clear all indexes in the es core"""
-        ESHypermap.es.delete(ESHypermap.index_name)
+        self.es.delete(self.index_name)
         print 'Elasticsearch: Index cleared'
 
-    @staticmethod
-    def create_indices():
+    def create_versioned(self):
+        """
+        Create a new, empty, versioned index to be filled before swapping the alias to it.
+        Returns an ESHypermap writing to the new index.
+        """
+        index_name = '%s_%s' % (ESHypermap.index_name, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        esobject = ESHypermap(url=self.es_url, index_name=index_name)
+        self.logger.info("Elasticsearch: index %s created" % index_name)
+        return esobject
+
+    def swap_alias(self):
+        """
+        Atomically point the alias to the index of this writer. Previous indices are kept for rollback.
+        An index created before aliases were used, which has the name of the alias, is deleted first: searches
+        fail between its deletion and the alias creation, only at the first rebuild.
+        Returns the previous indices.
+        """
+        alias = ESHypermap.index_name
+        previous_indices = []
+        actions = []
+        if self.es.indices.exists_alias(name=alias):
+            previous_indices = self.es.indices.get_alias(name=alias).keys()
+            actions = [{'remove': {'index': previous_index, 'alias': alias}} for previous_index in previous_indices]
+        elif self.es.indices.exists(alias):
+            # the remove_index alias action only exists from es 6.4, the index is deleted on its own
+            self.es.indices.delete(alias)
+            self.logger.warning("Elasticsearch: index %s deleted, to be replaced by an alias" % alias)
+        actions.append({'add': {'index': self.index_name, 'alias': alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+        self.logger.info("Elasticsearch: alias %s now points to %s (previously %s)" % (
+            alias, self.index_name, ','.join(previous_indices)))
+        return previous_indices
+
+    def prune_versioned(self, keep):
+        """
+        Delete the versioned indices of the alias but the one it points to and the previous ones kept for
+        rollback. Returns the indices deleted.
+        """
+        alias = ESHypermap.index_name
+        aliased = self.es.indices.get_alias(name=alias).keys() if self.es.indices.exists_alias(name=alias) else []
+        versioned_re = re.compile(r'^%s_\d{14}$' % re.escape(alias))
+        previous_indices = sorted(
+            index for index in self.es.indices.get_settings(index='%s_*' % alias).keys()
+            if versioned_re.match(index) and index not in aliased)
+        pruned = previous_indices[:max(len(previous_indices) - keep, 0)]
+        for index in pruned:
+            self.es.indices.delete(index)
+            self.logger.info("Elasticsearch: index %s deleted" % index)
+        return pruned
+
+    def create_indices(self):
         """Create ES core indices """
         # TODO: enable auto_create_index in the ES nodes to make this implicit.
         # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-index_.html#index-creation
@@ -184,4 +203,4 @@ class ESHypermap(object):
                 }
             }
         }
-        ESHypermap.es.indices.create(ESHypermap.index_name, ignore=[400, 404], body=mapping)
+        self.es.indices.create(self.index_name, ignore=[400, 404], body=mapping)
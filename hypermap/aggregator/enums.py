@@ -9,6 +9,9 @@ SERVICE_TYPES = (
     ('Hypermap:WARPER', 'Mapwarper'),
 )
 
+# service types whose layers are harvested with lon/lat bboxes, ESRI layers keep the native srs extents
+LONLAT_SERVICE_TYPES = ('OGC:WMS', 'OGC:WMTS', 'Hypermap:WorldMap', 'Hypermap:WARPER')
+
 CSW_RESOURCE_TYPES = {
     'OGC:CSW': 'http://www.opengis.net/cat/csw/2.0.2',
     'OGC:WMS': 'http://www.opengis.net/wms',
@@ -0,0 +1,171 @@
+"""
+Full-text index of the resource anytext, kept in a side table of each resource table:
+an fts5 virtual table on SQLite, a tsvector column with a GIN index on PostgreSQL.
+Text searches are then index lookups instead of a LIKE scan of every anytext.
+Indexed searches match the words starting as the searched words ('wat' matches 'water', 'ater' does
+not), where the LIKE scan matches any substring. Databases without the needed features (i.e. SQLite
+before 3.9, without fts5) are probed once, and fall back to the LIKE scan.
+"""
+
+import re
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+
+SUPPORTED_VENDORS = ('sqlite', 'postgresql')
+
+# the words of a text, as split by the fts5 unicode61 tokenizer
+WORDS_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+# results of the probes of the full-text index features, by database alias
+_available = {}
+
+
+def is_enabled():
+    return settings.FULLTEXT_INDEX_ENABLED and connection.vendor in SUPPORTED_VENDORS and is_available()
+
+
+def is_available():
+    """
+    Tell if the database supports the full-text index, probed once by database.
+    """
+    if connection.alias not in _available:
+        _available[connection.alias] = probe_fulltext_index()
+    return _available[connection.alias]
+
+
+def probe_fulltext_index():
+    if connection.vendor != 'sqlite':
+        # tsvector and gin are available on every supported PostgreSQL version
+        return True
+    try:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('CREATE VIRTUAL TABLE temp.fulltext_probe USING fts5(anytext)')
+            cursor.execute('DROP TABLE temp.fulltext_probe')
+    except DatabaseError as err:
+        print 'Full-text index not available, anytext is scanned instead: %s' % err
+        return False
+    return True
+
+
+def get_table_name(model):
+    return '%s_fts' % model._meta.db_table
+
+
+def create_fulltext_index(model):
+    """
+    Create the anytext side table of a resource model, if not existing.
+    """
+    if not is_enabled():
+        return
+    table_name = get_table_name(model)
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(anytext)' % table_name)
+    else:
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s (id integer PRIMARY KEY, document tsvector NOT NULL)'
+                       % table_name)
+        # CREATE INDEX IF NOT EXISTS needs PostgreSQL 9.5
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', ['%s_gin' % table_name])
+        if cursor.fetchone() is None:
+            cursor.execute('CREATE INDEX %s_gin ON %s USING gin (document)' % (table_name, table_name))
+
+
+def set_texts(model, anytexts):
+    """
+    Set the indexed texts of resources, given a dictionary of their anytext by id.
+    """
+    if not is_enabled() or not anytexts:
+        return
+    table_name = get_table_name(model)
+    cursor = connection.cursor()
+    ids = list(anytexts.keys())
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        table_name, get_id_column(), ', '.join(['%s'] * len(ids))), ids)
+    rows = [(resource_id, anytext) for resource_id, anytext in anytexts.items() if anytext]
+    if not rows:
+        return
+    if connection.vendor == 'sqlite':
+        sql = 'INSERT INTO %s (rowid, anytext) VALUES (%%s, %%s)' % table_name
+    else:
+        sql = "INSERT INTO %s (id, document) VALUES (%%s, to_tsvector('simple', %%s))" % table_name
+    cursor.executemany(sql, rows)
+
+
+def remove_texts(model, ids):
+    if not is_enabled() or not ids:
+        return
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        get_table_name(model), get_id_column(), ', '.join(['%s'] * len(ids))), list(ids))
+
+
+def rebuild_fulltext_index(model, bulk_size=500):
+    """
+    Fill again the anytext side table of a resource model from all the resources anytext.
+    """
+    if not is_enabled():
+        return 0
+    create_fulltext_index(model)
+    connection.cursor().execute('DELETE FROM %s' % get_table_name(model))
+    resources = model.objects.order_by('id').values_list('id', 'anytext')
+    count = 0
+    last_id = 0
+    while True:
+        chunk = list(resources.filter(id__gt=last_id)[:bulk_size])
+        if not chunk:
+            break
+        set_texts(model, dict(chunk))
+        count = count + len(chunk)
+        last_id = chunk[-1][0]
+    return count
+
+
+def get_id_column():
+    # fts5 tables have no other key than the rowid
+    if connection.vendor == 'sqlite':
+        return 'rowid'
+    return 'id'
+
+
+def get_match_query(text):
+    """
+    Returns the full-text query matching the resources with words starting as the words of a text,
+    or None if the text has no words.
+    """
+    words = WORDS_RE.findall(text or '')
+    if not words:
+        return None
+    if connection.vendor == 'sqlite':
+        return ' '.join('"%s"*' % word for word in words)
+    return ' & '.join('%s:*' % word for word in words)
+
+
+def get_text_subquery(model):
+    """
+    Returns the SQL selecting from the full-text index the ids of the resources matching
+    a query from get_match_query, given as its only parameter.
+    """
+    table_name = get_table_name(model)
+    if connection.vendor == 'sqlite':
+        return 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (table_name, table_name)
+    return "SELECT id FROM %s WHERE document @@ to_tsquery('simple', %%s)" % table_name
+
+
+def filter_by_text(queryset, text):
+    """
+    Filter a resource queryset to the resources whose anytext has words starting as the words of text.
+    Without full-text index, anytext is searched with a LIKE scan.
+    """
+    query = get_match_query(text)
+    if query is None:
+        return queryset
+    if not is_enabled():
+        for word in WORDS_RE.findall(text):
+            queryset = queryset.filter(anytext__icontains=word)
+        return queryset
+    return queryset.extra(
+        where=['%s.id IN (%s)' % (queryset.model._meta.db_table, get_text_subquery(queryset.model))],
+        params=[query]
+    )
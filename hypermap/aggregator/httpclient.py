@@ -0,0 +1,78 @@
+"""
+Central HTTP client of the aggregator: one pooled requests session by process, so that the calls to
+the search backend and to the same upstream services reuse their connections (keep-alive).
+Calls get the (connect, read) timeouts of the current operation (see budgets), and are retried on
+connection errors and on 502, 503 and 504 responses. The pool size can be set by host, i.e. larger
+for the search backend.
+"""
+
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+from hypermap.aggregator import budgets
+
+# responses of an overloaded or restarting upstream, worth retrying
+RETRY_STATUSES = (502, 503, 504)
+
+_session = {'pid': None, 'session': None}
+
+
+def get_adapter(pool_size):
+    retry = Retry(
+        total=settings.HTTP_RETRIES,
+        backoff_factor=settings.HTTP_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+    )
+    return HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS, pool_maxsize=pool_size, max_retries=retry)
+
+
+def create_session():
+    session = requests.Session()
+    adapter = get_adapter(settings.HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for host, pool_size in settings.HTTP_POOL_SIZES.items():
+        adapter = get_adapter(pool_size)
+        session.mount('http://%s/' % host, adapter)
+        session.mount('https://%s/' % host, adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the session of this process. Forked processes (i.e. the celery workers) do not share the
+    connections of their parent, they create their own session.
+    """
+    pid = os.getpid()
+    if _session['pid'] != pid:
+        _session['session'] = create_session()
+        _session['pid'] = pid
+    return _session['session']
+
+
+def reset_session():
+    """
+    Close the connections of the session, a new one is created at the next call (i.e. when the settings change).
+    """
+    if _session['session'] is not None:
+        _session['session'].close()
+    _session['pid'] = None
+    _session['session'] = None
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', budgets.get_timeout())
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
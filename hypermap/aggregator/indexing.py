@@ -0,0 +1,323 @@
+import datetime
+import numpy
+
+from collections import defaultdict
+from urlparse import urlparse
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Sum, When
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+
+from hypermap.aggregator.utils import get_llbboxes_extents, repair_bboxes
+
+
+# search writers, by SEARCH_TYPE
+SEARCH_WRITERS = {
+    'solr': 'hypermap.aggregator.solr.SolrHypermap',
+    'elasticsearch': 'hypermap.aggregator.elasticsearch_client.ESHypermap',
+}
+
+# ESRI wkids of spherical mercator, WMS services store lon/lat bboxes whatever their EPSG codes
+MERCATOR_CODES = ('102113', '102100', '3857')
+
+# number of most recent checks used for the recent reliability, as in Resource.recent_reliability
+RECENT_CHECKS_NUMBER = 2
+
+
+def get_search_writer(search_type=None, url=None):
+    """
+    Returns the writer for a search backend, by default the one searched by clients.
+    """
+    search_type = search_type or settings.SEARCH_TYPE
+    return import_string(SEARCH_WRITERS[search_type])(url)
+
+
+def get_search_writers():
+    """
+    Returns the writers every layer document must be sent to: SEARCH_TYPE, plus SEARCH_EXTRA_BACKENDS
+    (used for example when migrating from a backend to another).
+    """
+    writers = [get_search_writer()]
+    for search_type, url in settings.SEARCH_EXTRA_BACKENDS:
+        writers.append(get_search_writer(search_type, url))
+    return writers
+
+
+def get_date(layer):
+    """
+    Returns a date for the search backend. A date can be detected or from metadata.
+    It can be a range or a simple date in isoformat.
+    """
+    date_type = 1
+    # the temporal extent of a WorldMap layer comes first, as in Layer.get_layer_dates
+    date = get_layerwm_date(layer)
+    if date is None:
+        layer_date = get_first_layer_date(layer)
+        if layer_date:
+            date = datetime.datetime.combine(layer_date.parsed_date, datetime.time())
+            date_type = layer_date.type
+    if date is None:
+        date = layer.created.date()
+    # layer date > 2300 is invalid for sure
+    # TODO put this logic in date miner
+    if date.year > 2300:
+        date = None
+    if date_type == 0:
+        date_type = "Detected"
+    if date_type == 1:
+        date_type = "From Metadata"
+    return get_solr_date(date), date_type
+
+
+def get_layerwm_date(layer):
+    """
+    Returns the parsed temporal extent start of a WorldMap layer, or its end if the start is not a date.
+    """
+    from hypermap.aggregator.models import get_parsed_date
+    if not hasattr(layer, 'layerwm') or not layer.layerwm.temporal_extent_start:
+        return None
+    for temporal_extent in (layer.layerwm.temporal_extent_start, layer.layerwm.temporal_extent_end):
+        pydate = get_parsed_date(temporal_extent) if temporal_extent else None
+        if pydate:
+            return pydate
+    return None
+
+
+def get_first_layer_date(layer):
+    """
+    Returns the earliest parsed LayerDate for the layer, from the prefetched layer dates when available.
+    """
+    if 'layerdate' not in getattr(layer, '_prefetched_objects_cache', {}):
+        return layer.get_first_layer_date()
+    layer_dates = [layer_date for layer_date in layer.layerdate_set.all() if layer_date.parsed_date]
+    if not layer_dates:
+        return None
+    return min(layer_dates, key=lambda layer_date: (layer_date.parsed_date, -layer_date.type))
+
+
+def get_check_stats(layer):
+    """
+    Returns the reliability, recent reliability and last status of a layer.
+    Layers coming from get_indexing_queryset use their annotations and recent checks,
+    other layers query their checks.
+    """
+    if not hasattr(layer, 'checks_total') or not hasattr(layer, 'recent_checks'):
+        return layer.reliability, layer.recent_reliability, layer.last_status
+    reliability = None
+    if layer.checks_total:
+        reliability = (layer.checks_success / float(layer.checks_total)) * 100
+    recent_reliability = reliability
+    if len(layer.recent_checks) >= RECENT_CHECKS_NUMBER:
+        recent_reliability = (sum(layer.recent_checks) / float(RECENT_CHECKS_NUMBER)) * 100
+    last_status = None
+    if layer.recent_checks:
+        last_status = layer.recent_checks[0]
+    return reliability, recent_reliability, last_status
+
+
+def get_solr_date(pydate):
+    """
+    Returns a date in a valid Solr format from a string.
+    """
+    # check if date is valid and then set it to solr format YYYY-MM-DDThh:mm:ssZ
+    try:
+        if isinstance(pydate, datetime.datetime):
+            solr_date = '%sZ' % pydate.isoformat()[0:19]
+            return solr_date
+        else:
+            return None
+    except Exception:
+        return None
+
+
+def get_domain(url):
+    urlParts = urlparse(url)
+    hostname = urlParts.hostname
+    if hostname == "localhost":
+        return "Harvard"  # assumption
+    return hostname
+
+
+def get_layers_bboxes(layers):
+    """
+    Returns the bbox of each layer in WGS84, as a dictionary with extent, center, area and WKT envelope,
+    or None if the layer has not valid coordinates.
+    The bboxes are checked and repaired with repair_bboxes, as done by the repair_bboxes task, so
+    a stored bbox already repaired is indexed as it is.
+    """
+    bboxes = numpy.array([
+        [numpy.nan if coord is None else coord
+         for coord in (layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1)]
+        for layer in layers
+    ], dtype=float).reshape(-1, 4)
+    bboxes, flags = repair_bboxes(bboxes, mercator=[is_mercator(layer.service) for layer in layers])
+    extents = get_llbboxes_extents(bboxes)
+    # back to python floats, one dictionary per layer
+    extents = dict((key, values.tolist()) for key, values in extents.items())
+    layers_bboxes = []
+    for i in range(0, len(bboxes)):
+        if flags['invalid'][i]:
+            layers_bboxes.append(None)
+            continue
+        bbox = dict((key, values[i]) for key, values in extents.items())
+        bbox['wkt'] = "ENVELOPE({:f},{:f},{:f},{:f})".format(bbox['min_x'], bbox['max_x'], bbox['max_y'], bbox['min_y'])
+        layers_bboxes.append(bbox)
+    return layers_bboxes
+
+
+def get_layer_bbox(layer):
+    return get_layers_bboxes([layer])[0]
+
+
+def is_mercator(service):
+    """
+    True if the service uses a spherical mercator srs, read with all() so that prefetched srs are used.
+    """
+    return bool(set(srs.code for srs in service.srs.all()).intersection(MERCATOR_CODES))
+
+
+def set_bboxes(layers):
+    """
+    Set on each layer its bbox dictionary, computed for all the layers at once.
+    """
+    for layer, bbox in zip(layers, get_layers_bboxes(layers)):
+        layer.indexing_bbox = bbox
+
+
+def get_layer_document(layer):
+    """
+    Returns the canonical search document for a layer, which each search writer translates
+    to its own record format.
+    Related objects are read with all() so that prefetched querysets are used when available.
+    """
+    service = layer.service
+    srs_codes = [srs.code for srs in service.srs.all()]
+    category = None
+    username = None
+    if hasattr(layer, 'layerwm'):
+        category = layer.layerwm.category
+        username = layer.layerwm.username
+    domain = get_domain(service.url)
+    if layer.type == 'Hypermap:WorldMap':
+        originator = username
+    else:
+        originator = domain
+    abstract = layer.abstract
+    if abstract:
+        abstract = strip_tags(layer.abstract)
+    else:
+        abstract = ''
+    date, date_type = get_date(layer)
+    reliability, recent_reliability, last_status = get_check_stats(layer)
+    if hasattr(layer, 'indexing_bbox'):
+        bbox = layer.indexing_bbox
+    else:
+        bbox = get_layer_bbox(layer)
+    return {
+        'id': layer.id,
+        'name': layer.name,
+        'title': layer.title,
+        'originator': originator,
+        'service_id': service.id,
+        'service_type': service.type,
+        'category': category,
+        'username': username,
+        'url': layer.url,
+        'reliability': reliability,
+        'recent_reliability': recent_reliability,
+        'last_status': last_status,
+        'is_public': layer.is_public,
+        'location': '{"layerInfoPage": "' + layer.get_absolute_url() + '"}',
+        'abstract': abstract,
+        'domain_name': service.get_domain,
+        'tile_url': layer.get_tile_url(),
+        'srs': [code.encode('utf-8') for code in srs_codes if code],
+        'catalogs': [catalog.slug for catalog in layer.catalogs.all()],
+        'date': date,
+        'date_type': date_type,
+        'bbox': bbox,
+    }
+
+
+def get_indexing_queryset(layers=None):
+    """
+    Returns the layers with everything needed by get_layer_document loaded by a fixed number of queries:
+    service and WorldMap fields are joined, srs, dates and catalogs prefetched and check counts annotated.
+    """
+    from hypermap.aggregator.models import Layer
+
+    if layers is None:
+        layers = Layer.objects.all()
+    return layers.select_related(
+        'service', 'layerwm'
+    ).prefetch_related(
+        'service__srs', 'layerdate_set', 'catalogs'
+    ).annotate(
+        checks_total=Count('check_set'),
+        checks_success=Sum(Case(When(check_set__success=True, then=1), default=0, output_field=IntegerField())),
+    )
+
+
+def set_recent_checks(layers):
+    """
+    Set on each layer the success of its most recent checks (newest first), with a single query.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from hypermap.aggregator.models import Check, Layer
+
+    recent_checks = defaultdict(list)
+    checks = Check.objects.filter(
+        content_type=ContentType.objects.get_for_model(Layer),
+        object_id__in=[layer.id for layer in layers]
+    ).order_by('object_id', '-checked_datetime').values_list('object_id', 'success')
+    for object_id, success in checks:
+        if len(recent_checks[object_id]) < RECENT_CHECKS_NUMBER:
+            recent_checks[object_id].append(success)
+    for layer in layers:
+        layer.recent_checks = recent_checks[layer.id]
+
+
+def iter_layer_documents(layers=None, chunk_size=None):
+    """
+    Yields lists of canonical search documents, reading the layers in chunks ordered by id.
+    Each chunk is a keyset query (id greater than the last one read), so that deep chunks are as fast
+    as the first ones and the layers of a single chunk only are held in memory.
+    """
+    chunk_size = chunk_size or settings.SEARCH_BULK_SIZE
+    layers = get_indexing_queryset(layers).order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(layers.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        set_recent_checks(chunk)
+        set_bboxes(chunk)
+        yield [get_layer_document(layer) for layer in chunk]
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+
+def mark_layers_dirty(layer_ids):
+    """
+    Add layers to the index buffer, to be indexed in bulk at the next flush (see flush_index_buffer).
+    A layer marked again before the flush is indexed once.
+    """
+    from hypermap.aggregator.models import DirtyLayer
+
+    for layer_id in layer_ids:
+        DirtyLayer.objects.get_or_create(layer_id=layer_id)
+
+
+def take_dirty_layer_ids(limit=None):
+    """
+    Remove from the index buffer the layers marked first, and return their ids.
+    Layers marked again meanwhile are back in the buffer for the next flush.
+    """
+    from hypermap.aggregator.models import DirtyLayer
+
+    rows = list(DirtyLayer.objects.order_by('id').values_list('id', 'layer_id')[:limit or settings.SEARCH_BULK_SIZE])
+    if rows:
+        # the rows read, not an id range: a row committed late with a lower id stays for the next flush
+        DirtyLayer.objects.filter(id__in=[row_id for row_id, layer_id in rows]).delete()
+    return [layer_id for row_id, layer_id in rows]
@@ -0,0 +1,57 @@
+import random
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from hypermap.aggregator.utils import mercator_to_llbbox, mercator_to_llbboxes, get_llbboxes_extents
+
+
+def scalar_extents(bboxes):
+    """
+    Convert and measure the bboxes one at a time, as get_layer_bbox does.
+    """
+    extents = []
+    for bbox in bboxes:
+        minX, minY, maxX, maxY = mercator_to_llbbox(bbox)
+        minX, maxX = max(min(minX, maxX), -180), min(max(minX, maxX), 180)
+        minY, maxY = max(min(minY, maxY), -90), min(max(minY, maxY), 90)
+        extents.append(((maxX - minX) * (maxY - minY), (maxX + minX) / 2.0, (maxY + minY) / 2.0))
+    return extents
+
+
+def vectorized_extents(bboxes):
+    return get_llbboxes_extents(mercator_to_llbboxes(bboxes))
+
+
+class Command(BaseCommand):
+    help = ("Compare the time spent converting mercator bboxes to lon/lat one at a time and in batch.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-n',
+            '--number',
+            dest="number",
+            default=100000,
+            help="Number of random bboxes"),
+        make_option(
+            '-r',
+            '--repeat',
+            dest="repeat",
+            default=5,
+            help="Number of timed runs for each path"),
+    )
+
+    def handle(self, *args, **options):
+        number = int(options.get('number'))
+        repeat = int(options.get('repeat'))
+        bboxes = []
+        for i in range(0, number):
+            x = sorted(random.uniform(-20037508.34, 20037508.34) for c in range(0, 2))
+            y = sorted(random.uniform(-20037508.34, 20037508.34) for c in range(0, 2))
+            bboxes.append([x[0], y[0], x[1], y[1]])
+
+        scalar = min(timeit.repeat(lambda: scalar_extents(bboxes), number=1, repeat=repeat))
+        vectorized = min(timeit.repeat(lambda: vectorized_extents(bboxes), number=1, repeat=repeat))
+        print 'Scalar path: %.4fs for %s bboxes' % (scalar, number)
+        print 'Vectorized path: %.4fs for %s bboxes (%.1fx)' % (vectorized, number, scalar / vectorized)
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from hypermap.aggregator.thumbnails import collect_orphans
+
+
+class Command(BaseCommand):
+    help = ("Remove the stored thumbnail images which are not the thumbnail of any layer.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-n',
+            '--dry-run',
+            action='store_true',
+            dest="dry_run",
+            default=False,
+            help="Only list the images to remove"),
+    )
+
+    def handle(self, *args, **options):
+        orphans = collect_orphans(dry_run=options.get('dry_run'))
+        for name in orphans:
+            print name
+        print '%s orphan thumbnails' % len(orphans)
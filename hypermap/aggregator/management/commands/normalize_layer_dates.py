@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from hypermap.aggregator.models import LayerDate
+
+NORMALIZED_FIELDS = ('parsed_date', 'year', 'is_bc', 'range_start_year', 'range_end_year')
+
+
+class Command(BaseCommand):
+    help = ("Parse the layer dates stored before their normalized fields, or all of them with --all.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-a',
+            '--all',
+            action='store_true',
+            dest="all",
+            default=False,
+            help="Normalize again all the layer dates, not only the ones without year"),
+        make_option(
+            '-b',
+            '--bulk-size',
+            dest="bulk_size",
+            default=500,
+            help="Number of layer dates updated by transaction"),
+    )
+
+    def handle(self, *args, **options):
+        bulk_size = int(options.get('bulk_size'))
+        layer_dates = LayerDate.objects.order_by('id').only('id', 'date')
+        if not options.get('all'):
+            # dates which are not parsed have no year either
+            layer_dates = layer_dates.filter(year__isnull=True)
+        count = 0
+        last_id = 0
+        while True:
+            chunk = list(layer_dates.filter(id__gt=last_id)[:bulk_size])
+            if not chunk:
+                break
+            # update() skips the pre_save signal, the dates are normalized here
+            with transaction.atomic():
+                for layer_date in chunk:
+                    layer_date.normalize()
+                    LayerDate.objects.filter(id=layer_date.id).update(
+                        **dict((field, getattr(layer_date, field)) for field in NORMALIZED_FIELDS))
+            count = count + len(chunk)
+            last_id = chunk[-1].id
+            print 'Normalized %s layer dates' % count
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from hypermap.aggregator.models import Service, Layer
+from hypermap.aggregator.fulltext import rebuild_fulltext_index
+from hypermap.aggregator.spatial import rebuild_spatial_index
+
+
+class Command(BaseCommand):
+    help = ("Fill again the spatial and full-text indexes of the services and layers.")
+
+    def handle(self, *args, **options):
+        for model in (Service, Layer):
+            count = rebuild_spatial_index(model)
+            print '%s %s geometries indexed' % (count, model._meta.verbose_name)
+            count = rebuild_fulltext_index(model)
+            print '%s %s texts indexed' % (count, model._meta.verbose_name)
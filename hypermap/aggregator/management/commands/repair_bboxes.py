@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from hypermap.aggregator.tasks import repair_layers_bboxes
+
+
+class Command(BaseCommand):
+    help = ("Check the lon/lat bboxes of the layers, and repair the flipped, out of range, "
+            "mercator encoded and invalid ones. Partial bboxes are only reported.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-n',
+            '--dry-run',
+            action='store_true',
+            dest="dry_run",
+            default=False,
+            help="Only report the bboxes to repair"),
+    )
+
+    def handle(self, *args, **options):
+        stats = repair_layers_bboxes(dry_run=options.get('dry_run'))
+        for flag, count in sorted(stats.items()):
+            print '%s: %s' % (flag, count)
@@ -1,9 +1,8 @@
 import datetime
-import os
+import hashlib
 import re
 import json
-import urllib2
-import requests
+from StringIO import StringIO
 from urlparse import urlparse
 from dateutil.parser import parse
 
@@ -13,7 +12,6 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.db.models import Avg, Min, Max
 from django.db.models import signals
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django_extensions.db.fields import AutoSlugField
 
@@ -24,15 +22,23 @@ from owslib.namespaces import Namespaces
 from owslib.util import nspath_eval
 from owslib.csw import CatalogueServiceWeb
 from owslib.tms import TileMapService
-from owslib.wms import WebMapService
+from owslib.wms import WebMapService, WMSCapabilitiesReader
 from owslib.wmts import WebMapTileService
 from arcrest import MapService as ArcMapService, ImageService as ArcImageService
 
 from enums import CSW_RESOURCE_TYPES, SERVICE_TYPES, DATE_TYPES
-from tasks import update_endpoint, update_endpoints, check_service, check_layer, index_layer
+from tasks import update_endpoint, update_endpoints, check_service, check_layer
 from utils import get_esri_extent, get_esri_service_name, format_float, flip_coordinates
+import budgets
+import caching
+import fulltext
+import httpclient
+import probes
+import spatial
+import thumbnails
 
 from hypermap.dynasty.utils import get_mined_dates
+from hypermap.aggregator.indexing import mark_layers_dirty
 
 
 def get_parsed_date(sdate):
@@ -48,6 +54,53 @@ def get_parsed_date(sdate):
         return None
 
 
+def get_normalized_date(sdate):
+    """
+    Parse a LayerDate string once, returning its typed representation.
+    Returns a dict with the parsed date (AD only), the signed year, the BC flag
+    and the year endpoints when the string is a range ("[x TO y]").
+    """
+    normalized = {
+        'parsed_date': None,
+        'year': None,
+        'is_bc': False,
+        'range_start_year': None,
+        'range_end_year': None,
+    }
+    if not sdate:
+        return normalized
+    sdate = sdate.strip()
+    if 'TO' in sdate:
+        endpoints = sdate.strip('[]').split('TO')
+        years = []
+        for endpoint in endpoints:
+            match = re.match(r'\s*(-?)(\d+)', endpoint)
+            if match:
+                year = int(match.group(2))
+                if match.group(1):
+                    year = -year
+                years.append(year)
+            else:
+                years.append(None)
+        if len(years) == 2:
+            normalized['range_start_year'], normalized['range_end_year'] = years
+            normalized['year'] = years[0]
+            normalized['is_bc'] = years[0] is not None and years[0] < 0
+        return normalized
+    if sdate.startswith('-'):
+        # datetime cannot store BC dates, we only keep the signed year
+        match = re.match(r'-(\d+)', sdate)
+        if match:
+            normalized['year'] = -int(match.group(1))
+            normalized['is_bc'] = True
+        return normalized
+    pydate = get_parsed_date(sdate)
+    if pydate:
+        normalized['parsed_date'] = pydate.date()
+        normalized['year'] = pydate.year
+    return normalized
+
+
 def add_metadata_dates_to_layer(dates, layer):
     default = datetime.datetime(2016, 1, 1)
     for date in dates:
@@ -101,6 +154,8 @@ class Check(models.Model):
     object_id = models.PositiveIntegerField()
     checked_datetime = models.DateTimeField(auto_now=True)
     success = models.BooleanField(default=False)
+    # the check failed because the resource did not respond within the time budget
+    timed_out = models.BooleanField(default=False)
     response_time = models.FloatField()
     message = models.TextField(default='OK')
 
@@ -143,6 +198,8 @@ class Resource(models.Model):
     xml = models.TextField(null=True,
                            default='<csw:Record xmlns:csw="http://www.opengis.net/cat/2.0.2"/>',
                            blank=True)
+    # hash of the metadata the XML was generated from, generated again only when they change
+    xml_hash = models.CharField(max_length=32, null=True, blank=True)
 
     def __unicode__(self):
         return str(self.id)
@@ -274,6 +331,7 @@ class Service(Resource):
         Check for availability of a service and provide run metrics.
         """
         success = True
+        timed_out = False
         start_time = datetime.datetime.utcnow()
         message = ''
 
@@ -286,12 +344,12 @@ class Service(Resource):
             wkt_geometry = None
             srs = '4326'
             if self.type == 'OGC:CSW':
-                ows = CatalogueServiceWeb(self.url)
+                ows = CatalogueServiceWeb(self.url, timeout=budgets.get_read_timeout())
                 title = ows.identification.title
                 abstract = ows.identification.abstract
                 keywords = ows.identification.keywords
             if self.type == 'OGC:WMS':
-                ows = WebMapService(self.url)
+                ows = WebMapService(self.url, timeout=budgets.get_read_timeout())
                 title = ows.identification.title
                 abstract = ows.identification.abstract
                 keywords = ows.identification.keywords
@@ -305,7 +363,7 @@ class Service(Resource):
                 abstract = ows.identification.abstract
                 keywords = ows.identification.keywords
             if self.type == 'OSGeo:TMS':
-                ows = TileMapService(self.url)
+                ows = TileMapService(self.url, timeout=budgets.get_read_timeout())
                 title = ows.identification.title
                 abstract = ows.identification.abstract
                 keywords = ows.identification.keywords
@@ -334,10 +392,10 @@ class Service(Resource):
                     extent['ymax']
                 ])
             if self.type == 'Hypermap:WorldMap':
-                urllib2.urlopen(self.url)
+                httpclient.get(self.url).raise_for_status()
                 title = 'Harvard WorldMap'
             if self.type == 'Hypermap:WARPER':
-                urllib2.urlopen(self.url)
+                httpclient.get(self.url).raise_for_status()
             # update title without raising a signal and recursion
             if title:
                 self.title = title
@@ -352,7 +410,9 @@ class Service(Resource):
             if wkt_geometry:
                 self.wkt_geometry = wkt_geometry
                 Service.objects.filter(id=self.id).update(wkt_geometry=wkt_geometry)
-            xml = create_metadata_record(
+                spatial.set_bboxes(Service, {self.id: wkt_geometry})
+            set_metadata_record(
+                self,
                 identifier=self.id_string,
                 source=self.url,
                 links=[[self.type, self.url]],
@@ -365,11 +425,15 @@ class Service(Resource):
                 srs=srs
             )
             anytexts = gen_anytext(title, abstract, keywords)
-            Service.objects.filter(id=self.id).update(anytext=anytexts, xml=xml, csw_type='service')
+            Service.objects.filter(id=self.id).update(
+                anytext=anytexts, xml=self.xml, xml_hash=self.xml_hash, csw_type='service')
+            fulltext.set_texts(Service, {self.id: anytexts})
+            caching.increment_generation()
         except Exception as err:
             print(err)
             message = str(err)
             success = False
+            timed_out = budgets.is_timeout(err)
 
         end_time = datetime.datetime.utcnow()
         delta = end_time - start_time
@@ -378,6 +442,7 @@ class Service(Resource):
         check = Check(
             content_object=self,
             success=success,
+            timed_out=timed_out,
             response_time=response_time,
             message=message
         )
@@ -411,6 +476,9 @@ class Layer(Resource):
     bbox_y0 = models.DecimalField(max_digits=19, decimal_places=10, blank=True, null=True)
     bbox_y1 = models.DecimalField(max_digits=19, decimal_places=10, blank=True, null=True)
     thumbnail = models.ImageField(upload_to='layers', blank=True, null=True)
+    # md5 of the thumbnail image, and of the service and bbox it was generated from
+    thumbnail_hash = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    thumbnail_source_hash = models.CharField(max_length=32, null=True, blank=True)
     page_url = models.URLField(max_length=255)
     service = models.ForeignKey(Service)
     catalogs = models.ManyToManyField(Catalog)
@@ -463,26 +531,52 @@ class Layer(Resource):
                     end_date.append(pydate)
                     end_date.append(1)
                     dates.append(end_date)
-        for layerdate in self.layerdate_set.all().order_by('date'):
-            sdate = layerdate.date
-            if 'TO' not in sdate:
-                pydate = get_parsed_date(sdate)
-                if pydate:
-                    date = []
-                    date.append(pydate)
-                    date.append(layerdate.type)
-                    dates.append(date)
+        # dates are parsed when the LayerDate is saved, see layerdate_pre_save
+        for layerdate in self.layerdate_set.filter(parsed_date__isnull=False).order_by('date'):
+            date = []
+            date.append(datetime.datetime.combine(layerdate.parsed_date, datetime.time()))
+            date.append(layerdate.type)
+            dates.append(date)
         return dates
 
-    def update_thumbnail(self):
+    def get_first_layer_date(self):
+        """
+        Returns the earliest parsed LayerDate for the layer, using a single ordered query.
+        """
+        return self.layerdate_set.filter(parsed_date__isnull=False).order_by('parsed_date', '-type').first()
+
+    def get_thumbnail_source_hash(self):
+        """
+        Returns a hash of what the thumbnail of the layer is generated from.
+        """
+        bbox = [None if coord is None else '%.6f' % float(coord)
+                for coord in (self.bbox_x0, self.bbox_y0, self.bbox_x1, self.bbox_y1)]
+        return hashlib.md5(repr((self.type, self.service.url, self.url, self.name, bbox))).hexdigest()
+
+    def update_thumbnail(self, force=False):
+        """
+        Generate the thumbnail of the layer, unless its service and bbox did not change since the
+        thumbnail was generated. The image is written only if it changed.
+        Returns True if the thumbnail changed.
+        """
+        source_hash = self.get_thumbnail_source_hash()
+        if not force and self.thumbnail and self.thumbnail_source_hash == source_hash:
+            print 'Thumbnail for layer id %s is up to date' % self.id
+            return False
         print 'Generating thumbnail for layer id %s' % self.id
+        return self.set_thumbnail(self.get_thumbnail_image(), source_hash)
+
+    def get_thumbnail_image(self):
+        """
+        Returns the content of the thumbnail image of the layer, fetched from its service.
+        """
         if not self.has_valid_bbox():
             raise ValueError('Extent for this layer is invalid, cannot generate thumbnail')
             return None
         format_error_message = 'This layer does not expose valid formats (png, jpeg) to generate the thumbnail'
         img = None
         if self.type == 'OGC:WMS':
-            ows = WebMapService(self.service.url)
+            ows = get_wms_capabilities(self.service, self.service.url)
             op_getmap = ows.getOperationByName('GetMap')
             image_format = 'image/png'
             if image_format not in op_getmap.formatOptions:
@@ -525,7 +619,7 @@ class Layer(Resource):
                                 format=image_format
                             )
         elif self.type == 'Hypermap:WorldMap':
-            ows = WebMapService(self.url, username=settings.WM_USERNAME, password=settings.WM_PASSWORD)
+            ows = get_wms_capabilities(self.service, self.url, settings.WM_USERNAME, settings.WM_PASSWORD)
             op_getmap = ows.getOperationByName('GetMap')
             image_format = 'image/png'
             if image_format not in op_getmap.formatOptions:
@@ -550,7 +644,7 @@ class Layer(Resource):
                 raise ValueError(img.read())
                 img = None
         elif self.type == 'Hypermap:WARPER':
-            ows = WebMapService(self.url)
+            ows = get_wms_capabilities(self.service, self.url)
             op_getmap = ows.getOperationByName('GetMap')
             image_format = 'image/png'
             if image_format not in op_getmap.formatOptions:
@@ -594,11 +688,10 @@ class Layer(Resource):
                 )
             except Exception, e:
                 print e
-            name = re.sub('[^\w\-_\. ]', '_', self.name)
-            thumbnail_file_name = '%s%s.jpg' % ('/tmp/', name)
-            image.save(thumbnail_file_name)
-            img = open(thumbnail_file_name)
-            os.remove(thumbnail_file_name)
+            # the image is read in memory, arcrest saves to file-like objects
+            img = StringIO()
+            image.save(img)
+            img.seek(0)
         elif self.type == 'ESRI:ArcGIS:ImageServer':
             image = None
             try:
@@ -612,40 +705,67 @@ class Layer(Resource):
                 image = arcserver.ExportImage(bbox=bbox)
             except Exception, e:
                 print e
-            name = re.sub('[^\w\-_\. ]', '_', self.name)
-            thumbnail_file_name = '%s%s.jpg' % ('/tmp/', name)
-            image.save(thumbnail_file_name)
-            img = open(thumbnail_file_name)
-            os.remove(thumbnail_file_name)
+            # the image is read in memory, arcrest saves to file-like objects
+            img = StringIO()
+            image.save(img)
+            img.seek(0)
 
-        # update thumb in model
         if img:
-            thumbnail_file_name = '%s.jpg' % self.name
-            upfile = SimpleUploadedFile(thumbnail_file_name, img.read(), "image/jpeg")
-            self.thumbnail.save(thumbnail_file_name, upfile, True)
-            print 'Thumbnail updated for layer %s' % self.name
+            return img.read()
+        return None
+
+    def set_thumbnail(self, content, source_hash=None):
+        """
+        Set the thumbnail image of the layer, stored by its hash (see thumbnails), only if the image changed.
+        Returns True if the thumbnail changed.
+        """
+        if not content:
+            return False
+        thumbnail_hash = thumbnails.get_thumbnail_hash(content)
+        previous_hash = self.thumbnail_hash
+        changed = False
+        # the image is not released by another layer between being found stored and being referenced
+        with thumbnails.thumbnail_lock(thumbnail_hash):
+            if not self.thumbnail or previous_hash != thumbnail_hash:
+                self.thumbnail = thumbnails.store_thumbnail(content, thumbnail_hash)
+                changed = True
+                print 'Thumbnail updated for layer %s' % self.name
+            self.thumbnail_hash = thumbnail_hash
+            self.thumbnail_source_hash = source_hash or self.get_thumbnail_source_hash()
+            # update() does not send signals, the thumbnail is not part of the metadata
+            Layer.objects.filter(id=self.id).update(
+                thumbnail=self.thumbnail.name,
+                thumbnail_hash=self.thumbnail_hash,
+                thumbnail_source_hash=self.thumbnail_source_hash
+            )
+        if changed:
+            # checked again now that it is referenced, in case the lock was not taken in time
+            thumbnails.store_thumbnail(content, thumbnail_hash)
+        if changed and previous_hash != thumbnail_hash:
+            thumbnails.release_thumbnail(previous_hash)
+        return changed
 
     def check_available(self):
         """
         Check for availability of a layer and provide run metrics.
         """
         success = True
+        timed_out = False
         start_time = datetime.datetime.utcnow()
         message = ''
         print 'Checking layer id %s' % self.id
         try:
             signals.post_save.disconnect(layer_post_save, sender=Layer)
-            self.update_thumbnail()
+            probes.probe_layer(self)
             if settings.SEARCH_ENABLED:
-                if not settings.SKIP_CELERY_TASK:
-                    index_layer.delay(self)
-                else:
-                    index_layer(self)
+                # indexed in bulk with the other layers checked meanwhile, by flush_index_buffer
+                mark_layers_dirty([self.id])
             signals.post_save.connect(layer_post_save, sender=Layer)
 
         except Exception, err:
             message = str(err)
             success = False
+            timed_out = budgets.is_timeout(err)
 
         end_time = datetime.datetime.utcnow()
 
@@ -655,6 +775,7 @@ class Layer(Resource):
         check = Check(
             content_object=self,
             success=success,
+            timed_out=timed_out,
             response_time=response_time,
             message=message
         )
@@ -678,10 +799,23 @@ class LayerDate(models.Model):
     date = models.CharField(max_length=25)
     type = models.IntegerField(choices=DATE_TYPES)
     layer = models.ForeignKey(Layer)
+    # normalized values, computed from date when the row is saved
+    parsed_date = models.DateField(null=True, blank=True, db_index=True)
+    year = models.IntegerField(null=True, blank=True)
+    is_bc = models.BooleanField(default=False)
+    range_start_year = models.IntegerField(null=True, blank=True)
+    range_end_year = models.IntegerField(null=True, blank=True)
 
     def __unicode__(self):
         return self.date
 
+    def normalize(self):
+        """
+        Set the normalized fields from the date string.
+        """
+        for field, value in get_normalized_date(self.date).items():
+            setattr(self, field, value)
+
 
 class LayerWM(models.Model):
     """
@@ -742,6 +876,46 @@ class TaskError(models.Model):
     message = models.TextField(blank=True, null=True)
 
 
+class IndexingRun(models.Model):
+    """
+    IndexingRun represents a successful delta indexing run, its start is used as the high-water mark.
+    """
+    started_datetime = models.DateTimeField()
+    finished_datetime = models.DateTimeField(auto_now=True)
+    indexed = models.IntegerField(default=0)
+    removed = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return 'Indexing run %s' % self.id
+
+
+class RemovedLayer(models.Model):
+    """
+    RemovedLayer represents a deleted layer which still needs to be removed from the search index.
+    """
+    layer_id = models.PositiveIntegerField()
+    removed_datetime = models.DateTimeField(auto_now_add=True)
+
+
+class DirtyLayer(models.Model):
+    """
+    DirtyLayer represents a layer saved or checked which still needs to be indexed, see the index buffer in indexing.
+    """
+    layer_id = models.PositiveIntegerField(unique=True)
+    marked_datetime = models.DateTimeField(auto_now_add=True)
+
+
+# namespaces and qualified tag names of the csw:Record documents
+RECORD_NSMAP = Namespaces().get_namespaces(['csw', 'dc', 'dct', 'ows'])
+RECORD_TAGS = dict((tag, nspath_eval(tag, RECORD_NSMAP)) for tag in (
+    'csw:Record', 'dc:identifier', 'dc:title', 'dct:alternative', 'dct:modified', 'dct:abstract', 'dc:type',
+    'dc:format', 'dc:source', 'dc:relation', 'dc:subject', 'dct:references', 'ows:BoundingBox',
+    'ows:LowerCorner', 'ows:UpperCorner'
+))
+
+WKT_NUMBER_RE = re.compile(r'[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?')
+
+
 def bbox2wktpolygon(bbox):
     """
     Return OGC WKT Polygon of a simple bbox list
@@ -755,6 +929,17 @@ def bbox2wktpolygon(bbox):
         % (minx, miny, minx, maxy, maxx, maxy, maxx, miny, minx, miny)
 
 
+def wkt2bbox(wkt):
+    """
+    Return the (minx, miny, maxx, maxy) bounds of an OGC WKT Polygon, as written by bbox2wktpolygon
+    """
+
+    if not wkt.startswith('POLYGON(('):
+        return loads(wkt).bounds
+    coords = [float(coord) for coord in WKT_NUMBER_RE.findall(wkt)]
+    return min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2])
+
+
 def create_metadata_record(**kwargs):
     """
     Create a csw:Record XML document from harvested metadata
@@ -767,40 +952,74 @@ def create_metadata_record(**kwargs):
 
     modified = '%sZ' % datetime.datetime.utcnow().isoformat().split('.')[0]
 
-    nsmap = Namespaces().get_namespaces(['csw', 'dc', 'dct', 'ows'])
-
-    e = etree.Element(nspath_eval('csw:Record', nsmap), nsmap=nsmap)
+    e = etree.Element(RECORD_TAGS['csw:Record'], nsmap=RECORD_NSMAP)
 
-    etree.SubElement(e, nspath_eval('dc:identifier', nsmap)).text = kwargs['identifier']
-    etree.SubElement(e, nspath_eval('dc:title', nsmap)).text = kwargs['title']
+    etree.SubElement(e, RECORD_TAGS['dc:identifier']).text = kwargs['identifier']
+    etree.SubElement(e, RECORD_TAGS['dc:title']).text = kwargs['title']
     if 'alternative' in kwargs:
-        etree.SubElement(e, nspath_eval('dct:alternative', nsmap)).text = kwargs['alternative']
-    etree.SubElement(e, nspath_eval('dct:modified', nsmap)).text = modified
-    etree.SubElement(e, nspath_eval('dct:abstract', nsmap)).text = kwargs['abstract']
-    etree.SubElement(e, nspath_eval('dc:type', nsmap)).text = kwargs['type']
-    etree.SubElement(e, nspath_eval('dc:format', nsmap)).text = kwargs['format']
-    etree.SubElement(e, nspath_eval('dc:source', nsmap)).text = kwargs['source']
+        etree.SubElement(e, RECORD_TAGS['dct:alternative']).text = kwargs['alternative']
+    etree.SubElement(e, RECORD_TAGS['dct:modified']).text = modified
+    etree.SubElement(e, RECORD_TAGS['dct:abstract']).text = kwargs['abstract']
+    etree.SubElement(e, RECORD_TAGS['dc:type']).text = kwargs['type']
+    etree.SubElement(e, RECORD_TAGS['dc:format']).text = kwargs['format']
+    etree.SubElement(e, RECORD_TAGS['dc:source']).text = kwargs['source']
 
     if 'relation' in kwargs:
-        etree.SubElement(e, nspath_eval('dc:relation', nsmap)).text = kwargs['relation']
+        etree.SubElement(e, RECORD_TAGS['dc:relation']).text = kwargs['relation']
 
     if 'keywords' in kwargs:
         if kwargs['keywords'] is not None:
             for keyword in kwargs['keywords']:
-                etree.SubElement(e, nspath_eval('dc:subject', nsmap)).text = keyword
+                etree.SubElement(e, RECORD_TAGS['dc:subject']).text = keyword
 
     for link in kwargs['links']:
-        etree.SubElement(e, nspath_eval('dct:references', nsmap), scheme=link[0]).text = link[1]
+        etree.SubElement(e, RECORD_TAGS['dct:references'], scheme=link[0]).text = link[1]
 
-    bbox2 = loads(kwargs['wkt_geometry']).bounds
-    bbox = etree.SubElement(e, nspath_eval('ows:BoundingBox', nsmap),
+    bbox2 = wkt2bbox(kwargs['wkt_geometry'])
+    bbox = etree.SubElement(e, RECORD_TAGS['ows:BoundingBox'],
                             crs='http://www.opengis.net/def/crs/EPSG/0/%s' % srs,
                             dimensions='2')
 
-    etree.SubElement(bbox, nspath_eval('ows:LowerCorner', nsmap)).text = '%s %s' % (bbox2[1], bbox2[0])
-    etree.SubElement(bbox, nspath_eval('ows:UpperCorner', nsmap)).text = '%s %s' % (bbox2[3], bbox2[2])
+    etree.SubElement(bbox, RECORD_TAGS['ows:LowerCorner']).text = '%s %s' % (bbox2[1], bbox2[0])
+    etree.SubElement(bbox, RECORD_TAGS['ows:UpperCorner']).text = '%s %s' % (bbox2[3], bbox2[2])
 
-    return etree.tostring(e, pretty_print=True)
+    return etree.tostring(e)
+
+
+def set_metadata_record(resource, **kwargs):
+    """
+    Set the csw:Record XML document of a resource from harvested metadata (as for
+    create_metadata_record), only generated again when the metadata changed.
+    Return True if the document was generated.
+    """
+
+    xml_hash = hashlib.md5(repr(sorted(kwargs.items()))).hexdigest()
+    if resource.xml_hash == xml_hash and resource.xml:
+        return False
+    resource.xml = create_metadata_record(**kwargs)
+    resource.xml_hash = xml_hash
+    return True
+
+
+def set_metadata_record_bbox(resource):
+    """
+    Set the bounding box of the csw:Record XML document of a resource to its wkt_geometry, i.e. once its
+    bbox is repaired. The document is generated again as a whole at the next harvest.
+    """
+
+    try:
+        e = etree.fromstring(resource.xml)
+    except (TypeError, ValueError, etree.XMLSyntaxError):
+        return False
+    bbox = e.find(RECORD_TAGS['ows:BoundingBox'])
+    if bbox is None:
+        return False
+    bbox2 = wkt2bbox(resource.wkt_geometry)
+    bbox.find(RECORD_TAGS['ows:LowerCorner']).text = '%s %s' % (bbox2[1], bbox2[0])
+    bbox.find(RECORD_TAGS['ows:UpperCorner']).text = '%s %s' % (bbox2[3], bbox2[2])
+    resource.xml = etree.tostring(e)
+    resource.xml_hash = None
+    return True
 
 
 def gen_anytext(*args):
@@ -823,12 +1042,33 @@ def gen_anytext(*args):
 
 # updatelayers for each service type
 
+# how long the WMS capabilities of a service are reused by the thumbnails of its layers, in seconds
+WMS_CAPABILITIES_TIMEOUT = 3600
+
+
+def get_wms_capabilities(service, url, username=None, password=None):
+    """
+    Returns the parsed WMS capabilities of a service, fetched once for the thumbnails of its layers:
+    the document is kept in the shared cache by service and by the time the service was last updated
+    (a harvest of the service makes it stale).
+    """
+    key = 'wms-capabilities-%s-%s' % (
+        service.id, hashlib.md5(repr((url, service.last_updated))).hexdigest())
+    cache = caching.get_shared_cache()
+    xml = cache.get(key)
+    if xml is None:
+        reader = WMSCapabilitiesReader('1.1.1', url=url, un=username, pw=password)
+        xml = etree.tostring(reader.read(url, timeout=budgets.get_read_timeout()))
+        cache.set(key, xml, WMS_CAPABILITIES_TIMEOUT)
+    return WebMapService(url, xml=xml, username=username, password=password, timeout=budgets.get_read_timeout())
+
+
 def update_layers_wms(service):
     """
     Update layers for an OGC:WMS service.
     Sample endpoint: http://demo.geonode.org/geoserver/ows
     """
-    wms = WebMapService(service.url)
+    wms = WebMapService(service.url, timeout=budgets.get_read_timeout())
     layer_names = list(wms.contents)
     parent = wms.contents[layer_names[0]].parent
     # fallback, some endpoint like this one:
@@ -875,7 +1115,8 @@ def update_layers_wms(service):
                 layer.keywords.add(keyword)
             # crsOptions
             # TODO we may rather prepopulate with fixutres the SpatialReferenceSystem table
-            layer.xml = create_metadata_record(
+            set_metadata_record(
+                layer,
                 identifier=layer.id_string,
                 source=service.url,
                 links=links,
@@ -942,7 +1183,8 @@ def update_layers_wmts(service):
             layer.bbox_x1 = bbox[2]
             layer.bbox_y1 = bbox[3]
             layer.wkt_geometry = bbox2wktpolygon(bbox)
-            layer.xml = create_metadata_record(
+            set_metadata_record(
+                layer,
                 identifier=layer.id_string,
                 source=service.url,
                 links=links,
@@ -971,7 +1213,7 @@ def update_layers_wm(service):
     Update layers for an WorldMap.
     Sample endpoint: http://worldmap.harvard.edu/
     """
-    response = requests.get('http://worldmap.harvard.edu/data/search/api?start=0&limit=10')
+    response = httpclient.get('http://worldmap.harvard.edu/data/search/api?start=0&limit=10')
     data = json.loads(response.content)
     total = data['total']
 
@@ -985,7 +1227,7 @@ def update_layers_wm(service):
     for i in range(0, total, 10):
         url = 'http://worldmap.harvard.edu/data/search/api?start=%s&limit=10' % i
         print 'Fetching %s' % url
-        response = requests.get(url)
+        response = httpclient.get(url)
         data = json.loads(response.content)
         for row in data['rows']:
             name = row['name']
@@ -1060,7 +1302,7 @@ def update_layers_warper(service):
     """
     params = {'field': 'title', 'query': '', 'show_warped': '1', 'format': 'json'}
     headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
-    request = requests.get(service.url, headers=headers, params=params)
+    request = httpclient.get(service.url, headers=headers, params=params)
     records = json.loads(request.content)
     total_pages = int(records['total_pages'])
 
@@ -1072,7 +1314,7 @@ def update_layers_warper(service):
 
     for i in range(1, total_pages + 1):
         params = {'field': 'title', 'query': '', 'show_warped': '1', 'format': 'json', 'page': i}
-        request = requests.get(service.url, headers=headers, params=params)
+        request = httpclient.get(service.url, headers=headers, params=params)
         records = json.loads(request.content)
         print 'Fetched %s' % request.url
         layers = records['items']
@@ -1201,7 +1443,8 @@ def update_layers_esri_mapserver(service):
                 except Exception:
                     pass
                 layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
-                layer.xml = create_metadata_record(
+                set_metadata_record(
+                    layer,
                     identifier=layer.id_string,
                     source=service.url,
                     links=links,
@@ -1254,7 +1497,8 @@ def update_layers_esri_imageserver(service):
             settings.SITE_URL.rstrip('/') + layer.page_url
         ])
         layer.wkt_geometry = bbox2wktpolygon([layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1])
-        layer.xml = create_metadata_record(
+        set_metadata_record(
+            layer,
             identifier=layer.id_string,
             source=service.url,
             links=links,
@@ -1325,6 +1569,56 @@ def service_post_save(instance, *args, **kwargs):
         check_service(instance)
 
 
+def resource_post_save(sender, instance, *args, **kwargs):
+    """
+    Used to keep the spatial and full-text indexes in sync with the resource geometry and anytext,
+    and to make stale the responses cached for the previous generation of the catalogue.
+    """
+    spatial.set_bboxes(sender, {instance.id: instance.wkt_geometry})
+    fulltext.set_texts(sender, {instance.id: instance.anytext})
+    caching.increment_generation()
+
+
+def resource_post_delete(sender, instance, *args, **kwargs):
+    spatial.remove_bboxes(sender, [instance.id])
+    fulltext.remove_texts(sender, [instance.id])
+    caching.increment_generation()
+
+
+def layer_catalogs_changed(action, *args, **kwargs):
+    """
+    Used to make stale the responses cached for the catalogs of the layer.
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        caching.increment_generation()
+
+
+def create_resource_indexes(app_config, *args, **kwargs):
+    """
+    Used to create the spatial and full-text index side tables, which are not managed by django.
+    """
+    if app_config.label == 'aggregator':
+        for model in (Service, Layer):
+            spatial.create_spatial_index(model)
+            fulltext.create_fulltext_index(model)
+
+
+def layerdate_pre_save(instance, *args, **kwargs):
+    """
+    Used to parse the date string only once, when the layer date is written.
+    """
+    instance.normalize()
+
+
+def layer_post_delete(instance, *args, **kwargs):
+    """
+    Used to remove a deleted layer from the search index at the next delta indexing run,
+    and its thumbnail if no other layer shares it.
+    """
+    RemovedLayer.objects.create(layer_id=instance.id)
+    thumbnails.release_thumbnail(instance.thumbnail_hash)
+
+
 def layer_post_save(instance, *args, **kwargs):
     """
     Used to do a layer full check when saving it.
@@ -1340,3 +1634,11 @@ signals.post_save.connect(endpointlist_post_save, sender=EndpointList)
 signals.pre_save.connect(service_pre_save, sender=Service)
 signals.post_save.connect(service_post_save, sender=Service)
 signals.post_save.connect(layer_post_save, sender=Layer)
+signals.post_delete.connect(layer_post_delete, sender=Layer)
+signals.pre_save.connect(layerdate_pre_save, sender=LayerDate)
+signals.post_save.connect(resource_post_save, sender=Service)
+signals.post_save.connect(resource_post_save, sender=Layer)
+signals.post_delete.connect(resource_post_delete, sender=Service)
+signals.post_delete.connect(resource_post_delete, sender=Layer)
+signals.m2m_changed.connect(layer_catalogs_changed, sender=Layer.catalogs.through)
+signals.post_migrate.connect(create_resource_indexes)
@@ -0,0 +1,172 @@
+"""
+Lightweight availability probes of the layers, one small request by check instead of generating
+a thumbnail: a 1x1 GetMap for WMS layers, a single tile for WMTS layers (its url is found in the
+capabilities once, then cached), the layer listed in the service description for ESRI layers (the
+description is fetched once for the layers of a service checked together).
+The probe of each layer type is set in settings.LAYER_PROBES.
+Probes raise ValueError when the layer is not available.
+"""
+
+import hashlib
+
+from django.conf import settings
+
+from owslib.wmts import WebMapTileService, WMTSCapabilitiesReader
+
+from hypermap.aggregator import caching, httpclient
+
+# how long the tile url of a WMTS layer is cached, in seconds
+WMTS_TILE_URL_TIMEOUT = 86400
+
+# how long the description of an ESRI service is reused by the checks of its layers, in seconds
+ESRI_DESCRIPTION_TIMEOUT = 300
+
+WORLD_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+
+def check_image_response(response):
+    response.raise_for_status()
+    content_type = response.headers.get('content-type', '')
+    if not content_type.startswith('image/'):
+        raise ValueError('Expected an image, got %s: %s' % (content_type, response.content[:200]))
+
+
+def probe_wms(url, layer_name, bbox=None, auth=None):
+    """
+    Request a 1x1 image of a WMS layer.
+    """
+    params = {
+        'SERVICE': 'WMS',
+        'VERSION': '1.1.1',
+        'REQUEST': 'GetMap',
+        'LAYERS': layer_name,
+        'STYLES': '',
+        'SRS': 'EPSG:4326',
+        'BBOX': ','.join(str(coord) for coord in bbox or WORLD_BBOX),
+        'WIDTH': '1',
+        'HEIGHT': '1',
+        'FORMAT': 'image/png',
+        'TRANSPARENT': 'TRUE',
+    }
+    check_image_response(httpclient.get(url, params=params, auth=auth))
+
+
+def get_wmts_tile_url(url, layer_name):
+    """
+    Returns the url of the first tile of a WMTS layer, as found in the capabilities.
+    """
+    # fetched with the http client, within the timeouts of the operation: owslib has no timeout for WMTS
+    response = httpclient.get(WMTSCapabilitiesReader().capabilities_url(url))
+    response.raise_for_status()
+    wmts = WebMapTileService(url, xml=response.content)
+    ows_layer = wmts.contents[layer_name]
+    image_format = 'image/png'
+    if image_format not in ows_layer.formats:
+        image_format = 'image/jpeg' if 'image/jpeg' in ows_layer.formats else ows_layer.formats[0]
+    tilematrixset = ows_layer.tilematrixsets[0]
+    # the tile matrix identifiers are not always numbers, the coarsest one has a single tile at 0, 0
+    tilematrices = wmts.tilematrixsets[tilematrixset].tilematrix.values()
+    tilematrix = max(tilematrices, key=lambda matrix: matrix.scaledenominator).identifier
+    if wmts.restonly:
+        return wmts.buildTileResource(layer_name, None, image_format, tilematrixset, tilematrix, '0', '0')
+    request = wmts.buildTileRequest(layer_name, None, image_format, tilematrixset, tilematrix, '0', '0')
+    return '%s%s%s' % (url, '&' if '?' in url else '?', request)
+
+
+def probe_wmts(url, layer_name):
+    """
+    Request the first tile of a WMTS layer.
+    """
+    cache = caching.get_shared_cache()
+    key = 'wmts-tile-url-%s' % hashlib.md5(repr((url, layer_name))).hexdigest()
+    tile_url = cache.get(key)
+    if tile_url is None:
+        tile_url = get_wmts_tile_url(url, layer_name)
+        cache.set(key, tile_url, WMTS_TILE_URL_TIMEOUT)
+    check_image_response(httpclient.get(tile_url))
+
+
+def get_esri_description(url):
+    """
+    Returns the description of an ESRI service, cached for the checks of its other layers.
+    """
+    cache = caching.get_shared_cache()
+    key = 'esri-description-%s' % hashlib.md5(url).hexdigest()
+    description = cache.get(key)
+    if description is not None:
+        return description
+    response = httpclient.get(url, params={'f': 'json'})
+    response.raise_for_status()
+    try:
+        description = response.json()
+    except ValueError:
+        raise ValueError('Expected a service description: %s' % response.content[:200])
+    if 'error' in description:
+        raise ValueError(description['error'])
+    cache.set(key, description, ESRI_DESCRIPTION_TIMEOUT)
+    return description
+
+
+def probe_esri(url, layer_name=None):
+    """
+    Request the description of an ESRI service, and check it still lists a layer: by id for a MapServer,
+    by name for an ImageServer (a single layer).
+    """
+    description = get_esri_description(url)
+    if layer_name is None:
+        return
+    if 'layers' in description:
+        layer_ids = [str(esri_layer.get('id')) for esri_layer in description['layers']]
+        if str(layer_name) not in layer_ids:
+            raise ValueError('Layer %s is not listed by the service' % layer_name)
+    elif description.get('name') not in (None, layer_name):
+        raise ValueError('Layer %s is not served by the service' % layer_name)
+
+
+def get_layer_bbox(layer):
+    if layer.has_valid_bbox():
+        return [float(coord) for coord in (layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1)]
+    return None
+
+
+def probe_layer_wms(layer):
+    if layer.type == 'Hypermap:WorldMap':
+        probe_wms(layer.url, layer.name, get_layer_bbox(layer), auth=(settings.WM_USERNAME, settings.WM_PASSWORD))
+    elif layer.type == 'OGC:WMS':
+        probe_wms(layer.service.url, layer.name, get_layer_bbox(layer))
+    else:
+        probe_wms(layer.url, layer.name, get_layer_bbox(layer))
+
+
+def probe_layer_wmts(layer):
+    probe_wmts(layer.service.url, layer.name)
+
+
+def probe_layer_esri(layer):
+    probe_esri(layer.service.url, layer.name)
+
+
+def probe_layer_url(layer):
+    httpclient.get(layer.url).raise_for_status()
+
+
+def probe_layer_thumbnail(layer):
+    # the heavier check done before the probes, generating the thumbnail
+    layer.update_thumbnail(force=True)
+
+
+# the probes which can be set for a layer type in settings.LAYER_PROBES
+PROBES = {
+    'wms': probe_layer_wms,
+    'wmts': probe_layer_wmts,
+    'esri': probe_layer_esri,
+    'url': probe_layer_url,
+    'thumbnail': probe_layer_thumbnail,
+}
+
+
+def probe_layer(layer):
+    """
+    Check a layer is available with the probe of its type, by default one small request to its url.
+    """
+    PROBES[settings.LAYER_PROBES.get(layer.type, 'url')](layer)
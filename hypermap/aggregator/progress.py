@@ -0,0 +1,94 @@
+"""
+Throttled progress of the tasks, kept in the shared cache: a task reports its progress at most once every
+PROGRESS_REPORT_ITEMS items or PROGRESS_REPORT_INTERVAL seconds, instead of at every item.
+A task fanning out to child tasks (i.e. check_all_services) gives them its id as progress_id, the children
+count themselves done in a counter of the parent, so that its progress is the one of the whole job.
+The progress of a task is read with a single get_many, see get_progress. Reports are also the heartbeat
+of the lock of a deduplicated task (see dedup).
+"""
+
+import time
+
+from django.conf import settings
+
+from hypermap.aggregator import caching
+
+PROGRESS_KEY = 'task-progress-%s'
+CHILDREN_DONE_KEY = 'task-progress-%s-children-done'
+
+# seconds the progress of a task is kept
+PROGRESS_TIMEOUT = 86400
+
+
+class ProgressReporter(object):
+    """
+    Reports the progress of a task, throttled. Tasks called directly (not queued) do not report.
+    """
+
+    def __init__(self, task, total=0, every=None, interval=None):
+        self.task = task
+        self.task_id = None if task.request.called_directly else task.request.id
+        self.current = 0
+        self.total = total
+        self.children = 0
+        self.every = every or settings.PROGRESS_REPORT_ITEMS
+        self.interval = interval or settings.PROGRESS_REPORT_INTERVAL
+        self.reported_count = None
+        self.reported_time = 0
+
+    def update(self, current, total=None, children=0):
+        """
+        Set the number of items processed, and count the child tasks queued to process them.
+        """
+        self.current = current
+        if total is not None:
+            self.total = total
+        self.children += children
+        if (self.reported_count is None or current - self.reported_count >= self.every or
+                time.time() - self.reported_time >= self.interval):
+            self.report()
+
+    def report(self):
+        if self.task_id is None:
+            return
+        caching.get_shared_cache().set(PROGRESS_KEY % self.task_id, {
+            'current': self.current,
+            'total': self.total,
+            'children': self.children,
+        }, PROGRESS_TIMEOUT)
+        # the lock of a deduplicated task is extended as long as it reports progress
+        heartbeat = getattr(self.task, 'heartbeat', None)
+        if heartbeat is not None:
+            heartbeat()
+        self.reported_count = self.current
+        self.reported_time = time.time()
+
+
+def child_done(progress_id):
+    """
+    Count a child task done in the progress of its parent task.
+    """
+    if progress_id is None:
+        return
+    cache = caching.get_shared_cache()
+    key = CHILDREN_DONE_KEY % progress_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        # first child done
+        if not cache.add(key, 1, PROGRESS_TIMEOUT):
+            cache.incr(key)
+
+
+def get_progress(task_id):
+    """
+    Returns the progress of a task as (current, total), or None. The items of a task handed to child tasks
+    count as processed once the children are done.
+    """
+    keys = (PROGRESS_KEY % task_id, CHILDREN_DONE_KEY % task_id)
+    values = caching.get_shared_cache().get_many(keys)
+    progress = values.get(keys[0])
+    if progress is None:
+        return None
+    current = progress['current'] - progress['children'] + values.get(keys[1], 0)
+    return current, progress['total']
@@ -1,161 +1,214 @@
+import re
 import sys
 import pysolr
-import requests
 import logging
 import json
 import datetime
 
-from urlparse import urlparse
 from django.conf import settings
-from django.utils.html import strip_tags
-
-from hypermap.aggregator.utils import mercator_to_llbbox
-
-
-def get_date(layer):
-    """
-    Returns a date for Solr. A date can be detected or from metadata.
-    It can be a range or a simple date in isoformat.
-    """
-    date = None
-    date_type = 1
-    layer_dates = layer.get_layer_dates()
-    if layer_dates:
-        date = layer_dates[0][0]
-        date_type = layer_dates[0][1]
-    if date is None:
-        date = layer.created.date()
-    # layer date > 2300 is invalid for sure
-    # TODO put this logic in date miner
-    if date.year > 2300:
-        date = None
-    if date_type == 0:
-        date_type = "Detected"
-    if date_type == 1:
-        date_type = "From Metadata"
-    return get_solr_date(date), date_type
-
-
-def get_solr_date(pydate):
-    """
-    Returns a date in a valid Solr format from a string.
-    """
-    # check if date is valid and then set it to solr format YYYY-MM-DDThh:mm:ssZ
-    try:
-        if isinstance(pydate, datetime.datetime):
-            solr_date = '%sZ' % pydate.isoformat()[0:19]
-            return solr_date
-        else:
-            return None
-    except Exception:
-        return None
+
+from hypermap.aggregator import budgets, httpclient
+from hypermap.aggregator.indexing import get_layer_document
 
 
 class SolrHypermap(object):
 
-    def get_domain(self, url):
-        urlParts = urlparse(url)
-        hostname = urlParts.hostname
-        if hostname == "localhost":
-            return "Harvard"  # assumption
-        return hostname
+    def __init__(self, url=None, alias=None):
+        # url of the core (or alias) to write to, defaults to the one searched by clients
+        self.url = url or settings.SEARCH_URL
+        self.alias = alias or settings.SEARCH_SOLR_ALIAS or self.get_collection_name()
+        super(SolrHypermap, self).__init__()
+
+    @staticmethod
+    def document_to_solr(document):
+        """
+        Translate a canonical layer document to a solr record.
+        """
+        solr_record = {
+                        'id': document['id'],
+                        'type': 'Layer',
+                        'layer_id': document['id'],
+                        'name': document['name'],
+                        'title': document['title'],
+                        'layer_originator': document['originator'],
+                        'service_id': document['service_id'],
+                        'service_type': document['service_type'],
+                        'layer_category': document['category'],
+                        'layer_username': document['username'],
+                        'url': document['url'],
+                        'reliability': document['reliability'],
+                        'recent_reliability': document['recent_reliability'],
+                        'last_status': document['last_status'],
+                        'is_public': document['is_public'],
+                        'availability': 'Online',
+                        'location': document['location'],
+                        'abstract': document['abstract'],
+                        'domain_name': document['domain_name']
+                        }
+        if document['date'] is not None:
+            solr_record['layer_date'] = document['date']
+            solr_record['layer_datetype'] = document['date_type']
+        bbox = document['bbox']
+        if bbox is not None:
+            solr_record['min_x'] = bbox['min_x']
+            solr_record['min_y'] = bbox['min_y']
+            solr_record['max_x'] = bbox['max_x']
+            solr_record['max_y'] = bbox['max_y']
+            solr_record['area'] = bbox['area']
+            solr_record['bbox'] = bbox['wkt']
+            solr_record['srs'] = document['srs']
+        if document['tile_url']:
+            solr_record['tile_url'] = document['tile_url']
+        return solr_record
 
     def layer_to_solr(self, layer):
+        return self.index_document(get_layer_document(layer))
+
+    def index_document(self, document):
         logger = logging.getLogger("hypermap")
-        category = None
-        username = None
         try:
-            bbox = None
-            if not layer.has_valid_bbox():
-                message = 'There are not valid coordinates for layer id: %s' % layer.id
-                logger.error(message)
-            else:
-                bbox = [float(layer.bbox_x0), float(layer.bbox_y0), float(layer.bbox_x1), float(layer.bbox_y1)]
-                for proj in layer.service.srs.values():
-                    if proj['code'] in ('102113', '102100'):
-                        bbox = mercator_to_llbbox(bbox)
-                minX = bbox[0]
-                minY = bbox[1]
-                maxX = bbox[2]
-                maxY = bbox[3]
-                # coords hack needed by solr
-                if (minX < -180):
-                    minX = -180
-                if (maxX > 180):
-                    maxX = 180
-                if (minY < -90):
-                    minY = -90
-                if (maxY > 90):
-                    maxY = 90
-                wkt = "ENVELOPE({:f},{:f},{:f},{:f})".format(minX, maxX, maxY, minY)
-                halfWidth = (maxX - minX) / 2.0
-                halfHeight = (maxY - minY) / 2.0
-                area = (halfWidth * 2) * (halfHeight * 2)
-            domain = self.get_domain(layer.service.url)
-            if hasattr(layer, 'layerwm'):
-                category = layer.layerwm.category
-                username = layer.layerwm.username
-            abstract = layer.abstract
-            if abstract:
-                abstract = strip_tags(layer.abstract)
-            else:
-                abstract = ''
-            if layer.type == "WM":
-                originator = username
-            else:
-                originator = domain
-            # now we add the index
-            solr_record = {
-                            'id': layer.id,
-                            'type': 'Layer',
-                            'layer_id': layer.id,
-                            'name': layer.name,
-                            'title': layer.title,
-                            'layer_originator': originator,
-                            'service_id': layer.service.id,
-                            'service_type': layer.service.type,
-                            'layer_category': category,
-                            'layer_username': username,
-                            'url': layer.url,
-                            'reliability': layer.reliability,
-                            'recent_reliability': layer.recent_reliability,
-                            'last_status': layer.last_status,
-                            'is_public': layer.is_public,
-                            'availability': 'Online',
-                            'location': '{"layerInfoPage": "' + layer.get_absolute_url() + '"}',
-                            'abstract': abstract,
-                            'domain_name': layer.service.get_domain
-                            }
-
-            solr_date, date_type = get_date(layer)
-            if solr_date is not None:
-                solr_record['layer_date'] = solr_date
-                solr_record['layer_datetype'] = date_type
-            if bbox is not None:
-                solr_record['min_x'] = minX
-                solr_record['min_y'] = minY
-                solr_record['max_x'] = maxX
-                solr_record['max_y'] = maxY
-                solr_record['area'] = area
-                solr_record['bbox'] = wkt
-                srs_list = [srs.encode('utf-8') for srs in layer.service.srs.values_list('code', flat=True)]
-                # solr_record['srs'] = ', '.join(srs_list)
-                solr_record['srs'] = srs_list
-            if layer.get_tile_url():
-                solr_record['tile_url'] = layer.get_tile_url()
-
             # time to send request to solr
-            url_solr_update = '%s/update/json/docs' % settings.SEARCH_URL
+            url_solr_update = '%s/update/json/docs' % self.url
+            headers = {"content-type": "application/json"}
+            params = {"commitWithin": 1500}
+            solr_json = json.dumps(self.document_to_solr(document))
+            response = httpclient.post(
+                url_solr_update, data=solr_json, params=params, headers=headers, timeout=budgets.get_timeout('index'))
+            response.raise_for_status()
+            logger.info("Solr record saved for layer with id: %s" % document['id'])
+            return True, None
+        except Exception:
+            logger.error("Error saving solr record for layer with id: %s - %s" % (document['id'], sys.exc_info()[1]))
+            return False, sys.exc_info()[1]
+
+    def index_documents(self, documents, commit=False):
+        """
+        Send many layer documents to solr with a single update request.
+        """
+        logger = logging.getLogger("hypermap")
+        solr_records = [self.document_to_solr(document) for document in documents]
+        url_solr_update = '%s/update' % self.url
+        headers = {"content-type": "application/json"}
+        params = {"commit": "true"} if commit else {"commitWithin": 15000}
+        response = httpclient.post(
+            url_solr_update, data=json.dumps(solr_records), params=params, headers=headers,
+            timeout=budgets.get_timeout('index'))
+        response.raise_for_status()
+        logger.info("%s solr records saved" % len(solr_records))
+        return len(solr_records)
+
+    def remove_layer(self, layer_id):
+        """Remove a layer from the solr core"""
+        logger = logging.getLogger("hypermap")
+        try:
+            url_solr_update = '%s/update/json' % self.url
             headers = {"content-type": "application/json"}
             params = {"commitWithin": 1500}
-            solr_json = json.dumps(solr_record)
-            requests.post(url_solr_update, data=solr_json, params=params,  headers=headers)
-            logger.info("Solr record saved for layer with id: %s" % layer.id)
+            solr_json = json.dumps({'delete': {'id': str(layer_id)}})
+            response = httpclient.post(
+                url_solr_update, data=solr_json, params=params, headers=headers, timeout=budgets.get_timeout('index'))
+            response.raise_for_status()
+            logger.info("Solr record removed for layer with id: %s" % layer_id)
             return True, None
         except Exception:
-            logger.error("Error saving solr record for layer with id: %s - %s" % (layer.id, sys.exc_info()[1]))
+            logger.error("Error removing solr record for layer with id: %s - %s" % (layer_id, sys.exc_info()[1]))
             return False, sys.exc_info()[1]
 
+    def commit(self):
+        """Commit pending documents"""
+        response = httpclient.get(
+            '%s/update' % self.url, params={'commit': 'true'}, timeout=budgets.get_timeout('index'))
+        response.raise_for_status()
+
+    def get_collections_api(self, action, **params):
+        """Call the solr Collections API"""
+        solr_base_url = self.url.rstrip('/').rsplit('/', 1)[0]
+        params.update({'action': action, 'wt': 'json'})
+        response = httpclient.get(
+            '%s/admin/collections' % solr_base_url, params=params, timeout=budgets.get_timeout('index'))
+        response.raise_for_status()
+        return response.json()
+
+    def get_alias_name(self):
+        """The name of the alias searched by clients"""
+        return self.alias
+
+    def get_collection_name(self):
+        return self.url.rstrip('/').rsplit('/', 1)[1]
+
+    def get_aliased_collections(self):
+        """Return the collections the alias is pointing to"""
+        aliases = self.get_collections_api('CLUSTERSTATUS')['cluster'].get('aliases', {})
+        collections = aliases.get(self.get_alias_name())
+        if collections:
+            return collections.split(',')
+        return []
+
+    def get_collections(self):
+        """Return the names of the collections of the cluster"""
+        return self.get_collections_api('LIST').get('collections', [])
+
+    def check_alias(self):
+        """
+        Refuse to rebuild while the alias name is taken by a collection, i.e. the SEARCH_URL one created before
+        aliases were used: solr has no atomic rename, and the collection searched by clients is not dropped.
+        """
+        if self.get_alias_name() in self.get_collections():
+            raise ValueError(
+                'Solr collection %s is not an alias: set SEARCH_SOLR_ALIAS to a new name, rebuild the index, then '
+                'point SEARCH_URL to the alias' % self.get_alias_name())
+
+    def get_versioned_collections(self):
+        """Return the versioned collections of the alias, oldest first"""
+        versioned_re = re.compile(r'^%s_\d{14}$' % re.escape(self.get_alias_name()))
+        return sorted(name for name in self.get_collections() if versioned_re.match(name))
+
+    def create_versioned(self):
+        """
+        Create a new, empty, versioned collection to be filled before swapping the alias to it.
+        Returns a SolrHypermap writing to the new collection.
+        """
+        logger = logging.getLogger("hypermap")
+        self.check_alias()
+        name = '%s_%s' % (self.get_alias_name(), datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        self.get_collections_api(
+            'CREATE',
+            name=name,
+            numShards=settings.SEARCH_SOLR_SHARDS,
+            replicationFactor=settings.SEARCH_SOLR_REPLICAS,
+            **{'collection.configName': settings.SEARCH_SOLR_CONFIG_NAME}
+        )
+        logger.info("Solr collection %s created" % name)
+        solr_base_url = self.url.rstrip('/').rsplit('/', 1)[0]
+        return SolrHypermap('%s/%s' % (solr_base_url, name), alias=self.alias)
+
+    def swap_alias(self):
+        """
+        Atomically point the alias to the collection of this writer. Previous collections are kept for rollback.
+        Returns the previous collections.
+        """
+        logger = logging.getLogger("hypermap")
+        self.check_alias()
+        previous_collections = self.get_aliased_collections()
+        self.get_collections_api('CREATEALIAS', name=self.get_alias_name(), collections=self.get_collection_name())
+        logger.info("Solr alias %s now points to %s (previously %s)" % (
+            self.get_alias_name(), self.get_collection_name(), ','.join(previous_collections)))
+        return previous_collections
+
+    def prune_versioned(self, keep):
+        """
+        Delete the versioned collections of the alias but the one it points to and the previous ones kept for
+        rollback. Returns the collections deleted.
+        """
+        logger = logging.getLogger("hypermap")
+        aliased = self.get_aliased_collections()
+        previous_collections = [name for name in self.get_versioned_collections() if name not in aliased]
+        pruned = previous_collections[:max(len(previous_collections) - keep, 0)]
+        for name in pruned:
+            self.get_collections_api('DELETE', name=name)
+            logger.info("Solr collection %s deleted" % name)
+        return pruned
+
     def clear_solr(self):
         """Clear all indexes in the solr core"""
         solr_url = settings.SEARCH_URL
@@ -0,0 +1,214 @@
+"""
+Spatial index of the resource bboxes, kept in a side table of each resource table and
+filled from wkt_geometry: an rtree virtual table on SQLite, a box column with a GiST index
+on PostgreSQL (no PostGIS needed). Bbox queries are then index lookups instead of a full
+scan parsing the WKT of each row.
+Databases without the needed features (i.e. SQLite built without rtree) are probed once, and
+fall back to the filters on the bbox fields.
+"""
+
+import math
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from shapely.wkt import loads
+
+SUPPORTED_VENDORS = ('sqlite', 'postgresql')
+
+# results of the probes of the spatial index features, by database alias
+_available = {}
+
+
+def is_enabled():
+    return settings.SPATIAL_INDEX_ENABLED and connection.vendor in SUPPORTED_VENDORS and is_available()
+
+
+def is_available():
+    """
+    Tell if the database supports the spatial index, probed once by database.
+    """
+    if connection.alias not in _available:
+        _available[connection.alias] = probe_spatial_index()
+    return _available[connection.alias]
+
+
+def probe_spatial_index():
+    if connection.vendor != 'sqlite':
+        # box and gist are available on every supported PostgreSQL version
+        return True
+    try:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('CREATE VIRTUAL TABLE temp.spatial_probe USING rtree(id, min_x, max_x)')
+            cursor.execute('DROP TABLE temp.spatial_probe')
+    except DatabaseError as err:
+        print 'Spatial index not available, bbox fields are filtered instead: %s' % err
+        return False
+    return True
+
+
+def get_table_name(model):
+    return '%s_bbox' % model._meta.db_table
+
+
+def get_wkt_bounds(wkt):
+    """
+    Returns the (minx, miny, maxx, maxy) bounds of a WKT geometry, or None if it is not valid.
+    """
+    try:
+        bounds = loads(wkt).bounds
+    except Exception:
+        return None
+    if len(bounds) != 4:
+        return None
+    return bounds
+
+
+def create_spatial_index(model):
+    """
+    Create the bbox side table of a resource model, if not existing.
+    """
+    if not is_enabled():
+        return
+    table_name = get_table_name(model)
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING rtree(id, min_x, max_x, min_y, max_y)'
+                       % table_name)
+    else:
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s (id integer PRIMARY KEY, bbox box NOT NULL)' % table_name)
+        # CREATE INDEX IF NOT EXISTS needs PostgreSQL 9.5
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', ['%s_gist' % table_name])
+        if cursor.fetchone() is None:
+            cursor.execute('CREATE INDEX %s_gist ON %s USING gist (bbox)' % (table_name, table_name))
+
+
+def set_bboxes(model, wkt_geometries):
+    """
+    Set the indexed bboxes of resources, given a dictionary of their WKT geometries by id.
+    Resources with a missing or invalid geometry are removed from the index.
+    """
+    if not is_enabled() or not wkt_geometries:
+        return
+    table_name = get_table_name(model)
+    rows = []
+    for resource_id, wkt in wkt_geometries.items():
+        bounds = get_wkt_bounds(wkt) if wkt else None
+        if bounds is not None:
+            minx, miny, maxx, maxy = bounds
+            if connection.vendor == 'sqlite':
+                rows.append((resource_id, minx, maxx, miny, maxy))
+            else:
+                rows.append((resource_id, minx, miny, maxx, maxy))
+    cursor = connection.cursor()
+    # the rtree virtual table does not support upserts, rows are replaced
+    ids = list(wkt_geometries.keys())
+    cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table_name, ', '.join(['%s'] * len(ids))), ids)
+    if not rows:
+        return
+    if connection.vendor == 'sqlite':
+        sql = 'INSERT INTO %s (id, min_x, max_x, min_y, max_y) VALUES (%%s, %%s, %%s, %%s, %%s)' % table_name
+    else:
+        sql = 'INSERT INTO %s (id, bbox) VALUES (%%s, box(point(%%s, %%s), point(%%s, %%s)))' % table_name
+    cursor.executemany(sql, rows)
+
+
+def remove_bboxes(model, ids):
+    if not is_enabled() or not ids:
+        return
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (get_table_name(model), ', '.join(['%s'] * len(ids))),
+                   list(ids))
+
+
+def rebuild_spatial_index(model, bulk_size=500):
+    """
+    Fill again the bbox side table of a resource model from all the resources geometries.
+    """
+    if not is_enabled():
+        return 0
+    create_spatial_index(model)
+    connection.cursor().execute('DELETE FROM %s' % get_table_name(model))
+    resources = model.objects.order_by('id').values_list('id', 'wkt_geometry')
+    count = 0
+    last_id = 0
+    while True:
+        chunk = list(resources.filter(id__gt=last_id)[:bulk_size])
+        if not chunk:
+            break
+        set_bboxes(model, dict(chunk))
+        count = count + len(chunk)
+        last_id = chunk[-1][0]
+    return count
+
+
+# conditions on the indexed bbox of a resource for a query bbox, by predicate,
+# exact as long as the resource geometries are rectangles
+SQLITE_PREDICATES = {
+    'intersects': 'min_x <= {maxx!r} AND max_x >= {minx!r} AND min_y <= {maxy!r} AND max_y >= {miny!r}',
+    'within': 'min_x >= {minx!r} AND max_x <= {maxx!r} AND min_y >= {miny!r} AND max_y <= {maxy!r}',
+    'contains': 'min_x <= {minx!r} AND max_x >= {maxx!r} AND min_y <= {miny!r} AND max_y >= {maxy!r}',
+    'equals': 'min_x = {minx!r} AND max_x = {maxx!r} AND min_y = {miny!r} AND max_y = {maxy!r}',
+}
+POSTGRESQL_PREDICATES = {
+    'intersects': 'bbox && box(point({minx!r}, {miny!r}), point({maxx!r}, {maxy!r}))',
+    'within': 'bbox <@ box(point({minx!r}, {miny!r}), point({maxx!r}, {maxy!r}))',
+    'contains': 'bbox @> box(point({minx!r}, {miny!r}), point({maxx!r}, {maxy!r}))',
+    'equals': 'bbox ~= box(point({minx!r}, {miny!r}), point({maxx!r}, {maxy!r}))',
+}
+PREDICATES = tuple(SQLITE_PREDICATES.keys())
+
+
+def get_bbox_subquery(model, bbox, predicate='intersects'):
+    """
+    Returns the SQL selecting from the spatial index the ids of the resources matching
+    a spatial predicate (see PREDICATES) with a (minx, miny, maxx, maxy) bbox.
+    """
+    minx, miny, maxx, maxy = [float(coord) for coord in bbox]
+    if not is_finite(bbox):
+        # the coordinates are written in the SQL
+        raise ValueError('Invalid bbox: %s' % (bbox, ))
+    if connection.vendor == 'sqlite':
+        condition = SQLITE_PREDICATES[predicate]
+    else:
+        condition = POSTGRESQL_PREDICATES[predicate]
+    condition = condition.format(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+    return 'SELECT id FROM %s WHERE %s' % (get_table_name(model), condition)
+
+
+def filter_by_bbox(queryset, bbox):
+    """
+    Filter a resource queryset to the resources intersecting a (minx, miny, maxx, maxy) bbox,
+    with a lookup of the spatial index.
+    Without spatial index, layers are filtered on their bbox fields, the other resources (services)
+    on the bounds of their geometry, scanning them.
+    """
+    minx, miny, maxx, maxy = [float(coord) for coord in bbox]
+    model = queryset.model
+    if not is_enabled():
+        if 'bbox_x0' in [field.name for field in model._meta.fields]:
+            return queryset.filter(bbox_x0__lte=maxx, bbox_x1__gte=minx, bbox_y0__lte=maxy, bbox_y1__gte=miny)
+        ids = []
+        for resource_id, wkt in queryset.values_list('id', 'wkt_geometry').iterator():
+            bounds = get_wkt_bounds(wkt) if wkt else None
+            if bounds and bounds[0] <= maxx and bounds[2] >= minx and bounds[1] <= maxy and bounds[3] >= miny:
+                ids.append(resource_id)
+        return queryset.filter(id__in=ids)
+    return queryset.extra(where=['%s.id IN (%s)' % (model._meta.db_table, get_bbox_subquery(model, bbox))])
+
+
+def parse_bbox(value):
+    """
+    Parse a 'minx,miny,maxx,maxy' string, returns None if it is not a valid bbox.
+    """
+    try:
+        bbox = [float(coord) for coord in value.split(',')]
+    except ValueError:
+        return None
+    if len(bbox) != 4 or not is_finite(bbox):
+        return None
+    return bbox
+
+
+def is_finite(bbox):
+    return not any(math.isinf(float(coord)) or math.isnan(float(coord)) for coord in bbox)
@@ -4,73 +4,90 @@ from django.conf import settings
 
 from celery import shared_task
 
+from hypermap.aggregator import budgets
+from hypermap.aggregator.dedup import DeduplicatedTask
+from hypermap.aggregator.enums import LONLAT_SERVICE_TYPES
+from hypermap.aggregator.progress import ProgressReporter, child_done
 
-@shared_task(bind=True)
+
+def get_queue_options(task):
+    """
+    Returns the options to queue the children of a task: the children of a task queued explicitly on
+    another queue than its route (i.e. the interactive queue, from the pages) follow it there.
+    """
+    delivery_info = task.request.delivery_info or {}
+    queue = delivery_info.get('routing_key')
+    if queue and queue != settings.CELERY_ROUTES.get(task.name, {}).get('queue', settings.CELERY_DEFAULT_QUEUE):
+        return {'queue': queue}
+    return {}
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
 def check_all_services(self):
     from hypermap.aggregator.models import Service
     service_to_processes = Service.objects.filter(active=True)
     total = service_to_processes.count()
+    progress = ProgressReporter(self, total)
     count = 0
     for service in service_to_processes:
-        # update state
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
-        check_service.delay(service)
+        check_service.delay(service, progress_id=progress.task_id)
         count = count + 1
+        progress.update(count, children=1)
+    progress.report()
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def check_service(self, service, progress_id=None):
+    try:
+        # total is determined (and updated) exactly after service.update_layers
+        progress = ProgressReporter(self, 100)
+        progress.update(0)
+        with budgets.operation('harvest'):
+            service.update_layers()
+        # we count 1 for update_layers and 1 for service check for simplicity
+        layer_to_process = service.layer_set.all()
+
+        if settings.DEBUG_SERVICES:
+            layer_to_process = layer_to_process[0:settings.DEBUG_LAYERS_NUMBER]
+
+        total = layer_to_process.count() + 2
+        progress.update(1, total)
+        with budgets.operation('check'):
+            service.check_available()
+        count = 2
+        progress.update(count)
 
-
-@shared_task(bind=True)
-def check_service(self, service):
-    # total is determined (and updated) exactly after service.update_layers
-    total = 100
-
-    def status_update(count):
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
-
-    status_update(0)
-    service.update_layers()
-    # we count 1 for update_layers and 1 for service check for simplicity
-    layer_to_process = service.layer_set.all()
-
-    if settings.DEBUG_SERVICES:
-        layer_to_process = layer_to_process[0:settings.DEBUG_LAYERS_NUMBER]
-
-    total = layer_to_process.count() + 2
-    status_update(1)
-    service.check_available()
-    status_update(2)
-    count = 3
-
-    if not settings.SKIP_CELERY_TASK:
-        for layer in layer_to_process:
-            # update state
-            status_update(count)
-            check_layer.delay(layer)
-            count += 1
-    else:
-        for layer in layer_to_process:
-            status_update(count)
-            check_layer(layer)
-            count += 1
+        if not settings.SKIP_CELERY_TASK:
+            queue_options = get_queue_options(self)
+            for layer in layer_to_process:
+                check_layer.apply_async((layer,), {'progress_id': progress.task_id}, **queue_options)
+                count += 1
+                progress.update(count, children=1)
+        else:
+            for layer in layer_to_process:
+                check_layer(layer)
+                count += 1
+                progress.update(count)
+        progress.report()
+    finally:
+        child_done(progress_id)
 
 
-@shared_task(bind=True, time_limit=10)
-def check_layer(self, layer):
+@shared_task(bind=True, base=DeduplicatedTask)
+def check_layer(self, layer, progress_id=None):
     print 'Checking layer %s' % layer.name
-    success, message = layer.check_available()
-    # every time a layer is checked it should be indexed
-    if success and settings.SEARCH_ENABLED:
+    try:
+        with budgets.operation('check'):
+            success, message = layer.check_available()
+    finally:
+        child_done(progress_id)
+    # thumbnails are generated on a slower cadence (see update_thumbnails), except the first one
+    if success and not layer.thumbnail:
         if not settings.SKIP_CELERY_TASK:
-            index_layer.delay(layer)
+            update_layer_thumbnail.delay(layer)
         else:
-            index_layer(layer)
+            update_layer_thumbnail(layer)
+    # every time a layer is checked it is indexed, check_available adds it to the index buffer
     if not success:
         from hypermap.aggregator.models import TaskError
         task_error = TaskError(
@@ -81,6 +98,48 @@ def check_layer(self, layer):
         task_error.save()
 
 
+@shared_task(bind=True, base=DeduplicatedTask)
+def update_layer_thumbnail(self, layer, force=False, progress_id=None):
+    """
+    Generate the thumbnail of a layer, skipped when its service and bbox did not change since the last one.
+    """
+    try:
+        with budgets.operation('thumbnail'):
+            layer.update_thumbnail(force=force)
+    except Exception as err:
+        from hypermap.aggregator.models import TaskError
+        task_error = TaskError(
+            task_name=self.name,
+            args=layer.id,
+            message=str(err)
+        )
+        task_error.save()
+    finally:
+        child_done(progress_id)
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def update_thumbnails(self, force=False):
+    """
+    Queue the generation of the thumbnails of all the active layers.
+    """
+    from hypermap.aggregator.models import Layer
+    layer_to_process = Layer.objects.filter(active=True).select_related('service')
+    total = layer_to_process.count()
+    progress = ProgressReporter(self, total)
+    count = 0
+    for layer in layer_to_process.iterator():
+        if not settings.SKIP_CELERY_TASK:
+            update_layer_thumbnail.delay(layer, force, progress_id=progress.task_id)
+            count = count + 1
+            progress.update(count, children=1)
+        else:
+            update_layer_thumbnail(layer, force)
+            count = count + 1
+            progress.update(count)
+    progress.report()
+
+
 @shared_task(name="clear_solr")
 def clear_solr():
     print 'Clearing the solr core and indexes'
@@ -102,58 +161,49 @@ def remove_service_checks(self, service):
 
     service.check_set.all().delete()
 
-    def status_update(count, total):
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
-
     layer_to_process = service.layer_set.all()
     count = 0
-    total = layer_to_process.count()
+    progress = ProgressReporter(self, layer_to_process.count())
     for layer in layer_to_process:
-        # update state
-        status_update(count, total)
         layer.check_set.all().delete()
         count = count + 1
+        progress.update(count)
+    progress.report()
 
 
-@shared_task(bind=True)
+@shared_task(bind=True, base=DeduplicatedTask)
 def index_service(self, service):
 
     layer_to_process = service.layer_set.all()
-    total = layer_to_process.count()
-
-    def status_update(count):
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
+    progress = ProgressReporter(self, layer_to_process.count())
 
     count = 0
     for layer in layer_to_process:
-        # update state
-        status_update(count)
         if not settings.SKIP_CELERY_TASK:
-            index_layer.delay(layer)
+            index_layer.delay(layer, progress_id=progress.task_id)
+            count = count + 1
+            progress.update(count, children=1)
         else:
             index_layer(layer)
-        count = count + 1
-
-
-@shared_task(bind=True)
-def index_layer(self, layer):
-    # TODO: Make this function more DRY
-    # by abstracting the common bits.
-    if settings.SEARCH_TYPE == 'solr':
-        from hypermap.aggregator.solr import SolrHypermap
-        print 'Syncing layer %s to solr' % layer.name
-        try:
-            solrobject = SolrHypermap()
-            success, message = solrobject.layer_to_solr(layer)
-            if not success:
+            count = count + 1
+            progress.update(count)
+    progress.report()
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def index_layer(self, layer, progress_id=None):
+    from hypermap.aggregator.indexing import get_layer_document, get_search_writers
+    print 'Syncing layer %s to %s' % (layer.name, settings.SEARCH_TYPE)
+    try:
+        document = get_layer_document(layer)
+    except Exception as err:
+        document = None
+        message = str(err)
+    try:
+        for writer in get_search_writers():
+            if document is not None:
+                success, message = writer.index_document(document)
+            if document is None or not success:
                 from hypermap.aggregator.models import TaskError
                 task_error = TaskError(
                     task_name=self.name,
@@ -161,25 +211,11 @@ def index_layer(self, layer):
                     message=message
                 )
                 task_error.save()
-        except:
-            print 'There was an exception here!'
-            self.retry(layer)
-    elif settings.SEARCH_TYPE == 'elasticsearch':
-        from hypermap.aggregator.elasticsearch_client import ESHypermap
-        print 'Syncing layer %s to es' % layer.name
-        esobject = ESHypermap()
-        success, message = esobject.layer_to_es(layer)
-        if not success:
-            from hypermap.aggregator.models import TaskError
-            task_error = TaskError(
-                task_name=self.name,
-                args=layer.id,
-                message=message
-            )
-            task_error.save()
+    finally:
+        child_done(progress_id)
 
 
-@shared_task(bind=True)
+@shared_task(bind=True, base=DeduplicatedTask)
 def index_all_layers(self):
     from hypermap.aggregator.models import Layer
 
@@ -187,50 +223,306 @@ def index_all_layers(self):
     #    clear_es()
 
     layer_to_processes = Layer.objects.all()
-    total = layer_to_processes.count()
+    progress = ProgressReporter(self, layer_to_processes.count())
     count = 0
     for layer in Layer.objects.all():
-        # update state
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
         if not settings.SKIP_CELERY_TASK:
-            index_layer.delay(layer)
+            index_layer.delay(layer, progress_id=progress.task_id)
+            count = count + 1
+            progress.update(count, children=1)
         else:
             index_layer(layer)
+            count = count + 1
+            progress.update(count)
+    progress.report()
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def rebuild_index(self):
+    """
+    Rebuild the search index in a new versioned solr collection (or es index), using bulk requests,
+    then atomically swap to it the alias searched by clients. Search keeps working during the rebuild.
+    The layers changed, checked or removed while the new collection is filled, which are written to the
+    previous one, are replayed on the new one before the swap, and once more after it. The previous
+    collections but the last SEARCH_KEEP_VERSIONS are deleted.
+    """
+    from django.utils import timezone
+    from hypermap.aggregator.models import Layer
+    from hypermap.aggregator.indexing import iter_layer_documents, get_search_writers
+
+    started_datetime = timezone.now()
+    layer_to_process = Layer.objects.filter(active=True)
+    progress = ProgressReporter(self, layer_to_process.count())
+
+    # the layers are read once from the database and sent to each backend
+    writers = [writer.create_versioned() for writer in get_search_writers()]
+    count = 0
+    for documents in iter_layer_documents(layer_to_process):
+        for writer in writers:
+            writer.index_documents(documents)
+        count = count + len(documents)
+        progress.update(count)
+    progress.report()
+    since = replay_index_changes(writers, started_datetime)
+    for writer in writers:
+        writer.commit()
+        writer.swap_alias()
+    # the changes written to the previous collection while swapping
+    replay_index_changes(writers, since)
+    for writer in writers:
+        writer.commit()
+        writer.prune_versioned(settings.SEARCH_KEEP_VERSIONS)
+
+
+def replay_index_changes(writers, since):
+    """
+    Index with the writers the layers changed or checked since a time, and remove the layers deactivated
+    or deleted since then. Returns the time the changes were read at, to replay the next ones from.
+    """
+    from django.db.models import Q
+    from django.utils import timezone
+    from hypermap.aggregator.models import Layer, RemovedLayer
+    from hypermap.aggregator.indexing import iter_layer_documents
+
+    replayed_datetime = timezone.now()
+    # filtered by id, so that the join on checks does not alter the check stats of the indexing queryset
+    layers_to_index = Layer.objects.filter(id__in=Layer.objects.filter(active=True).filter(
+        Q(last_updated__gte=since) | Q(check_set__checked_datetime__gte=since)
+    ).values('id'))
+    layer_ids_to_remove = list(Layer.objects.filter(active=False, last_updated__gte=since).values_list(
+        'id', flat=True))
+    # the rows are kept for the delta indexing of the alias
+    layer_ids_to_remove += list(RemovedLayer.objects.filter(removed_datetime__gte=since).values_list(
+        'layer_id', flat=True))
+    for documents in iter_layer_documents(layers_to_index):
+        for writer in writers:
+            writer.index_documents(documents)
+    for layer_id in layer_ids_to_remove:
+        for writer in writers:
+            writer.remove_layer(layer_id)
+    return replayed_datetime
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def flush_index_buffer(self):
+    """
+    Index in bulk the layers saved or checked since the last flush, each one once however many times it was
+    marked. Returns the number of layers indexed.
+    """
+    from hypermap.aggregator.models import Layer
+    from hypermap.aggregator.indexing import (iter_layer_documents, get_search_writers, mark_layers_dirty,
+                                              take_dirty_layer_ids)
+
+    if not settings.SEARCH_ENABLED:
+        return 0
+
+    writers = get_search_writers()
+    count = 0
+    while True:
+        layer_ids = take_dirty_layer_ids()
+        if not layer_ids:
+            break
+        try:
+            for documents in iter_layer_documents(Layer.objects.filter(id__in=layer_ids)):
+                for writer in writers:
+                    writer.index_documents(documents)
+        except Exception:
+            # back in the buffer for the next flush
+            mark_layers_dirty(layer_ids)
+            raise
+        count = count + len(layer_ids)
+    return count
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def unindex_layer(self, layer_id):
+    from hypermap.aggregator.indexing import get_search_writers
+    print 'Removing layer %s from %s' % (layer_id, settings.SEARCH_TYPE)
+    removed = True
+    for writer in get_search_writers():
+        success, message = writer.remove_layer(layer_id)
+        if not success:
+            from hypermap.aggregator.models import TaskError
+            task_error = TaskError(
+                task_name=self.name,
+                args=layer_id,
+                message=message
+            )
+            task_error.save()
+            removed = False
+    return removed
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def index_delta_layers(self):
+    """
+    Index only the layers updated since the last delta run, and remove from the index the layers
+    deactivated or deleted in the meantime. The checked layers are indexed by flush_index_buffer.
+    If a layer cannot be removed, the run is not recorded, so that the next one starts again from
+    the previous run.
+    """
+    from django.utils import timezone
+    from hypermap.aggregator.models import Layer, IndexingRun, RemovedLayer
+    from hypermap.aggregator.indexing import iter_layer_documents, get_search_writers
+
+    if not settings.SEARCH_ENABLED:
+        return
+
+    started_datetime = timezone.now()
+    layers_to_index = Layer.objects.filter(active=True)
+    layers_to_remove = Layer.objects.filter(active=False)
+    last_run = IndexingRun.objects.order_by('-started_datetime').first()
+    if last_run:
+        since = last_run.started_datetime
+        layers_to_index = layers_to_index.filter(last_updated__gte=since)
+        layers_to_remove = layers_to_remove.filter(last_updated__gte=since)
+    removed_layers = list(RemovedLayer.objects.filter(removed_datetime__lte=started_datetime))
+
+    layer_ids_to_remove = list(layers_to_remove.values_list('id', flat=True))
+    layer_ids_to_remove += [removed_layer.layer_id for removed_layer in removed_layers]
+    total = layers_to_index.count() + len(layer_ids_to_remove)
+    progress = ProgressReporter(self, total)
+    count = 0
+
+    writers = get_search_writers()
+    for documents in iter_layer_documents(layers_to_index):
+        for writer in writers:
+            writer.index_documents(documents)
+        count = count + len(documents)
+        progress.update(count)
+    failed_layer_ids = set()
+    for layer_id in layer_ids_to_remove:
+        if not unindex_layer(layer_id):
+            failed_layer_ids.add(layer_id)
         count = count + 1
+        progress.update(count)
+    progress.report()
+    # the removals which failed are retried at the next run
+    RemovedLayer.objects.filter(id__in=[
+        removed_layer.id for removed_layer in removed_layers if removed_layer.layer_id not in failed_layer_ids
+    ]).delete()
+    if failed_layer_ids:
+        print 'Delta indexing not recorded, %s layers could not be removed' % len(failed_layer_ids)
+        return
+
+    IndexingRun.objects.create(
+        started_datetime=started_datetime,
+        indexed=total - len(layer_ids_to_remove),
+        removed=len(layer_ids_to_remove)
+    )
 
 
 @shared_task(bind=True)
-def update_endpoint(self, endpoint):
+def repair_layers_bboxes(self, dry_run=False):
+    """
+    Check the lon/lat bboxes of all the layers in one pass, and save the repaired ones: flipped, out of
+    range and mercator encoded bboxes are fixed, bboxes with an infinite or huge coordinate are cleared.
+    Only the layers of the service types harvested with lon/lat bboxes are checked, the ESRI layers keep
+    the extents in the native srs of their service. Partial bboxes (missing coordinates) are only counted
+    as invalid, they are left to the next harvest.
+    Returns the number of layers flagged for each problem.
+    """
+    import numpy
+    from decimal import Decimal
+    from django.db import transaction
+    from django.utils import timezone
+    from hypermap.aggregator.models import Layer, bbox2wktpolygon, set_metadata_record_bbox
+    from hypermap.aggregator.utils import repair_bboxes
+    from hypermap.aggregator import caching, fulltext, spatial
+
+    rows = list(Layer.objects.filter(service__type__in=LONLAT_SERVICE_TYPES).values_list(
+        'id', 'bbox_x0', 'bbox_y0', 'bbox_x1', 'bbox_y1'))
+    if not rows:
+        return {}
+    layer_ids = numpy.array([row[0] for row in rows])
+    bboxes = numpy.array([
+        [numpy.nan if coord is None else coord for coord in row[1:]] for row in rows
+    ], dtype=float)
+    repaired, flags = repair_bboxes(bboxes)
+
+    # bboxes with a missing coordinate are invalid, but are not cleared
+    partial = numpy.isnan(bboxes).any(axis=1)
+    missing = numpy.isnan(bboxes).all(axis=1)
+    to_write = ~partial & (flags['invalid'] | flags['mercator'] | flags['flipped'] | flags['out_of_range'])
+    stats = dict((flag, int(values.sum())) for flag, values in flags.items())
+    stats['invalid'] = int((flags['invalid'] & ~missing).sum())
+    stats['repaired'] = int(to_write.sum())
+    if dry_run:
+        return stats
+
+    def to_decimal(value):
+        if numpy.isnan(value):
+            return None
+        return Decimal('%.10f' % value)
+
+    default_wkt_geometry = Layer._meta.get_field('wkt_geometry').get_default()
+    bulk_size = 500
+    indices = numpy.flatnonzero(to_write)
+    progress = ProgressReporter(self, len(indices))
+    for start in range(0, len(indices), bulk_size):
+        progress.update(start)
+        chunk = dict((int(layer_ids[i]), repaired[i]) for i in indices[start:start + bulk_size])
+        layers = Layer.objects.filter(id__in=chunk.keys()).only('id', 'anytext', 'xml', 'xml_hash')
+        now = timezone.now()
+        wkt_geometries = {}
+        anytexts = {}
+        with transaction.atomic():
+            for layer in layers:
+                bbox = chunk[layer.id]
+                layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1 = [to_decimal(coord) for coord in bbox]
+                if numpy.isnan(bbox).any():
+                    layer.wkt_geometry = default_wkt_geometry
+                else:
+                    layer.wkt_geometry = bbox2wktpolygon(bbox)
+                set_metadata_record_bbox(layer)
+                # saved without the post_save signals, which would check each layer again:
+                # the spatial and full-text indexes are refreshed in bulk below, and
+                # last_updated is set for the delta indexing
+                Layer.objects.filter(id=layer.id).update(
+                    bbox_x0=layer.bbox_x0, bbox_y0=layer.bbox_y0, bbox_x1=layer.bbox_x1, bbox_y1=layer.bbox_y1,
+                    wkt_geometry=layer.wkt_geometry, xml=layer.xml, xml_hash=layer.xml_hash, last_updated=now)
+                wkt_geometries[layer.id] = layer.wkt_geometry
+                anytexts[layer.id] = layer.anytext
+            spatial.set_bboxes(Layer, wkt_geometries)
+            fulltext.set_texts(Layer, anytexts)
+    progress.update(len(indices))
+    progress.report()
+    if len(indices):
+        caching.increment_generation()
+    return stats
+
+
+@shared_task(bind=True, base=DeduplicatedTask)
+def update_endpoint(self, endpoint, progress_id=None):
     from hypermap.aggregator.utils import create_services_from_endpoint
     print 'Processing endpoint with id %s: %s' % (endpoint.id, endpoint.url)
-    imported, message = create_services_from_endpoint(endpoint.url)
-    endpoint.imported = imported
-    endpoint.message = message
-    endpoint.processed = True
-    endpoint.save()
+    try:
+        with budgets.operation('harvest'):
+            imported, message = create_services_from_endpoint(endpoint.url)
+        endpoint.imported = imported
+        endpoint.message = message
+        endpoint.processed = True
+        endpoint.save()
+    finally:
+        child_done(progress_id)
 
 
 @shared_task(bind=True)
 def update_endpoints(self, endpoint_list):
     # for now we process the enpoint even if they were already processed
     endpoint_to_process = endpoint_list.endpoint_set.filter(processed=False)
-    total = endpoint_to_process.count()
+    progress = ProgressReporter(self, endpoint_to_process.count())
     count = 0
     if not settings.SKIP_CELERY_TASK:
         for endpoint in endpoint_to_process:
-            update_endpoint.delay(endpoint)
-        # update state
-        if not self.request.called_directly:
-            self.update_state(
-                state='PROGRESS',
-                meta={'current': count, 'total': total}
-            )
+            update_endpoint.delay(endpoint, progress_id=progress.task_id)
+            count = count + 1
+            progress.update(count, children=1)
     else:
         for endpoint in endpoint_to_process:
             update_endpoint(endpoint)
+            count = count + 1
+            progress.update(count)
+    progress.report()
 
     return True
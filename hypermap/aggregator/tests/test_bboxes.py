@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the bbox checks and repairs.
+"""
+
+import numpy
+
+from django.test import TestCase
+from django.db.models import signals
+
+from hypermap.aggregator.models import Service, Layer, SpatialReferenceSystem
+from hypermap.aggregator.models import layer_post_save, service_post_save
+from hypermap.aggregator.models import bbox2wktpolygon, create_metadata_record
+from hypermap.aggregator.tasks import repair_layers_bboxes
+from hypermap.aggregator.utils import repair_bboxes
+
+
+class BboxesTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def test_repair_bboxes(self):
+        bboxes = [
+            [-10, -20, 10, 20],
+            [10, 20, -10, -20],
+            [-190, -20, 10, 95],
+            [numpy.nan, -20, 10, 20],
+            [-10, -20, 1e10, 20],
+            [-1113194.9, -1118889.97, 1113194.9, 1118889.97],
+            [-170, -20, 170, 20],
+        ]
+        repaired, flags = repair_bboxes(bboxes, mercator=[False] * 6 + [True])
+        self.assertEqual(flags['flipped'].tolist(), [False, True, False, False, False, False, False])
+        self.assertEqual(flags['out_of_range'].tolist(), [False, False, True, False, False, False, False])
+        self.assertEqual(flags['invalid'].tolist(), [False, False, False, True, True, False, False])
+        self.assertEqual(flags['mercator'].tolist(), [False, False, False, False, False, True, False])
+        self.assertEqual(repaired[0].tolist(), [-10, -20, 10, 20])
+        self.assertEqual(repaired[1].tolist(), [-10, -20, 10, 20])
+        self.assertEqual(repaired[2].tolist(), [-180, -20, 10, 90])
+        self.assertTrue(numpy.isnan(repaired[3]).all())
+        self.assertTrue(numpy.isnan(repaired[4]).all())
+        numpy.testing.assert_allclose(repaired[5], [-10, -10, 10, 10], atol=1e-6)
+        # a lon/lat bbox of a mercator service is not converted
+        self.assertEqual(repaired[6].tolist(), [-170, -20, 170, 20])
+
+    def test_repair_layers_bboxes(self):
+        service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        esri_service = Service.objects.create(
+            url='http://fakeurl.com/arcgis', title='Title', type='ESRI:ArcGIS:MapServer')
+        esri_service.srs.add(SpatialReferenceSystem.objects.create(code='102100'))
+        coords = (
+            (service, (-10, -20, 10, 20)),
+            (service, (10, 20, -10, -20)),
+            (service, (None, 0, 10, 10)),
+            (service, (None, None, None, None)),
+            (service, (-1113194.9, -1118889.97, 1113194.9, 1118889.97)),
+            (esri_service, (-1113194.9, -1118889.97, 1113194.9, 1118889.97)),
+        )
+        for s, (x0, y0, x1, y1) in coords:
+            Layer.objects.create(service=s, bbox_x0=x0, bbox_y0=y0, bbox_x1=x1, bbox_y1=y1)
+        flipped_layer = Layer.objects.order_by('id')[1]
+        flipped_layer.wkt_geometry = bbox2wktpolygon((10, 20, -10, -20))
+        flipped_layer.xml = create_metadata_record(
+            identifier=flipped_layer.id_string, source=service.url, links=[], format='OGC:WMS',
+            type='dataset', title='Title', abstract='', wkt_geometry=flipped_layer.wkt_geometry)
+        flipped_layer.save()
+        last_updated = Layer.objects.order_by('id')[0].last_updated
+
+        stats = repair_layers_bboxes(dry_run=True)
+        self.assertEqual(stats['repaired'], 2)
+        self.assertEqual(Layer.objects.order_by('id')[1].bbox_x0, 10)
+
+        stats = repair_layers_bboxes()
+        self.assertEqual(stats, {'repaired': 2, 'invalid': 1, 'flipped': 1, 'mercator': 1, 'out_of_range': 0})
+        layers = Layer.objects.order_by('id')
+        coords = [[layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1] for layer in layers]
+        self.assertEqual(coords[0], [-10, -20, 10, 20])
+        self.assertEqual(coords[1], [-10, -20, 10, 20])
+        # partial bboxes are left to the next harvest
+        self.assertEqual(coords[2], [None, 0, 10, 10])
+        self.assertEqual(coords[3], [None, None, None, None])
+        numpy.testing.assert_allclose([float(coord) for coord in coords[4]], [-10, -10, 10, 10], atol=1e-6)
+        # ESRI layers keep the extents in the srs of their service
+        self.assertAlmostEqual(float(coords[5][0]), -1113194.9)
+        # the geometry and the csw:Record of a repaired layer are refreshed too
+        self.assertEqual(layers[1].wkt_geometry, bbox2wktpolygon((-10, -20, 10, 20)))
+        self.assertIn('-20.0 -10.0</ows:LowerCorner>', layers[1].xml)
+        self.assertIsNone(layers[1].xml_hash)
+        # the untouched layer is not updated, repaired ones are for the delta indexing
+        self.assertEqual(layers[0].last_updated, last_updated)
+        self.assertGreater(layers[1].last_updated, last_updated)
+
+        # a second sweep has nothing to repair
+        self.assertEqual(repair_layers_bboxes()['repaired'], 0)
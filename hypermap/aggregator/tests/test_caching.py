@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the shared cache and the generation of the catalogue.
+"""
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.db.models import signals
+
+from hypermap.aggregator import caching
+from hypermap.aggregator.models import Service, Layer
+from hypermap.aggregator.models import layer_post_save, service_post_save
+
+
+class CachingTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        caching.get_shared_cache().clear()
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+        caching._shared_cache['checked'] = 0
+
+    def test_generation(self):
+        generation = caching.get_generation()
+        self.assertEqual(caching.get_generation(), generation)
+        service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        layer = Layer.objects.create(service=service, title='Layer')
+        self.assertEqual(caching.get_generation(), generation + 2)
+        layer.delete()
+        self.assertEqual(caching.get_generation(), generation + 3)
+
+    def test_fallback(self):
+        self.assertIs(caching.get_shared_cache(), caches['default'])
+        available = caching.is_available
+        caching.is_available = lambda cache: False
+        caching._shared_cache['checked'] = 0
+        try:
+            self.assertIs(caching.get_shared_cache(), caches['local'])
+        finally:
+            caching.is_available = available
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the deduplication of the tasks.
+"""
+
+from celery.app.task import Context
+from celery.signals import task_revoked
+
+from django.conf import settings
+from django.test import TestCase
+
+from hypermap import celeryapp
+from hypermap.aggregator import caching
+from hypermap.aggregator.tasks import check_service, get_queue_options, unindex_layer
+
+
+class DedupTestCase(TestCase):
+
+    def setUp(self):
+        caching.get_shared_cache().clear()
+        celeryapp.app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        celeryapp.app.conf.CELERY_ALWAYS_EAGER = False
+
+    def test_dedup(self):
+        cache = caching.get_shared_cache()
+        key = unindex_layer.get_lock_key((1,))
+        # the same task queued for the same layer is dropped
+        cache.add(key, 'queued-task-id')
+        result = unindex_layer.delay(1)
+        self.assertEqual(result.id, 'queued-task-id')
+        # the lock is released when the task returns
+        cache.delete(key)
+        result = unindex_layer.delay(1)
+        self.assertNotEqual(result.id, 'queued-task-id')
+        self.assertIsNone(cache.get(key))
+
+    def test_interactive_queue(self):
+        cache = caching.get_shared_cache()
+        key = unindex_layer.get_lock_key((1,))
+        # a task queued from a page takes the lock over instead of being dropped
+        cache.add(key, 'queued-task-id')
+        result = unindex_layer.apply_async((1,), queue=settings.INTERACTIVE_QUEUE)
+        self.assertNotEqual(result.id, 'queued-task-id')
+        self.assertIsNone(cache.get(key))
+
+    def test_revoked(self):
+        cache = caching.get_shared_cache()
+        key = unindex_layer.get_lock_key((1,))
+        cache.add(key, 'queued-task-id')
+        task_revoked.send(sender=unindex_layer, request=Context(id='other-task-id', args=[1]))
+        self.assertEqual(cache.get(key), 'queued-task-id')
+        task_revoked.send(sender=unindex_layer, request=Context(id='queued-task-id', args=[1]))
+        self.assertIsNone(cache.get(key))
+
+    def test_queue_options(self):
+        # the children of a task queued from a page follow it on the interactive queue
+        check_service.push_request(delivery_info={'routing_key': settings.INTERACTIVE_QUEUE})
+        try:
+            self.assertEqual(get_queue_options(check_service), {'queue': settings.INTERACTIVE_QUEUE})
+        finally:
+            check_service.pop_request()
+        check_service.push_request(delivery_info={'routing_key': 'harvest'})
+        try:
+            self.assertEqual(get_queue_options(check_service), {})
+        finally:
+            check_service.pop_request()
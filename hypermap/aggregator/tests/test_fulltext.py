@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the full-text index of the resource anytext.
+"""
+
+from django.test import TestCase
+from django.db.models import signals
+
+from hypermap.aggregator import fulltext
+from hypermap.aggregator.models import Service, Layer
+from hypermap.aggregator.models import layer_post_save, service_post_save
+
+
+class FulltextIndexTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        for anytext in ('Fresh water wells', 'Rivers and lakes'):
+            Layer.objects.create(service=service, anytext=anytext)
+        self.layers = list(Layer.objects.order_by('id'))
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def search(self, text):
+        return sorted(fulltext.filter_by_text(Layer.objects.all(), text).values_list('id', flat=True))
+
+    def test_filter_by_text(self):
+        if not fulltext.is_enabled():
+            return
+        self.assertEqual(self.search('wat'), [self.layers[0].id])
+        self.assertEqual(self.search('WATER wells'), [self.layers[0].id])
+        self.assertEqual(self.search('water lakes'), [])
+        # words are matched by prefix, not as substrings
+        self.assertEqual(self.search('ater'), [])
+
+    def test_filter_without_fts5(self):
+        # SQLite builds without fts5 fall back to the LIKE scan, matching substrings
+        fulltext._available['default'] = False
+        try:
+            self.assertFalse(fulltext.is_enabled())
+            self.assertEqual(self.search('ater'), [self.layers[0].id])
+            self.assertEqual(self.search('rivers lakes'), [self.layers[1].id])
+        finally:
+            del fulltext._available['default']
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the central HTTP client.
+"""
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from httmock import with_httmock, urlmatch
+
+from hypermap.aggregator import httpclient
+
+
+@urlmatch(netloc=r'example\.com')
+def example_mock(url, request):
+    return {'status_code': 200, 'content': 'ok'}
+
+
+class HttpClientTestCase(TestCase):
+
+    def tearDown(self):
+        httpclient.reset_session()
+
+    def test_session(self):
+        session = httpclient.get_session()
+        self.assertIs(httpclient.get_session(), session)
+        # a forked process creates its own session
+        httpclient._session['pid'] = None
+        self.assertIsNot(httpclient.get_session(), session)
+
+    @override_settings(HTTP_POOL_SIZE=3, HTTP_POOL_SIZES={'solr.example.com:8983': 12})
+    def test_pool_sizes(self):
+        httpclient.reset_session()
+        session = httpclient.get_session()
+        self.assertEqual(session.get_adapter('http://solr.example.com:8983/solr/update')._pool_maxsize, 12)
+        self.assertEqual(session.get_adapter('http://example.com/wms')._pool_maxsize, 3)
+
+    @with_httmock(example_mock)
+    def test_get(self):
+        self.assertEqual(httpclient.get('http://example.com/wms').content, 'ok')
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the search indexing tasks.
+"""
+
+import json
+
+from django.test import TestCase
+from httmock import HTTMock, urlmatch
+from django.utils import timezone
+from django.test.utils import override_settings
+from django.db.models import signals
+
+from hypermap.aggregator import indexing
+from hypermap.aggregator.models import Service, Layer, LayerDate, Check, IndexingRun, RemovedLayer, DirtyLayer
+from hypermap.aggregator.models import SpatialReferenceSystem
+from hypermap.aggregator.models import layer_post_save, service_post_save
+from hypermap.aggregator.tasks import index_delta_layers, index_layer, rebuild_index, flush_index_buffer
+from hypermap.aggregator.tasks import replay_index_changes
+
+
+class DummyWriter(object):
+    """
+    A search writer keeping the documents in memory.
+    """
+    documents = {}
+
+    def __init__(self, url=None):
+        self.url = url
+
+    def index_document(self, document):
+        DummyWriter.documents[document['id']] = document
+        return True, None
+
+    def index_documents(self, documents, commit=False):
+        for document in documents:
+            self.index_document(document)
+        return len(documents)
+
+    def remove_layer(self, layer_id):
+        DummyWriter.documents.pop(layer_id, None)
+        return True, None
+
+    def create_versioned(self):
+        DummyWriter.documents = {}
+        return self
+
+    def commit(self):
+        pass
+
+    def swap_alias(self):
+        return []
+
+    def prune_versioned(self, keep):
+        return []
+
+
+@override_settings(SEARCH_ENABLED=True, SEARCH_TYPE='dummy')
+class IndexingTestCase(TestCase):
+
+    def setUp(self):
+        indexing.SEARCH_WRITERS['dummy'] = 'hypermap.aggregator.tests.test_indexing.DummyWriter'
+        DummyWriter.documents = {}
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        service = Service(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        service.save()
+        for l in range(0, 3):
+            layer = Layer(name='Layer %s' % l, service=service)
+            layer.save()
+
+    def tearDown(self):
+        del indexing.SEARCH_WRITERS['dummy']
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def test_layer_document(self):
+        layer = Layer.objects.all().order_by('id')[0]
+        # flipped coordinates are swapped and clamped to the world extent
+        layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1 = 10, 95, -10, -20
+        layer.save()
+        index_layer(layer)
+        document = DummyWriter.documents[layer.id]
+        self.assertEqual(document['originator'], 'fakeurl.com')
+        self.assertEqual(document['bbox']['min_x'], -10)
+        self.assertEqual(document['bbox']['max_x'], 10)
+        self.assertEqual(document['bbox']['min_y'], -20)
+        self.assertEqual(document['bbox']['max_y'], 90)
+        self.assertEqual(document['bbox']['area'], 20 * 110)
+        # layers without coordinates are indexed without a bbox
+        layer = Layer.objects.all().order_by('id')[1]
+        index_layer(layer)
+        self.assertIsNone(DummyWriter.documents[layer.id]['bbox'])
+
+    def test_mercator_layer_document(self):
+        layer = Layer.objects.all().order_by('id')[0]
+        srs = SpatialReferenceSystem.objects.create(code='102100')
+        layer.service.srs.add(srs)
+        layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1 = -20037508.34, 0, 20037508.34, 1000000
+        layer.save()
+        document = indexing.get_layer_document(layer)
+        self.assertAlmostEqual(document['bbox']['min_x'], -180)
+        self.assertAlmostEqual(document['bbox']['max_x'], 180)
+        self.assertEqual(document['srs'], ['102100'])
+
+    def test_rebuild_index(self):
+        rebuild_index()
+        self.assertEqual(len(DummyWriter.documents), 3)
+
+    def test_replay_index_changes(self):
+        layers = list(Layer.objects.all().order_by('id'))
+        writer = DummyWriter()
+        writer.index_documents([indexing.get_layer_document(layer) for layer in layers[1:]])
+        since = timezone.now()
+        # the changes made while the new collection is filled
+        Check(content_object=layers[0], success=True, response_time=0.1).save()
+        layers[1].active = False
+        layers[1].save()
+        layers[2].delete()
+        replayed_datetime = replay_index_changes([writer], since)
+        self.assertEqual(DummyWriter.documents.keys(), [layers[0].id])
+        self.assertGreaterEqual(replayed_datetime, since)
+        # the removals are kept for the delta indexing
+        self.assertEqual(RemovedLayer.objects.count(), 1)
+
+    def test_flush_index_buffer(self):
+        layer_ids = list(Layer.objects.values_list('id', flat=True))
+        indexing.mark_layers_dirty(layer_ids)
+        # marked again before the flush, indexed once
+        indexing.mark_layers_dirty(layer_ids[:1])
+        self.assertEqual(DirtyLayer.objects.count(), 3)
+        with self.settings(SEARCH_BULK_SIZE=2):
+            self.assertEqual(flush_index_buffer(), 3)
+        self.assertEqual(len(DummyWriter.documents), 3)
+        self.assertEqual(DirtyLayer.objects.count(), 0)
+        self.assertEqual(flush_index_buffer(), 0)
+
+    def test_take_dirty_layer_ids_late_commit(self):
+        DirtyLayer.objects.create(id=10, layer_id=1)
+        DirtyLayer.objects.create(id=20, layer_id=2)
+        order_by = DirtyLayer.objects.order_by
+
+        class LateCommit(object):
+            """
+            Reads the buffer, then commits a row with a lower id than the last one read.
+            """
+            def values_list(self, *fields):
+                self.fields = fields
+                return self
+
+            def __getitem__(self, key):
+                rows = list(order_by('id').values_list(*self.fields)[key])
+                DirtyLayer.objects.create(id=15, layer_id=3)
+                return rows
+
+        DirtyLayer.objects.order_by = lambda *fields: LateCommit()
+        try:
+            self.assertEqual(indexing.take_dirty_layer_ids(), [1, 2])
+        finally:
+            del DirtyLayer.objects.order_by
+        # the row committed late is left for the next flush
+        self.assertEqual(indexing.take_dirty_layer_ids(), [3])
+
+    def test_index_delta_layers(self):
+        # first run indexes everything
+        index_delta_layers()
+        self.assertEqual(IndexingRun.objects.latest('started_datetime').indexed, 3)
+        self.assertEqual(len(DummyWriter.documents), 3)
+
+        # nothing changed
+        index_delta_layers()
+        self.assertEqual(IndexingRun.objects.latest('started_datetime').indexed, 0)
+
+        # a check, a deactivation and a removal
+        layers = list(Layer.objects.all().order_by('id'))
+        Check(content_object=layers[0], success=True, response_time=0.1).save()
+        layers[1].active = False
+        layers[1].save()
+        layers[2].delete()
+        self.assertEqual(RemovedLayer.objects.count(), 1)
+        index_delta_layers()
+        run = IndexingRun.objects.latest('started_datetime')
+        # checked layers are indexed by flush_index_buffer
+        self.assertEqual(run.indexed, 0)
+        self.assertEqual(run.removed, 2)
+        self.assertEqual(RemovedLayer.objects.count(), 0)
+        self.assertEqual(DummyWriter.documents.keys(), [layers[0].id])
+
+    def test_index_delta_layers_removal_failed(self):
+        index_delta_layers()
+        last_run = IndexingRun.objects.latest('started_datetime')
+        layer_ids = list(Layer.objects.order_by('id').values_list('id', flat=True))
+        Layer.objects.get(id=layer_ids[1]).delete()
+        Layer.objects.get(id=layer_ids[2]).delete()
+        remove_layer = DummyWriter.remove_layer
+        DummyWriter.remove_layer = lambda writer, layer_id: (
+            remove_layer(writer, layer_id) if layer_id != layer_ids[2] else (False, 'Connection refused'))
+        try:
+            index_delta_layers()
+        finally:
+            DummyWriter.remove_layer = remove_layer
+        # the run is not recorded, and the failed removal is kept for the next one
+        self.assertEqual(IndexingRun.objects.latest('started_datetime'), last_run)
+        self.assertEqual(list(RemovedLayer.objects.values_list('layer_id', flat=True)), [layer_ids[2]])
+        index_delta_layers()
+        self.assertEqual(RemovedLayer.objects.count(), 0)
+        self.assertEqual(DummyWriter.documents.keys(), [layer_ids[0]])
+
+    @override_settings(SEARCH_TYPE='solr', SEARCH_URL='http://solr.example.com/solr/search')
+    def test_index_delta_layers_solr_error(self):
+        @urlmatch(netloc=r'solr\.example\.com')
+        def solr_mock(url, request):
+            if 'delete' in json.loads(request.body):
+                return {'status_code': 500, 'content': 'Internal Server Error'}
+            return {'status_code': 200, 'content': '{}'}
+
+        with HTTMock(solr_mock):
+            index_delta_layers()
+            last_run = IndexingRun.objects.latest('started_datetime')
+            layer = Layer.objects.all()[0]
+            layer_id = layer.id
+            layer.delete()
+            index_delta_layers()
+        # the removal failed on the solr side, it is kept for the next run
+        self.assertEqual(IndexingRun.objects.latest('started_datetime'), last_run)
+        self.assertEqual(list(RemovedLayer.objects.values_list('layer_id', flat=True)), [layer_id])
+
+    @override_settings(SEARCH_BULK_SIZE=500)
+    def test_indexing_queries(self):
+        service = Service.objects.get()
+        service.srs.add(SpatialReferenceSystem.objects.create(code='4326'))
+        Layer.objects.bulk_create([Layer(name='Bulk %s' % l, service=service) for l in range(0, 997)])
+        layers = list(Layer.objects.all().order_by('id'))
+        self.assertEqual(len(layers), 1000)
+        for success in (True, False, True):
+            Check(content_object=layers[0], success=success, response_time=0.1).save()
+        Check(content_object=service, success=False, response_time=0.1).save()
+        LayerDate.objects.create(layer=layers[0], date='1900-01-01', type=0)
+        LayerDate.objects.create(layer=layers[0], date='1850-01-01', type=1)
+
+        # 1000 layers in 2 chunks: layers, srs, dates, catalogs and recent checks for each chunk,
+        # then the empty chunk ending the iteration
+        with self.assertNumQueries(11):
+            documents = [document for chunk in indexing.iter_layer_documents() for document in chunk]
+        self.assertEqual(len(documents), 1000)
+        self.assertEqual(documents[0]['srs'], ['4326'])
+        self.assertEqual(documents[0]['date'], '1850-01-01T00:00:00Z')
+        # the stats match the ones computed by the layer
+        for document, layer in ((documents[0], layers[0]), (documents[1], layers[1])):
+            self.assertEqual(document['reliability'], layer.reliability)
+            self.assertEqual(document['recent_reliability'], layer.recent_reliability)
+            self.assertEqual(document['last_status'], layer.last_status)
+
+    def test_layers_bboxes(self):
+        service = Service.objects.get()
+        mercator_service = Service.objects.create(
+            url='http://fakeurl.com/arcgis', title='Title', type='ESRI:ArcGIS:MapServer')
+        mercator_service.srs.add(SpatialReferenceSystem.objects.create(code='102100'))
+        coords = (
+            (service, (10, 95, -10, -20)),
+            (service, (None, 0, 10, 10)),
+            (service, (float('nan'), 0, 10, 10)),
+            (service, (-200, -45.5, 200, 45.5)),
+            (mercator_service, (-20037508.34, 0, 20037508.34, 1000000)),
+            (mercator_service, (1000000, -1000000, -1000000, 2000000)),
+        )
+        layers = [
+            Layer(service=s, bbox_x0=x0, bbox_y0=y0, bbox_x1=x1, bbox_y1=y1) for s, (x0, y0, x1, y1) in coords
+        ]
+        bboxes = indexing.get_layers_bboxes(layers)
+        self.assertEqual(
+            [(bbox['min_x'], bbox['min_y'], bbox['max_x'], bbox['max_y']) for bbox in bboxes[0:4] if bbox],
+            [(-10, -20, 10, 90), (-180, -45.5, 180, 45.5)]
+        )
+        self.assertIsNone(bboxes[1])
+        self.assertIsNone(bboxes[2])
+        self.assertAlmostEqual(bboxes[4]['min_x'], -180)
+        self.assertAlmostEqual(bboxes[4]['max_y'], 8.9465739)
+        self.assertAlmostEqual(bboxes[5]['min_x'], -8.9831528)
+        self.assertAlmostEqual(bboxes[5]['min_y'], -8.9465739)
+        self.assertEqual(bboxes[0]['wkt'], 'ENVELOPE(-10.000000,10.000000,90.000000,-20.000000)')
+        # a single layer gives the same bbox
+        self.assertEqual(indexing.get_layer_bbox(layers[5]), bboxes[5])
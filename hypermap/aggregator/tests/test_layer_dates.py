@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the normalized layer dates.
+"""
+
+import datetime
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.db.models import signals
+
+from hypermap.aggregator.models import Service, Layer, LayerDate, LayerWM, get_normalized_date
+from hypermap.aggregator.models import layer_post_save, service_post_save
+from hypermap.aggregator.indexing import get_date
+
+
+class LayerDateTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        service = Service(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        service.save()
+        self.layer = Layer(name='Layer 1', service=service)
+        self.layer.save()
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def test_get_normalized_date(self):
+        normalized = get_normalized_date('1971-02-06')
+        self.assertEqual(normalized['parsed_date'], datetime.date(1971, 2, 6))
+        self.assertEqual(normalized['year'], 1971)
+        self.assertFalse(normalized['is_bc'])
+
+        normalized = get_normalized_date('0050-01-01')
+        self.assertEqual(normalized['parsed_date'], datetime.date(50, 1, 1))
+
+        normalized = get_normalized_date('-1900-01-01')
+        self.assertIsNone(normalized['parsed_date'])
+        self.assertEqual(normalized['year'], -1900)
+        self.assertTrue(normalized['is_bc'])
+
+        normalized = get_normalized_date('[-0200 TO 1200]')
+        self.assertEqual(normalized['range_start_year'], -200)
+        self.assertEqual(normalized['range_end_year'], 1200)
+        self.assertTrue(normalized['is_bc'])
+
+        normalized = get_normalized_date('not a date')
+        self.assertIsNone(normalized['parsed_date'])
+        self.assertIsNone(normalized['year'])
+
+    def test_layer_date_normalized_on_save(self):
+        layer_date = LayerDate(layer=self.layer, date='1855-01-01', type=0)
+        layer_date.save()
+        layer_date = LayerDate.objects.get(id=layer_date.id)
+        self.assertEqual(layer_date.parsed_date, datetime.date(1855, 1, 1))
+        self.assertEqual(layer_date.year, 1855)
+
+    def test_get_date(self):
+        self.layer.layerdate_set.create(date='1999-01-01', type=0)
+        self.layer.layerdate_set.create(date='1882-01-01', type=1)
+        self.layer.layerdate_set.create(date='-2000-01-01', type=0)
+        solr_date, date_type = get_date(self.layer)
+        self.assertEqual(solr_date, '1882-01-01T00:00:00Z')
+        self.assertEqual(date_type, 'From Metadata')
+        self.assertEqual(len(self.layer.get_layer_dates()), 2)
+
+    def test_get_date_layerwm(self):
+        self.layer.layerdate_set.create(date='1882-01-01', type=0)
+        LayerWM.objects.create(layer=self.layer, temporal_extent_start='1950-06-01', temporal_extent_end='1960')
+        layer = Layer.objects.select_related('layerwm').get(id=self.layer.id)
+        # the temporal extent of a WorldMap layer comes before its other dates
+        self.assertEqual(get_date(layer), ('1950-06-01T00:00:00Z', 'From Metadata'))
+
+    def test_normalize_layer_dates(self):
+        layer_date = self.layer.layerdate_set.create(date='1855-01-01', type=0)
+        # dates stored before the normalized fields
+        LayerDate.objects.filter(id=layer_date.id).update(parsed_date=None, year=None)
+        call_command('normalize_layer_dates')
+        layer_date = LayerDate.objects.get(id=layer_date.id)
+        self.assertEqual(layer_date.parsed_date, datetime.date(1855, 1, 1))
+        self.assertEqual(layer_date.year, 1855)
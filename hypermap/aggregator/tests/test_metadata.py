@@ -11,7 +11,7 @@ from lxml import etree
 
 from owslib.csw import CswRecord
 
-from hypermap.aggregator.models import gen_anytext, Layer, Service
+from hypermap.aggregator.models import gen_anytext, set_metadata_record, wkt2bbox, bbox2wktpolygon, Layer, Service
 import hypermap.aggregator.tests.mocks.wms
 import hypermap.aggregator.tests.mocks.warper
 import hypermap.aggregator.tests.mocks.worldmap
@@ -94,5 +94,27 @@ class TestMetadata(unittest.TestCase):
         anytext = gen_anytext(layer.title, layer.abstract, list(layer.keywords.names()))
         self.assertEqual(anytext, layer.anytext, 'Expected anytext equality')
 
+    def test_metadata_record(self):
+        """test the metadata record is generated again only when the metadata changes"""
+        layer = Layer.objects.filter(type='OGC:WMS').all()[0]
+        metadata = dict(identifier=layer.id_string, source=layer.url, links=[['OGC:WMS', layer.url]],
+                        format='OGC:WMS', type='dataset', title=layer.title, abstract=layer.abstract,
+                        wkt_geometry=bbox2wktpolygon([-10.5, -20, 30, 40.25]))
+        self.assertTrue(set_metadata_record(layer, **metadata))
+        xml = layer.xml
+        self.assertNotIn('\n', xml.strip(), 'Expected compact XML')
+        self.assertFalse(set_metadata_record(layer, **metadata))
+        self.assertEqual(layer.xml, xml)
+        metadata['title'] = 'Other title'
+        self.assertTrue(set_metadata_record(layer, **metadata))
+        self.assertEqual(CswRecord(etree.fromstring(layer.xml)).title, 'Other title')
+        self.assertEqual(CswRecord(etree.fromstring(layer.xml)).bbox.minx, '-10.5')
+
+    def test_wkt_bbox(self):
+        """test bounds of WKT polygons"""
+        self.assertEqual(wkt2bbox(bbox2wktpolygon([-10.5, -20, 30, 40.25])), (-10.5, -20, 30, 40.25))
+        self.assertEqual(wkt2bbox('POLYGON((-180 -90,-180 90,180 90,180 -90,-180 -90))'), (-180, -90, 180, 90))
+        self.assertEqual(wkt2bbox('POINT(1 2)'), (1, 2, 1, 2))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the lightweight availability probes of the layers.
+"""
+
+import json
+import socket
+
+import requests
+from django.test import TestCase
+from django.db.models import signals
+from httmock import HTTMock, with_httmock, urlmatch
+
+from hypermap.aggregator import budgets, httpclient, probes
+from hypermap.aggregator.models import Service, Layer
+from hypermap.aggregator.models import layer_post_save, service_post_save
+
+
+@urlmatch(netloc=r'wms\.example\.com')
+def wms_mock(url, request):
+    if 'LAYERS=layer' in url.query:
+        return {'status_code': 200, 'headers': {'content-type': 'image/png'}, 'content': 'png'}
+    return {'status_code': 200, 'headers': {'content-type': 'application/vnd.ogc.se_xml'},
+            'content': '<ServiceExceptionReport><ServiceException>LayerNotDefined</ServiceException>'
+                       '</ServiceExceptionReport>'}
+
+
+@urlmatch(netloc=r'esri\.example\.com')
+def esri_mock(url, request):
+    if url.path.endswith('/MapServer'):
+        return {'status_code': 200, 'content': json.dumps({'layers': [{'id': 0, 'name': 'Roads'}]})}
+    return {'status_code': 200, 'content': json.dumps({'error': {'code': 500}})}
+
+
+WMTS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Tiles</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:ServiceProvider><ows:ProviderName>Example</ows:ProviderName></ows:ServiceProvider>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetTile">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="http://wmts.example.com/wmts?">
+        <ows:Constraint name="GetEncoding">
+          <ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues>
+        </ows:Constraint>
+      </ows:Get></ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>
+    <Layer>
+      <ows:Title>Roads</ows:Title>
+      <ows:Identifier>roads</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/png</Format>
+      <TileMatrixSetLink><TileMatrixSet>EPSG:4326</TileMatrixSet></TileMatrixSetLink>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:4326</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::4326</ows:SupportedCRS>
+      <TileMatrix>
+        <ows:Identifier>EPSG:4326:1</ows:Identifier>
+        <ScaleDenominator>139770566.0</ScaleDenominator>
+        <TopLeftCorner>90.0 -180.0</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>4</MatrixWidth><MatrixHeight>2</MatrixHeight>
+      </TileMatrix>
+      <TileMatrix>
+        <ows:Identifier>EPSG:4326:0</ows:Identifier>
+        <ScaleDenominator>279541132.0</ScaleDenominator>
+        <TopLeftCorner>90.0 -180.0</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>2</MatrixWidth><MatrixHeight>1</MatrixHeight>
+      </TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+@urlmatch(netloc=r'wmts\.example\.com')
+def wmts_mock(url, request):
+    return {'status_code': 200, 'headers': {'content-type': 'application/xml'}, 'content': WMTS_CAPABILITIES}
+
+
+@urlmatch(netloc=r'hung\.example\.com')
+def hung_mock(url, request):
+    raise requests.exceptions.ReadTimeout('Read timed out')
+
+
+class ProbeTestCase(TestCase):
+
+    @with_httmock(wms_mock)
+    def test_probe_wms(self):
+        probes.probe_wms('http://wms.example.com/wms', 'layer', [-10, -10, 10, 10])
+        with self.assertRaises(ValueError):
+            probes.probe_wms('http://wms.example.com/wms', 'missing')
+
+    def test_wmts_tile_url(self):
+        urls = []
+        request = httpclient.request
+
+        def recording_request(method, url, **kwargs):
+            urls.append(url)
+            return request(method, url, **kwargs)
+
+        httpclient.request = recording_request
+        try:
+            with HTTMock(wmts_mock):
+                tile_url = probes.get_wmts_tile_url('http://wmts.example.com/wmts', 'roads')
+        finally:
+            httpclient.request = request
+        # the capabilities are fetched by the http client, within the timeouts of the operation
+        self.assertEqual(len(urls), 1)
+        self.assertIn('request=GetCapabilities', urls[0])
+        # the coarsest tile matrix, whatever its identifier
+        self.assertIn('TILEMATRIX=EPSG%3A4326%3A0&TILEROW=0&TILECOL=0', tile_url)
+
+    @with_httmock(esri_mock)
+    def test_probe_esri(self):
+        probes.probe_esri('http://esri.example.com/rest/services/map/MapServer')
+        probes.probe_esri('http://esri.example.com/rest/services/map/MapServer', '0')
+        with self.assertRaises(ValueError):
+            # the layer was removed from the service
+            probes.probe_esri('http://esri.example.com/rest/services/map/MapServer', '1')
+        with self.assertRaises(ValueError):
+            probes.probe_esri('http://esri.example.com/rest/services/missing')
+
+    def test_probe_esri_cached(self):
+        # the description fetched for the first layer of the service is reused by the next ones
+        with HTTMock(esri_mock):
+            probes.probe_esri('http://esri.example.com/rest/services/cached/MapServer', '0')
+        probes.probe_esri('http://esri.example.com/rest/services/cached/MapServer', '0')
+
+    @with_httmock(hung_mock)
+    def test_timeout(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        try:
+            service = Service.objects.create(url='http://hung.example.com/wms', title='Title', type='OGC:WMS')
+            layer = Layer.objects.create(service=service, name='layer', type='OGC:WMS')
+            with budgets.operation('check'):
+                self.assertEqual(socket.getdefaulttimeout(), budgets.get_read_timeout('check'))
+                success, message = layer.check_available()
+            self.assertIsNone(socket.getdefaulttimeout())
+        finally:
+            signals.post_save.connect(layer_post_save, sender=Layer)
+            signals.post_save.connect(service_post_save, sender=Service)
+        self.assertFalse(success)
+        check = layer.check_set.get()
+        self.assertTrue(check.timed_out)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the throttled progress of the tasks.
+"""
+
+from django.test import TestCase
+
+from hypermap.aggregator import caching, progress
+
+
+class FakeRequest(object):
+    id = 'parent-task'
+    called_directly = False
+
+
+class FakeTask(object):
+    request = FakeRequest()
+
+
+class ProgressTestCase(TestCase):
+
+    def setUp(self):
+        caching.get_shared_cache().clear()
+
+    def test_throttling(self):
+        reporter = progress.ProgressReporter(FakeTask(), 1000, every=100, interval=3600)
+        reports = []
+        report = reporter.report
+        reporter.report = lambda: reports.append(reporter.current) or report()
+        for count in range(1, 1001):
+            reporter.update(count)
+        self.assertEqual(reports, range(1, 1001, 100))
+        self.assertEqual(progress.get_progress('parent-task'), (901, 1000))
+        reporter.report()
+        self.assertEqual(progress.get_progress('parent-task'), (1000, 1000))
+
+    def test_children(self):
+        reporter = progress.ProgressReporter(FakeTask(), 12, every=1)
+        # 2 items processed by the parent, 10 handed to child tasks
+        reporter.update(2)
+        for count in range(3, 13):
+            reporter.update(count, children=1)
+        self.assertEqual(progress.get_progress('parent-task'), (2, 12))
+        for child in range(0, 4):
+            progress.child_done('parent-task')
+        self.assertEqual(progress.get_progress('parent-task'), (6, 12))
+        self.assertIsNone(progress.get_progress('other-task'))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the alias swaps of the search backends.
+"""
+
+import json
+import urlparse
+
+from django.test import TestCase
+from httmock import HTTMock, urlmatch
+
+from hypermap.aggregator.elasticsearch_client import ESHypermap
+from hypermap.aggregator.solr import SolrHypermap
+
+
+class FakeIndices(object):
+    """
+    The es indices client, recording the calls made to it.
+    """
+
+    def __init__(self, indices, aliases):
+        self.indices = indices
+        self.aliases = aliases
+        self.calls = []
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return dict((index, {'aliases': {name: {}}}) for index in self.aliases[name])
+
+    def exists(self, index):
+        return index in self.indices
+
+    def delete(self, index):
+        self.calls.append(('delete', index))
+        self.indices.remove(index)
+
+    def update_aliases(self, body):
+        self.calls.append(('update_aliases', body))
+
+
+class FakeElasticsearch(object):
+
+    def __init__(self, indices, aliases):
+        self.indices = FakeIndices(indices, aliases)
+
+
+class ESSwapAliasTestCase(TestCase):
+
+    def get_writer(self, indices, aliases):
+        # not created through __init__, which creates the index on the server
+        writer = ESHypermap.__new__(ESHypermap)
+        writer.index_name = 'hypermap_20170101000000'
+        writer.es = FakeElasticsearch(indices, aliases)
+        return writer
+
+    def test_swap_alias(self):
+        writer = self.get_writer(
+            ['hypermap_20160101000000', 'hypermap_20170101000000'], {'hypermap': ['hypermap_20160101000000']})
+        self.assertEqual(writer.swap_alias(), ['hypermap_20160101000000'])
+        self.assertEqual(writer.es.indices.calls, [('update_aliases', {'actions': [
+            {'remove': {'index': 'hypermap_20160101000000', 'alias': 'hypermap'}},
+            {'add': {'index': 'hypermap_20170101000000', 'alias': 'hypermap'}},
+        ]})])
+
+    def test_swap_legacy_index(self):
+        # the index created before aliases were used is deleted on its own, then the alias added
+        writer = self.get_writer(['hypermap', 'hypermap_20170101000000'], {})
+        self.assertEqual(writer.swap_alias(), [])
+        self.assertEqual(writer.es.indices.calls, [
+            ('delete', 'hypermap'),
+            ('update_aliases', {'actions': [{'add': {'index': 'hypermap_20170101000000', 'alias': 'hypermap'}}]}),
+        ])
+
+
+class SolrSwapAliasTestCase(TestCase):
+
+    def setUp(self):
+        self.collections = ['search_20160101000000', 'search_20160201000000', 'search_20160301000000',
+                            'search_20170101000000']
+        self.aliases = {'search': 'search_20160301000000'}
+        self.actions = []
+
+    def collections_mock(self):
+        @urlmatch(netloc=r'solr\.example\.com', path=r'/solr/admin/collections')
+        def mock(url, request):
+            params = dict(urlparse.parse_qsl(url.query))
+            self.actions.append((params['action'], params.get('name')))
+            if params['action'] == 'LIST':
+                return json.dumps({'collections': self.collections})
+            if params['action'] == 'CLUSTERSTATUS':
+                return json.dumps({'cluster': {'aliases': self.aliases}})
+            if params['action'] == 'CREATEALIAS':
+                self.aliases[params['name']] = params['collections']
+            elif params['action'] == 'DELETE':
+                self.collections.remove(params['name'])
+            return json.dumps({})
+        return HTTMock(mock)
+
+    def test_swap_alias(self):
+        writer = SolrHypermap('http://solr.example.com/solr/search_20170101000000', alias='search')
+        with self.collections_mock():
+            self.assertEqual(writer.swap_alias(), ['search_20160301000000'])
+            self.assertEqual(self.aliases['search'], 'search_20170101000000')
+            # the last previous collection is kept for rollback
+            self.assertEqual(writer.prune_versioned(1), ['search_20160101000000', 'search_20160201000000'])
+        self.assertEqual(self.collections, ['search_20160301000000', 'search_20170101000000'])
+
+    def test_legacy_collection(self):
+        # the collection searched by clients has the name of the alias, it is not dropped to swap
+        self.collections.append('search')
+        self.aliases = {}
+        writer = SolrHypermap('http://solr.example.com/solr/search')
+        with self.collections_mock():
+            with self.assertRaises(ValueError):
+                writer.create_versioned()
+        self.assertNotIn('CREATE', [action for action, name in self.actions])
+        self.assertIn('search', self.collections)
+        # rebuilt under a new alias, SEARCH_URL is moved to it afterwards
+        with self.settings(SEARCH_SOLR_ALIAS='hypermap'):
+            writer = SolrHypermap('http://solr.example.com/solr/search')
+            with self.collections_mock():
+                versioned = writer.create_versioned()
+                versioned.swap_alias()
+        self.assertTrue(self.aliases['hypermap'].startswith('hypermap_'))
+        self.assertIn('search', self.collections)
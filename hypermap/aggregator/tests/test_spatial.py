@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the spatial index of the resource geometries.
+"""
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.db.models import signals
+
+from hypermap.aggregator import spatial
+from hypermap.aggregator.models import Service, Layer, bbox2wktpolygon
+from hypermap.aggregator.models import layer_post_save, service_post_save
+
+
+class SpatialIndexTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        self.service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        for bbox in ([-10, -10, 10, 10], [100, 40, 120, 60], [-170, -80, -160, -70]):
+            Layer.objects.create(
+                service=self.service,
+                bbox_x0=bbox[0], bbox_y0=bbox[1], bbox_x1=bbox[2], bbox_y1=bbox[3],
+                wkt_geometry=bbox2wktpolygon(bbox)
+            )
+        self.layers = list(Layer.objects.order_by('id'))
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def search(self, model, bbox):
+        return sorted(spatial.filter_by_bbox(model.objects.all(), bbox).values_list('id', flat=True))
+
+    def test_filter_by_bbox(self):
+        self.assertEqual(self.search(Layer, [0, 0, 110, 50]), [self.layers[0].id, self.layers[1].id])
+        self.assertEqual(self.search(Layer, [-175, -85, -165, -75]), [self.layers[2].id])
+        self.assertEqual(self.search(Layer, [20, 20, 30, 30]), [])
+        # services have the world geometry by default
+        self.assertEqual(self.search(Service, [20, 20, 30, 30]), [self.service.id])
+
+    def test_sync(self):
+        layer = self.layers[0]
+        layer.wkt_geometry = bbox2wktpolygon([20, 20, 30, 30])
+        layer.save()
+        self.assertEqual(self.search(Layer, [20, 20, 30, 30]), [layer.id])
+        self.assertEqual(self.search(Layer, [-5, -5, 5, 5]), [])
+        layer.delete()
+        self.assertEqual(self.search(Layer, [20, 20, 30, 30]), [])
+        # the index can be filled again from the geometries
+        self.assertEqual(spatial.rebuild_spatial_index(Layer), 2)
+        self.assertEqual(self.search(Layer, [-180, -90, 180, 90]), [self.layers[1].id, self.layers[2].id])
+
+    @override_settings(SPATIAL_INDEX_ENABLED=False)
+    def test_filter_without_index(self):
+        self.assertEqual(self.search(Layer, [0, 0, 110, 50]), [self.layers[0].id, self.layers[1].id])
+
+    def test_filter_without_rtree(self):
+        # SQLite builds without rtree fall back to the bbox fields
+        spatial._available['default'] = False
+        try:
+            self.assertFalse(spatial.is_enabled())
+            self.assertEqual(self.search(Layer, [0, 0, 110, 50]), [self.layers[0].id, self.layers[1].id])
+            # services are filtered on their geometry, the world by default
+            self.assertEqual(self.search(Service, [20, 20, 30, 30]), [self.service.id])
+            Service.objects.filter(id=self.service.id).update(wkt_geometry=bbox2wktpolygon([-10, -10, 10, 10]))
+            self.assertEqual(self.search(Service, [20, 20, 30, 30]), [])
+        finally:
+            del spatial._available['default']
+        self.assertTrue(spatial.is_enabled())
+
+    def test_parse_bbox(self):
+        self.assertEqual(spatial.parse_bbox('-10,-10,10,10.5'), [-10, -10, 10, 10.5])
+        self.assertIsNone(spatial.parse_bbox('-10,-10,10'))
+        self.assertIsNone(spatial.parse_bbox('a,-10,10,10'))
+        # written in the SQL of the spatial index lookups
+        self.assertIsNone(spatial.parse_bbox('nan,-10,10,10'))
+        self.assertIsNone(spatial.parse_bbox('-inf,-10,10,10'))
+        with self.assertRaises(ValueError):
+            spatial.get_bbox_subquery(Layer, [float('nan'), -10, 10, 10])
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the generation of the layer thumbnails.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from PIL import Image
+
+from django.test import TestCase
+from django.utils import timezone
+from django.test.utils import override_settings
+from django.db.models import signals
+from httmock import HTTMock, urlmatch
+import mocks.wms
+
+from hypermap.aggregator import caching, models, thumbnails
+from hypermap.aggregator.models import Service, Layer
+from hypermap.aggregator.models import layer_post_save, service_post_save
+
+
+class ThumbnailTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        self.media_root = tempfile.mkdtemp()
+        self.service = service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        self.layer = Layer.objects.create(
+            service=service, name='layer', type='OGC:WMS', bbox_x0=-10, bbox_y0=-10, bbox_x1=10, bbox_y1=10)
+        self.images = []
+        self.layer.get_thumbnail_image = lambda: self.images.pop(0)
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+        shutil.rmtree(self.media_root)
+
+    def test_update_thumbnail(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            self.images = ['image', 'image', 'other image']
+            self.assertTrue(self.layer.update_thumbnail())
+            name = self.layer.thumbnail.name
+            self.assertEqual(Layer.objects.get(id=self.layer.id).thumbnail.name, name)
+            # the service and bbox did not change, the image is not fetched
+            self.assertFalse(self.layer.update_thumbnail())
+            self.assertEqual(len(self.images), 2)
+            # the image is fetched, but did not change
+            self.assertFalse(self.layer.update_thumbnail(force=True))
+            self.assertEqual(self.layer.thumbnail.name, name)
+            # the bbox changed
+            self.layer.bbox_x1 = 20
+            self.assertTrue(self.layer.update_thumbnail())
+            self.assertEqual(self.layer.thumbnail.read(), 'other image')
+
+    def test_shared_thumbnails(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            other = Layer.objects.create(service=self.service, name='other', type='OGC:WMS')
+            self.layer.set_thumbnail('blank')
+            other.set_thumbnail('blank')
+            # one image, referenced by both layers
+            self.assertEqual(other.thumbnail.name, self.layer.thumbnail.name)
+            self.assertEqual(thumbnails.count_references(other.thumbnail_hash), 2)
+            blank = os.path.join(self.media_root, self.layer.thumbnail.name)
+            self.layer.set_thumbnail('image')
+            self.assertTrue(os.path.exists(blank))
+            other.delete()
+            self.assertFalse(os.path.exists(blank))
+            # images not referenced anymore are collected
+            os.makedirs(os.path.join(self.media_root, 'layers'))
+            open(os.path.join(self.media_root, 'layers', 'old.jpg'), 'w').close()
+            self.assertEqual(thumbnails.collect_orphans(), ['layers/old.jpg'])
+            self.assertEqual(thumbnails.collect_orphans(), [])
+            self.assertEqual(self.layer.thumbnail.read(), 'image')
+
+    def test_thumbnail_lock(self):
+        wait = thumbnails.THUMBNAIL_LOCK_WAIT
+        thumbnails.THUMBNAIL_LOCK_WAIT = 0
+        try:
+            with override_settings(MEDIA_ROOT=self.media_root):
+                thumbnail_hash = thumbnails.get_thumbnail_hash('image')
+                name = thumbnails.store_thumbnail('image')
+                # being stored for a layer, the image is neither released nor collected
+                with thumbnails.thumbnail_lock(thumbnail_hash) as locked:
+                    self.assertTrue(locked)
+                    thumbnails.release_thumbnail(thumbnail_hash)
+                    self.assertEqual(thumbnails.collect_orphans(), [])
+                    self.layer.set_thumbnail('image')
+                self.assertTrue(os.path.exists(os.path.join(self.media_root, name)))
+                self.assertEqual(self.layer.thumbnail.name, name)
+                self.assertEqual(thumbnails.collect_orphans(), [])
+        finally:
+            thumbnails.THUMBNAIL_LOCK_WAIT = wait
+
+    def test_wms_capabilities(self):
+        requests = []
+
+        @urlmatch(netloc=mocks.wms.NETLOC)
+        def capabilities_mock(url, request):
+            requests.append(url.query)
+            return mocks.wms.resource_get(url, request)
+
+        service = Service.objects.create(url='http://wms.example.com/ows?', title='Title', type='OGC:WMS')
+        with HTTMock(capabilities_mock):
+            ows = models.get_wms_capabilities(service, service.url)
+            self.assertIn('geonode:_30river_project1_1', ows.contents)
+            # the layers of the service saved meanwhile do not make it stale
+            caching.increment_generation()
+            models.get_wms_capabilities(Service.objects.get(id=service.id), service.url)
+            self.assertEqual(len(requests), 1)
+            # fetched again once the service is harvested again
+            Service.objects.filter(id=service.id).update(last_updated=timezone.now())
+            models.get_wms_capabilities(Service.objects.get(id=service.id), service.url)
+            self.assertEqual(len(requests), 2)
+
+    def get_image(self, color, size=(50, 50)):
+        output = StringIO()
+        Image.new('RGB', size, color).save(output, 'JPEG')
+        return output.getvalue()
+
+    def test_sprite(self):
+        caching.get_shared_cache().clear()
+        with override_settings(MEDIA_ROOT=self.media_root):
+            layers = [self.layer] + [
+                Layer.objects.create(service=self.service, name='layer %s' % i, type='OGC:WMS') for i in range(0, 3)]
+            layers[0].set_thumbnail(self.get_image('red'))
+            layers[1].set_thumbnail(self.get_image('blue', (100, 50)))
+            layers[2].set_thumbnail(self.get_image('red'))
+            ids = ','.join(str(layer.id) for layer in layers)
+            response = self.client.get('/layers/sprite.json', {'ids': ids})
+            offsets = json.loads(response.content)['thumbnails']
+            # the layer without thumbnail is left out, the layers with the same image share it
+            self.assertEqual(len(offsets), 3)
+            self.assertEqual(offsets[str(layers[0].id)], offsets[str(layers[2].id)])
+            self.assertEqual(offsets[str(layers[1].id)][2:], [50, 25])
+            with self.assertNumQueries(1):
+                response = self.client.get('/layers/sprite.png', {'ids': ids})
+            sprite = Image.open(StringIO(response.content)).convert('RGB')
+            x, y = offsets[str(layers[0].id)][:2]
+            self.assertGreater(sprite.getpixel((x + 25, y + 25))[0], 200)
+            self.assertEqual(self.client.get('/layers/sprite.json').status_code, 400)
@@ -0,0 +1,189 @@
+"""
+Content-addressed storage of the layer thumbnails: an image is stored once, named by its md5,
+and shared by all the layers with the same thumbnail (i.e. the blank images of empty layers).
+The references to an image are the layers with its hash, when there are none left the image is
+removed; collect_orphans removes the images which are not referenced anymore.
+Storing an image and recording its reference, and releasing or collecting it, hold a lock of the image
+in the shared cache (see thumbnail_lock), so that an image is not removed between being found stored and
+being referenced by a layer.
+The thumbnails of a set of layers can be packed in a sprite, to be loaded in one request.
+"""
+
+import hashlib
+import math
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from hypermap.aggregator import caching
+
+THUMBNAILS_DIR = 'thumbnails'
+# where the thumbnails were written before they were content-addressed
+LEGACY_THUMBNAILS_DIR = 'layers'
+
+# size of the cells of a sprite, the thumbnails are 50x50 images
+SPRITE_CELL_SIZE = 50
+# how many layers a sprite can be requested for
+SPRITE_MAX_LAYERS = 500
+SPRITE_CACHE_TIMEOUT = 3600
+
+# how long the lock of an image is held at most, and waited for, in seconds
+THUMBNAIL_LOCK_TIMEOUT = 60
+THUMBNAIL_LOCK_WAIT = 10
+
+
+def get_thumbnail_hash(content):
+    return hashlib.md5(content).hexdigest()
+
+
+def get_thumbnail_name(thumbnail_hash):
+    return '%s/%s/%s.jpg' % (THUMBNAILS_DIR, thumbnail_hash[:2], thumbnail_hash)
+
+
+def get_name_hash(name):
+    """
+    Returns the hash of a stored image by its name, legacy images are locked by their name.
+    """
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+@contextmanager
+def thumbnail_lock(thumbnail_hash):
+    """
+    Hold the lock of an image while it is stored and referenced, or released. Yields whether the lock was
+    taken: it is not after THUMBNAIL_LOCK_WAIT seconds, i.e. held by a process which died.
+    """
+    cache = caching.get_shared_cache()
+    key = 'thumbnail-lock-%s' % thumbnail_hash
+    token = uuid.uuid4().hex
+    deadline = time.time() + THUMBNAIL_LOCK_WAIT
+    locked = cache.add(key, token, THUMBNAIL_LOCK_TIMEOUT)
+    while not locked and time.time() < deadline:
+        time.sleep(0.1)
+        locked = cache.add(key, token, THUMBNAIL_LOCK_TIMEOUT)
+    try:
+        yield locked
+    finally:
+        if locked and cache.get(key) == token:
+            cache.delete(key)
+
+
+def store_thumbnail(content, thumbnail_hash=None):
+    """
+    Store a thumbnail image, unless the same image is already stored. Returns its name in the storage.
+    """
+    name = get_thumbnail_name(thumbnail_hash or get_thumbnail_hash(content))
+    if not default_storage.exists(name):
+        saved_name = default_storage.save(name, ContentFile(content))
+        if saved_name != name:
+            # stored meanwhile by another process, the storage saved a copy under another name
+            default_storage.delete(saved_name)
+    return name
+
+
+def count_references(thumbnail_hash):
+    from hypermap.aggregator.models import Layer
+    return Layer.objects.filter(thumbnail_hash=thumbnail_hash).count()
+
+
+def release_thumbnail(thumbnail_hash):
+    """
+    Remove a thumbnail image if no layer references it anymore. An image still locked is left to
+    collect_orphans.
+    """
+    if not thumbnail_hash:
+        return
+    with thumbnail_lock(thumbnail_hash) as locked:
+        if locked and count_references(thumbnail_hash) == 0:
+            name = get_thumbnail_name(thumbnail_hash)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+
+
+def iter_stored_thumbnails():
+    """
+    Yield the names of the stored thumbnail images, content-addressed and legacy ones.
+    """
+    for directory in (THUMBNAILS_DIR, LEGACY_THUMBNAILS_DIR):
+        if not default_storage.exists(directory):
+            continue
+        subdirectories, files = default_storage.listdir(directory)
+        for file_name in files:
+            yield '%s/%s' % (directory, file_name)
+        for subdirectory in subdirectories:
+            for file_name in default_storage.listdir(os.path.join(directory, subdirectory))[1]:
+                yield '%s/%s/%s' % (directory, subdirectory, file_name)
+
+
+def collect_orphans(dry_run=False):
+    """
+    Remove the stored thumbnail images which no layer references. Returns their names.
+    """
+    from hypermap.aggregator.models import Layer
+    referenced = set(Layer.objects.exclude(thumbnail='').exclude(thumbnail__isnull=True).values_list(
+        'thumbnail', flat=True))
+    orphans = [name for name in iter_stored_thumbnails() if name not in referenced]
+    if dry_run:
+        return orphans
+    collected = []
+    for name in orphans:
+        with thumbnail_lock(get_name_hash(name)) as locked:
+            # the image may have been referenced since the references were read
+            if locked and not Layer.objects.filter(thumbnail=name).exists():
+                default_storage.delete(name)
+                collected.append(name)
+    return collected
+
+
+def build_sprite(thumbnail_names):
+    """
+    Pack thumbnail images in a grid of SPRITE_CELL_SIZE cells, the images are scaled down to fit.
+    Returns the sprite as PNG, and the [x, y, width, height] offsets of each image in it by name.
+    Images which cannot be read are left out.
+    """
+    images = []
+    for name in thumbnail_names:
+        try:
+            image = Image.open(default_storage.open(name)).convert('RGBA')
+        except Exception:
+            continue
+        image.thumbnail((SPRITE_CELL_SIZE, SPRITE_CELL_SIZE))
+        images.append((name, image))
+    columns = max(int(math.ceil(math.sqrt(len(images)))), 1)
+    rows = max(int(math.ceil(len(images) / float(columns))), 1)
+    sprite = Image.new('RGBA', (columns * SPRITE_CELL_SIZE, rows * SPRITE_CELL_SIZE), (0, 0, 0, 0))
+    offsets = {}
+    for index, (name, image) in enumerate(images):
+        x = (index % columns) * SPRITE_CELL_SIZE
+        y = (index // columns) * SPRITE_CELL_SIZE
+        sprite.paste(image, (x, y))
+        offsets[name] = [x, y, image.size[0], image.size[1]]
+    output = StringIO()
+    sprite.save(output, 'PNG', optimize=True)
+    return output.getvalue(), offsets
+
+
+def get_sprite(layer_ids):
+    """
+    Returns the sprite of the thumbnails of layers as PNG, and the [x, y, width, height] offsets of
+    each layer thumbnail in it by layer id. Layers sharing an image share its cell.
+    Sprites are cached by the set of layers and of their thumbnails.
+    """
+    from hypermap.aggregator.models import Layer
+    thumbnails = sorted(Layer.objects.filter(id__in=layer_ids).exclude(thumbnail='').exclude(
+        thumbnail__isnull=True).values_list('id', 'thumbnail'))
+    key = 'thumbnail-sprite-%s' % hashlib.md5(repr(thumbnails)).hexdigest()
+    cache = caching.get_shared_cache()
+    sprite = cache.get(key)
+    if sprite is None:
+        content, image_offsets = build_sprite(sorted(set(name for layer_id, name in thumbnails)))
+        offsets = dict((layer_id, image_offsets[name]) for layer_id, name in thumbnails if name in image_offsets)
+        sprite = (content, offsets)
+        cache.set(key, sprite, SPRITE_CACHE_TIMEOUT)
+    return sprite
@@ -11,6 +11,7 @@ urlpatterns = [
     url(r'^service/(?P<service_id>\d+)/checks$', views.service_checks, name='service_checks'),
     url(r'^layer/(?P<layer_id>\d+)/$', views.layer_detail, name='layer_detail'),
     url(r'^layer/(?P<layer_id>\d+)/checks$', views.layer_checks, name='layer_checks'),
+    url(r'^layers/sprite\.(?P<sprite_format>png|json)$', views.layers_sprite, name='layers_sprite'),
     url(r'^celery_monitor/$', views.celery_monitor, name='celery_monitor'),
     url(r'^update_progressbar/(?P<task_id>[^/]*)$', views.update_progressbar, name='update_progressbar'),
     url(r'^update_jobs_number/$', views.update_jobs_number, name='update_jobs_number'),
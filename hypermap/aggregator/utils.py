@@ -1,9 +1,8 @@
-import urllib2
 import logging
-import requests
 import re
 import sys
 import math
+import numpy
 import traceback
 from urlparse import urlparse
 
@@ -14,6 +13,7 @@ from owslib.tms import TileMapService
 from owslib.wmts import WebMapTileService
 from arcrest import Folder as ArcFolder
 
+from hypermap.aggregator import budgets, httpclient
 from hypermap.aggregator.enums import SERVICE_TYPES
 
 LOGGER = logging.getLogger(__name__)
@@ -26,7 +26,7 @@ def create_service_from_endpoint(endpoint, service_type, title=None, abstract=No
     from models import Service
     if Service.objects.filter(url=endpoint).count() == 0:
         # check if endpoint is valid
-        request = requests.get(endpoint)
+        request = httpclient.get(endpoint)
         if request.status_code == 200:
             print 'Creating a %s service for endpoint %s' % (service_type, endpoint)
             service = Service(
@@ -51,7 +51,7 @@ def create_services_from_endpoint(url):
     num_created = 0
     endpoint = get_sanitized_endpoint(url)
     try:
-        urllib2.urlopen(endpoint, timeout=10)
+        httpclient.get(endpoint).raise_for_status()
     except Exception as e:
         print 'ERROR! Cannot open this endpoint: %s' % endpoint
         message = traceback.format_exception(*sys.exc_info())
@@ -81,7 +81,7 @@ def create_services_from_endpoint(url):
     # test if it is CSW, WMS, TMS, WMTS or Esri
     # CSW
     try:
-        csw = CatalogueServiceWeb(endpoint)
+        csw = CatalogueServiceWeb(endpoint, timeout=budgets.get_read_timeout())
         service_type = 'OGC:CSW'
         service_links = {}
         detected = True
@@ -143,7 +143,7 @@ def create_services_from_endpoint(url):
     # WMS
     if not detected:
         try:
-            service = WebMapService(endpoint, timeout=10)
+            service = WebMapService(endpoint, timeout=budgets.get_read_timeout())
             service_type = 'OGC:WMS'
             title = service.identification.title,
             abstract = service.identification.abstract
@@ -154,7 +154,7 @@ def create_services_from_endpoint(url):
     # TMS
     if not detected:
         try:
-            service = TileMapService(endpoint, timeout=10)
+            service = TileMapService(endpoint, timeout=budgets.get_read_timeout())
             service_type = 'OSGeo:TMS'
             title = service.identification.title,
             abstract = service.identification.abstract
@@ -263,6 +263,94 @@ def mercator_to_llbbox(bbox):
     return [minlonlat[0], minlonlat[1], maxlonlat[0], maxlonlat[1]]
 
 
+def inverse_mercator_arrays(x, y):
+    """
+        Vectorized inverse_mercator: given arrays of coordinates in spherical mercator,
+        return the arrays of lon and lat.
+    """
+    lon = (x / 20037508.34) * 180
+    lat = (y / 20037508.34) * 180
+    # huge coordinates overflow to inf, which gives the poles
+    with numpy.errstate(over='ignore'):
+        lat = 180 / numpy.pi * \
+            (2 * numpy.arctan(numpy.exp(lat * numpy.pi / 180)) - numpy.pi / 2)
+    return lon, lat
+
+
+def mercator_to_llbboxes(bboxes):
+    """
+    Vectorized mercator_to_llbbox: convert an array of shape (n, 4) of minx, miny, maxx, maxy bboxes
+    in spherical mercator (EPSG:3857, 102100, 102113) to lon/lat bboxes.
+    """
+    bboxes = numpy.asarray(bboxes, dtype=float).reshape(-1, 4)
+    minlon, minlat = inverse_mercator_arrays(bboxes[:, 0], bboxes[:, 1])
+    maxlon, maxlat = inverse_mercator_arrays(bboxes[:, 2], bboxes[:, 3])
+    return numpy.column_stack((minlon, minlat, maxlon, maxlat))
+
+
+def repair_bboxes(bboxes, mercator=None):
+    """
+    Check and repair an array of shape (n, 4) of minx, miny, maxx, maxy bboxes, which should be in lon/lat.
+    A bbox is:
+    - invalid if it has a missing (NaN), infinite or huge (as for format_float) coordinate;
+    - mercator encoded if it is out of the lon/lat range and, either its service uses a mercator srs
+      (mercator array of booleans) or a coordinate is beyond 360: it is then converted to lon/lat;
+    - flipped if its min and max coordinates are swapped: they are then ordered;
+    - out of range if it goes beyond the world extent: it is then clamped.
+    Returns the repaired bboxes, with NaN rows for the invalid ones, and a dictionary of boolean
+    arrays flagging the bboxes for each problem.
+    """
+    bboxes = numpy.array(bboxes, dtype=float).reshape(-1, 4)
+    if mercator is None:
+        mercator = numpy.zeros(len(bboxes), dtype=bool)
+    with numpy.errstate(invalid='ignore'):
+        invalid = ~numpy.isfinite(bboxes).all(axis=1) | (numpy.abs(bboxes) > 999999999).any(axis=1)
+        out_of_lonlat = (numpy.abs(bboxes[:, [0, 2]]) > 180).any(axis=1) | \
+            (numpy.abs(bboxes[:, [1, 3]]) > 90).any(axis=1)
+        mercator = ~invalid & out_of_lonlat & (numpy.asarray(mercator, dtype=bool) |
+                                               (numpy.abs(bboxes) > 360).any(axis=1))
+        if mercator.any():
+            bboxes[mercator] = mercator_to_llbboxes(bboxes[mercator])
+        flipped = ~invalid & ((bboxes[:, 0] > bboxes[:, 2]) | (bboxes[:, 1] > bboxes[:, 3]))
+        out_of_range = ~invalid & ~mercator & out_of_lonlat
+    extents = get_llbboxes_extents(bboxes)
+    repaired = numpy.column_stack((extents['min_x'], extents['min_y'], extents['max_x'], extents['max_y']))
+    repaired[invalid] = numpy.nan
+    flags = {
+        'invalid': invalid,
+        'mercator': mercator,
+        'flipped': flipped,
+        'out_of_range': out_of_range,
+    }
+    return repaired, flags
+
+
+def get_llbboxes_extents(bboxes):
+    """
+    Given an array of shape (n, 4) of lon/lat bboxes, order their corners, clamp them to the
+    world extent and compute their centers, half sizes and areas, all in one pass.
+    Returns a dictionary of arrays.
+    """
+    bboxes = numpy.asarray(bboxes, dtype=float).reshape(-1, 4)
+    min_x = numpy.maximum(numpy.minimum(bboxes[:, 0], bboxes[:, 2]), -180)
+    max_x = numpy.minimum(numpy.maximum(bboxes[:, 0], bboxes[:, 2]), 180)
+    min_y = numpy.maximum(numpy.minimum(bboxes[:, 1], bboxes[:, 3]), -90)
+    max_y = numpy.minimum(numpy.maximum(bboxes[:, 1], bboxes[:, 3]), 90)
+    half_width = (max_x - min_x) / 2.0
+    half_height = (max_y - min_y) / 2.0
+    return {
+        'min_x': min_x,
+        'min_y': min_y,
+        'max_x': max_x,
+        'max_y': max_y,
+        'center_x': (max_x + min_x) / 2.0,
+        'center_y': (max_y + min_y) / 2.0,
+        'half_width': half_width,
+        'half_height': half_height,
+        'area': (half_width * 2) * (half_height * 2),
+    }
+
+
 def get_sanitized_endpoint(url):
     """
     Sanitize an endpoint, as removing unneeded parameters
@@ -1,19 +1,23 @@
-import urllib2
 import json
 import pika
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.template import RequestContext, loader
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
+from django.core.urlresolvers import reverse
 from django.db.models import Count
 from django.contrib.auth.decorators import login_required
 
 from models import Service, Layer
 from tasks import (check_all_services, check_service, check_layer, remove_service_checks,
-                   index_service, index_all_layers, index_layer, clear_solr)
+                   index_service, index_all_layers, index_delta_layers, index_layer, clear_solr,
+                   rebuild_index)
 from enums import SERVICE_TYPES
+from thumbnails import get_sprite, SPRITE_MAX_LAYERS
+import httpclient
+from progress import get_progress
 
 from hypermap import celeryapp
 
@@ -39,8 +43,8 @@ def domains(request):
     url = ('%s/select?q=*:*&facet=true&facet.limit=-1&facet.pivot=domain_name,service_id&wt=json&indent=true&rows=0'
            % settings.SEARCH_URL)
     print url
-    response = urllib2.urlopen(url)
-    data = response.read().replace('\n', '')
+    response = httpclient.get(url)
+    data = response.content.replace('\n', '')
     # stats
     layers_count = Layer.objects.all().count()
     services_count = Service.objects.all().count()
@@ -102,17 +106,17 @@ def service_detail(request, service_id):
             if settings.SKIP_CELERY_TASK:
                 check_service(service)
             else:
-                check_service.delay(service)
+                check_service.apply_async((service,), queue=settings.INTERACTIVE_QUEUE)
         if 'remove' in request.POST:
             if settings.SKIP_CELERY_TASK:
                 remove_service_checks(service)
             else:
-                remove_service_checks.delay(service)
+                remove_service_checks.apply_async((service,), queue=settings.INTERACTIVE_QUEUE)
         if 'index' in request.POST:
             if settings.SKIP_CELERY_TASK:
                 index_service(service)
             else:
-                index_service.delay(service)
+                index_service.apply_async((service,), queue=settings.INTERACTIVE_QUEUE)
 
     return render(request, 'aggregator/service_detail.html', {'service': service})
 
@@ -132,14 +136,14 @@ def layer_detail(request, layer_id):
             if settings.SKIP_CELERY_TASK:
                 check_layer(layer)
             else:
-                check_layer.delay(layer)
+                check_layer.apply_async((layer,), queue=settings.INTERACTIVE_QUEUE)
         if 'remove' in request.POST:
             layer.check_set.all().delete()
         if 'index' in request.POST:
             if settings.SKIP_CELERY_TASK:
                 index_layer(layer)
             else:
-                index_layer.delay(layer)
+                index_layer.apply_async((layer,), queue=settings.INTERACTIVE_QUEUE)
 
     return render(request, 'aggregator/layer_detail.html', {'layer': layer,
                                                             'SEARCH_TYPE': settings.SEARCH_TYPE,
@@ -153,6 +157,24 @@ def layer_checks(request, layer_id):
     return render(request, 'aggregator/layer_checks.html', {'layer': layer, 'resource': resource})
 
 
+def layers_sprite(request, sprite_format):
+    """
+    The thumbnails of the layers given as ids=1,2,3 packed in one image (sprite.png), and the
+    offsets of each layer thumbnail in it (sprite.json).
+    """
+    layer_ids = [int(layer_id) for layer_id in request.GET.get('ids', '').split(',') if layer_id.isdigit()]
+    if not layer_ids or len(layer_ids) > SPRITE_MAX_LAYERS:
+        return HttpResponseBadRequest('From 1 to %s layer ids are expected' % SPRITE_MAX_LAYERS)
+    content, offsets = get_sprite(layer_ids)
+    if sprite_format == 'png':
+        return HttpResponse(content, content_type='image/png')
+    response_data = {
+        'sprite': '%s?ids=%s' % (reverse('layers_sprite', args=('png',)), ','.join(str(i) for i in layer_ids)),
+        'thumbnails': offsets,
+    }
+    return HttpResponse(json.dumps(response_data), content_type="application/json")
+
+
 @login_required
 def celery_monitor(request):
     """
@@ -201,23 +223,38 @@ def celery_monitor(request):
                 index_all_layers()
             else:
                 index_all_layers.delay()
+        if 'index_delta' in request.POST:
+            if settings.SKIP_CELERY_TASK:
+                index_delta_layers()
+            else:
+                index_delta_layers.delay()
+        if 'rebuild_index' in request.POST:
+            if settings.SKIP_CELERY_TASK:
+                rebuild_index()
+            else:
+                rebuild_index.delay()
         if 'clear_solr' in request.POST:
             if settings.SKIP_CELERY_TASK:
                 clear_solr()
             else:
                 clear_solr.delay()
+    queues = get_queued_jobs_numbers()
     return render(
         request,
         'aggregator/celery_monitor.html',
         {
             'active_tasks': active_tasks,
             'reserved_tasks': reserved_tasks,
-            'jobs': get_queued_jobs_number(),
+            'jobs': sum(jobs for queue, jobs in queues),
+            'queues': queues,
         }
     )
 
 
-def get_queued_jobs_number():
+def get_queued_jobs_numbers():
+    """
+    Returns the number of jobs waiting in each of the task queues.
+    """
     # to detect tasks in the queued the only way is to use amqplib so far
     from amqplib import client_0_8 as amqp
 
@@ -228,15 +265,29 @@ def get_queued_jobs_number():
                            password=params.credentials.password,
                            virtual_host=params.virtual_host,
                            insist=False)
-    chan = conn.channel()
-    name, jobs, consumers = chan.queue_declare(queue="celery", passive=True)
-    return jobs
+    queues = []
+    try:
+        for queue in settings.TASK_QUEUES:
+            # a failed passive declare closes the channel, each queue gets its own
+            chan = conn.channel()
+            try:
+                name, jobs, consumers = chan.queue_declare(queue=queue, passive=True)
+                chan.close()
+            except amqp.AMQPChannelException:
+                # the queue was not declared yet, no task was ever sent to it
+                jobs = 0
+            queues.append((queue, jobs))
+    finally:
+        conn.close()
+    return queues
 
 
 @login_required
 def update_jobs_number(request):
+    queues = get_queued_jobs_numbers()
     response_data = {}
-    response_data['jobs'] = get_queued_jobs_number()
+    response_data['jobs'] = sum(jobs for queue, jobs in queues)
+    response_data['queues'] = dict(queues)
     json_data = json.dumps(response_data)
     return HttpResponse(json_data, content_type="application/json")
 
@@ -244,17 +295,21 @@ def update_jobs_number(request):
 @login_required
 def update_progressbar(request, task_id):
     response_data = {}
-    active_task = celeryapp.AsyncResult(task_id)
     progressbar = 100
     status = '100%'
     state = 'COMPLETED'
-    if active_task:
-        if not active_task.ready():
-            current = active_task.info['current']
-            total = active_task.info['total']
+    task_progress = get_progress(task_id)
+    if task_progress is None:
+        # tasks not reporting their progress in the shared cache
+        active_task = celeryapp.AsyncResult(task_id)
+        if active_task and not active_task.ready() and active_task.info:
+            task_progress = active_task.info['current'], active_task.info['total']
+    if task_progress is not None:
+        current, total = task_progress
+        if current < total:
             progressbar = (current / float(total) * 100)
             status = "%s/%s (%.2f %%)" % (current, total, progressbar)
-            state = active_task.state
+            state = 'PROGRESS'
     response_data['progressbar'] = progressbar
     response_data['status'] = status
     response_data['state'] = state
@@ -0,0 +1,172 @@
+"""
+Per process pycsw engine. The PYCSW settings are parsed and the repository mappings loaded once,
+instead of at every request, and each request only binds its environment to a new pycsw server.
+Responses are cached in the shared cache, under a version of the PYCSW settings and, for
+GetRecords and GetRecordById, under the generation of the catalogue.
+"""
+
+import copy
+import hashlib
+import imp
+import os
+from ConfigParser import SafeConfigParser
+
+from lxml import etree
+
+from django.conf import settings
+
+from pycsw import server
+from pycsw.core import config as pycsw_config
+
+from hypermap.aggregator import caching
+from hypermap.search.repository import get_catalog_filter
+
+# the operations whose responses are cached until the catalogue changes
+CACHED_OPERATIONS = ('getrecords', 'getrecordbyid')
+
+# blank text between elements is not significant in a request
+XML_PARSER = etree.XMLParser(remove_blank_text=True)
+
+# the engine of the current version of the PYCSW settings
+_engine = {}
+
+
+class CswEngine(object):
+    """
+    The parsed PYCSW settings and repository mappings, shared by the requests of the process,
+    and the settings of the catalogs, whose layers are filtered with a repository filter.
+    """
+
+    def __init__(self, rtconfig, version):
+        self.version = version
+        self.rtconfig = copy.deepcopy(rtconfig)
+        self.mappings = None
+        if 'mappings' in self.rtconfig.get('repository', {}):
+            module = self.rtconfig['repository'].pop('mappings')
+            self.mappings = imp.load_source(os.path.splitext(module)[0].replace(os.sep, '.'), module)
+        self.config = self.parse_config(self.rtconfig)
+        self.catalog_configs = {}
+
+    def parse_config(self, rtconfig):
+        config = SafeConfigParser()
+        for section, options in rtconfig.items():
+            config.add_section(section)
+            for key, value in options.items():
+                config.set(section, key, value)
+        # the options set by pycsw at every request, set once so that the shared config is not written
+        config.set('server', 'home', os.path.dirname(os.path.join(os.path.dirname(server.__file__), '..')))
+        if not config.has_option('server', 'ogc_schemas_base'):
+            config.set('server', 'ogc_schemas_base', pycsw_config.StaticContext().ogc_schemas_base)
+        if not config.has_option('repository', 'table'):
+            config.set('repository', 'table', 'records')
+        return config
+
+    def get_config(self, catalog=None):
+        """
+        Returns the parsed settings for the whole repository, or for the layers of a catalog.
+        """
+        if catalog is None:
+            return self.config
+        key = (catalog.id, catalog.slug)
+        config = self.catalog_configs.get(key)
+        if config is None:
+            rtconfig = copy.deepcopy(self.rtconfig)
+            rtconfig['server']['url'] = '%s/%s/' % (rtconfig['server']['url'].rstrip('/'), catalog.slug)
+            rtconfig['repository']['filter'] = get_catalog_filter(catalog)
+            config = self.parse_config(rtconfig)
+            self.catalog_configs[key] = config
+        return config
+
+    def get_csw(self, env, catalog=None):
+        """
+        Returns a pycsw server for the request environment env, on the layers of catalog if given.
+        """
+        csw = server.Csw(self.get_config(catalog), env, version='2.0.2')
+        if self.mappings is not None:
+            csw.context.md_core_model = self.mappings.MD_CORE_MODEL
+            csw.context.refresh_dc(self.mappings.MD_CORE_MODEL)
+        return csw
+
+
+def get_config_version():
+    return hashlib.md5(repr(sorted(
+        (section, sorted(options.items())) for section, options in settings.PYCSW.items()
+    ))).hexdigest()
+
+
+def get_engine():
+    """
+    Returns the engine of the PYCSW settings, built again when they change.
+    """
+    version = get_config_version()
+    engine = _engine.get(version)
+    if engine is None:
+        engine = CswEngine(settings.PYCSW, version)
+        _engine.clear()
+        _engine[version] = engine
+    return engine
+
+
+def get_operation(request):
+    """
+    Returns the CSW operation of a request, lowercased, and a canonical form of the request:
+    the sorted parameters of a GET request, the canonical XML of a POST request.
+    Returns (None, None) if the request is not parsed.
+    """
+    if request.method == 'GET':
+        kvp = sorted((key.lower(), value) for key, value in request.GET.items())
+        return dict(kvp).get('request', '').lower() or None, repr(kvp)
+    if request.method == 'POST':
+        try:
+            root = etree.fromstring(request.body, XML_PARSER)
+        except etree.XMLSyntaxError:
+            return None, None
+        return etree.QName(root).localname.lower(), etree.tostring(root, method='c14n')
+    return None, None
+
+
+def get_cache_key(request, version):
+    """
+    Returns the cache key of the response to a request and how long it is cached,
+    or (None, None) if it is not cached.
+    Responses to GetRecords and GetRecordById are stale as soon as the catalogue changes.
+    """
+    operation, canonical = get_operation(request)
+    if operation == 'getcapabilities':
+        prefix = 'csw-capabilities-%s' % version
+        timeout = settings.CSW_CAPABILITIES_CACHE_TIMEOUT
+    elif operation in CACHED_OPERATIONS:
+        prefix = 'csw-response-%s-%s' % (version, caching.get_generation())
+        timeout = settings.CSW_RESPONSE_CACHE_TIMEOUT
+    else:
+        return None, None
+    return '%s-%s' % (prefix, hashlib.md5(request.path + canonical).hexdigest()), timeout
+
+
+def dispatch(request, env, catalog=None):
+    """
+    Run a CSW request, on the layers of catalog if given.
+    Returns the content of the response and its content type.
+    """
+    engine = get_engine()
+    cache = caching.get_shared_cache()
+    key, timeout = get_cache_key(request, engine.version)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    csw = engine.get_csw(env, catalog)
+    content = csw.dispatch_wsgi()
+
+    # pycsw 2.0 has an API break:
+    # pycsw < 2.0: content = xml_response
+    # pycsw >= 2.0: content = [http_status_code, content]
+    # deal with the API break
+
+    if isinstance(content, list):  # pycsw 2.0+
+        content = content[1]
+
+    if key is not None and not csw.exception:
+        cache.set(key, (content, csw.contenttype), timeout)
+    return content, csw.contenttype
@@ -0,0 +1,95 @@
+"""
+Bulk export of the layer records, as a gzip stream of CSW XML or of JSON lines.
+Layers are read in keyset chunks, the export is generated and compressed one chunk at a time.
+"""
+
+import json
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+from hypermap.aggregator.models import Layer
+
+FORMATS = ('xml', 'jsonl')
+
+CSW_NAMESPACE = 'http://www.opengis.net/cat/csw/2.0.2'
+
+# the fields of the records exported as JSON lines
+JSON_FIELDS = ('title', 'abstract', 'type', 'url', 'wkt_geometry', 'last_updated')
+
+
+def get_layers(modified_since=None, catalog=None):
+    layers = Layer.objects.all()
+    if modified_since is not None:
+        if timezone.is_naive(modified_since):
+            modified_since = timezone.make_aware(modified_since, timezone.utc)
+        layers = layers.filter(last_updated__gte=modified_since)
+    if catalog is not None:
+        layers = layers.filter(catalogs=catalog)
+    return layers
+
+
+def iter_chunks(layers, fields, chunk_size=None):
+    """
+    Yield the values of fields for the layers, ordered by id, as lists of (id, values...) rows.
+    """
+    chunk_size = chunk_size or settings.SEARCH_BULK_SIZE
+    rows = layers.order_by('id').values_list('id', *fields)
+    last_id = 0
+    while True:
+        chunk = list(rows.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last_id = chunk[-1][0]
+
+
+def iter_xml(layers, chunk_size=None):
+    """
+    Yield a csw:GetRecordsResponse document of the layer records, in parts.
+    """
+    total = layers.count()
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<csw:GetRecordsResponse xmlns:csw="%s" version="2.0.2">'
+           '<csw:SearchResults numberOfRecordsMatched="%s" numberOfRecordsReturned="%s" nextRecord="0" '
+           'elementSet="full">' % (CSW_NAMESPACE, total, total))
+    for chunk in iter_chunks(layers, ('xml',), chunk_size):
+        yield ''.join(xml.encode('utf-8') for layer_id, xml in chunk if xml)
+    yield '</csw:SearchResults></csw:GetRecordsResponse>\n'
+
+
+def iter_json_lines(layers, chunk_size=None):
+    """
+    Yield the layer records as JSON lines, in parts.
+    """
+    for chunk in iter_chunks(layers, JSON_FIELDS, chunk_size):
+        lines = []
+        for row in chunk:
+            record = dict(zip(('identifier',) + JSON_FIELDS, row))
+            record['identifier'] = str(record['identifier'])
+            if record['last_updated'] is not None:
+                record['last_updated'] = record['last_updated'].isoformat()
+            lines.append(json.dumps(record))
+        yield '%s\n' % '\n'.join(lines)
+
+
+def iter_gzip(parts):
+    """
+    Compress parts of a document to a gzip stream.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(layers, export_format='xml', chunk_size=None):
+    """
+    Yield the gzip stream of the export of layers, in one of FORMATS.
+    """
+    if export_format == 'jsonl':
+        return iter_gzip(iter_json_lines(layers, chunk_size))
+    return iter_gzip(iter_xml(layers, chunk_size))
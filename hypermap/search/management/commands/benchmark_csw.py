@@ -0,0 +1,125 @@
+import random
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from hypermap.aggregator import caching, fulltext, spatial
+from hypermap.aggregator.models import Service, Layer, bbox2wktpolygon
+from hypermap.search import views
+
+GETRECORDS = """<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecords xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:ogc="http://www.opengis.net/ogc"
+    xmlns:gml="http://www.opengis.net/gml" service="CSW" version="2.0.2" resultType="results"
+    startPosition="%(start)s" maxRecords="10">
+  <csw:Query typeNames="csw:Record">
+    <csw:ElementSetName>brief</csw:ElementSetName>
+    <csw:Constraint version="1.1.0">
+      <ogc:Filter>%(filter)s</ogc:Filter>
+    </csw:Constraint>
+  </csw:Query>
+</csw:GetRecords>
+"""
+
+FILTERS = {
+    'bbox': """
+        <ogc:BBOX>
+          <ogc:PropertyName>ows:BoundingBox</ogc:PropertyName>
+          <gml:Envelope>
+            <gml:lowerCorner>0 0</gml:lowerCorner>
+            <gml:upperCorner>50 110</gml:upperCorner>
+          </gml:Envelope>
+        </ogc:BBOX>""",
+    'anytext': """
+        <ogc:PropertyIsLike wildCard="%" singleChar="_" escapeChar="\\">
+          <ogc:PropertyName>csw:AnyText</ogc:PropertyName>
+          <ogc:Literal>%water%</ogc:Literal>
+        </ogc:PropertyIsLike>""",
+}
+
+WORDS = ('water', 'roads', 'land', 'use', 'census', 'elevation', 'rivers', 'soils', 'parcels', 'zoning')
+
+
+def create_layers(number, bulk_size=1000):
+    """
+    Create random layers, with their spatial and full-text index rows.
+    """
+    service = Service(url='http://benchmark.example.com', title='Benchmark', type='OGC:WMS')
+    Service.objects.bulk_create([service])
+    service = Service.objects.get(url=service.url, type=service.type)
+    last_id = Layer.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, number, bulk_size):
+        layers = []
+        for i in range(start, min(start + bulk_size, number)):
+            x = sorted(random.uniform(-180, 180) for c in range(0, 2))
+            y = sorted(random.uniform(-90, 90) for c in range(0, 2))
+            anytext = ' '.join(random.sample(WORDS, 3))
+            layers.append(Layer(
+                service=service, name='layer%s' % i, title=anytext, anytext=anytext, type='OGC:WMS',
+                bbox_x0=x[0], bbox_y0=y[0], bbox_x1=x[1], bbox_y1=y[1],
+                wkt_geometry=bbox2wktpolygon([x[0], y[0], x[1], y[1]])
+            ))
+        Layer.objects.bulk_create(layers)
+    rows = Layer.objects.filter(id__gt=last_id).values_list('id', 'wkt_geometry', 'anytext')
+    for start in range(0, number, bulk_size):
+        chunk = rows[start:start + bulk_size]
+        spatial.set_bboxes(Layer, dict((row[0], row[1]) for row in chunk))
+        fulltext.set_texts(Layer, dict((row[0], row[2]) for row in chunk))
+
+
+def get_records(factory, body):
+    request = factory.post('/search/csw', body, content_type='application/xml')
+    response = views.csw_global_dispatch(request)
+    assert response.status_code == 200
+
+
+class Command(BaseCommand):
+    help = ("Time CSW GetRecords requests (bbox, anytext and deep page) against the layers, "
+            "optionally adding random layers which are removed at the end.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-l',
+            '--layers',
+            dest="layers",
+            default=0,
+            help="Number of random layers to add for the run, i.e. 200000"),
+        make_option(
+            '-r',
+            '--repeat',
+            dest="repeat",
+            default=5,
+            help="Number of timed runs for each request"),
+        make_option(
+            '-t',
+            '--target',
+            dest="target",
+            default=200,
+            help="Target time of a request in milliseconds"),
+    )
+
+    def handle(self, *args, **options):
+        number = int(options.get('layers'))
+        repeat = int(options.get('repeat'))
+        target = float(options.get('target'))
+        factory = RequestFactory()
+        requests = (
+            ('bbox', GETRECORDS % {'start': 1, 'filter': FILTERS['bbox']}),
+            ('anytext', GETRECORDS % {'start': 1, 'filter': FILTERS['anytext']}),
+            ('bbox page 100', GETRECORDS % {'start': 991, 'filter': FILTERS['bbox']}),
+        )
+        with transaction.atomic():
+            if number:
+                create_layers(number)
+            print 'Timing GetRecords on %s layers' % Layer.objects.count()
+            for name, body in requests:
+                # the first run loads the pycsw engine, the responses cached are made stale before each run
+                get_records(factory, body)
+                elapsed = min(timeit.repeat(
+                    lambda: get_records(factory, body), setup=caching.increment_generation, number=1, repeat=repeat
+                )) * 1000
+                print '%s: %.1f ms (%s)' % (name, elapsed, 'ok' if elapsed <= target else 'over %.0f ms' % target)
+            # the random layers are not kept
+            transaction.set_rollback(True)
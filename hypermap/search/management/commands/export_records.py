@@ -0,0 +1,59 @@
+import sys
+from optparse import make_option
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+
+from hypermap.aggregator.models import Catalog
+from hypermap.search import export
+
+
+class Command(BaseCommand):
+    help = ("Export the layer records to a gzip file of CSW XML or JSON lines.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '-f',
+            '--format',
+            dest="format",
+            default='xml',
+            help="Format of the records: xml or jsonl"),
+        make_option(
+            '-m',
+            '--modified-since',
+            dest="modified_since",
+            default=None,
+            help="Only export the layers modified since this date"),
+        make_option(
+            '-c',
+            '--catalog',
+            dest="catalog",
+            default=None,
+            help="Only export the layers of the catalog with this slug"),
+        make_option(
+            '-o',
+            '--output',
+            dest="output",
+            default=None,
+            help="File to write, the standard output if not set"),
+    )
+
+    def handle(self, *args, **options):
+        export_format = options.get('format')
+        if export_format not in export.FORMATS:
+            raise CommandError('Unknown format: %s' % export_format)
+        modified_since = None
+        if options.get('modified_since'):
+            modified_since = parse(options.get('modified_since'))
+        catalog = None
+        if options.get('catalog'):
+            catalog = Catalog.objects.get(slug=options.get('catalog'))
+
+        layers = export.get_layers(modified_since, catalog)
+        output = open(options.get('output'), 'wb') if options.get('output') else sys.stdout
+        try:
+            for data in export.iter_export(layers, export_format):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
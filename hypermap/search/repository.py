@@ -0,0 +1,215 @@
+import hashlib
+import re
+from sqlite3 import OperationalError
+
+from django.db import connection
+from shapely.wkt import loads
+
+from pycsw.core import util
+from pycsw.plugins.repository.hhypermap.hhypermap import HHypermapRepository, HYPERMAP_SERVICE_TYPES
+
+from hypermap.aggregator import caching, fulltext, spatial
+from hypermap.aggregator.models import Layer
+
+# spatial filters as written by pycsw for databases without native geometries
+QUERY_SPATIAL_RE = re.compile(r"query_spatial\(wkt_geometry,'([^']*)','(\w+)','([^']*)'\) = '(true|false)'")
+
+# filter predicates run as a lookup of the spatial index, and their negations
+SPATIAL_INDEX_PREDICATES = {
+    'bbox': ('intersects', False),
+    'intersects': ('intersects', False),
+    'disjoint': ('intersects', True),
+    'within': ('within', False),
+    'contains': ('contains', False),
+    'equals': ('equals', False),
+}
+
+# virtual properties of the pycsw mappings, and the columns to query instead
+COLUMNS = {
+    'id_string': 'id',
+    'last_updated_iso8601': 'last_updated',
+}
+COLUMNS_RE = re.compile(r'\b(%s)\b' % '|'.join(COLUMNS.keys()))
+
+# text filters as written by pycsw, the parameter being '%words%'
+ANYTEXT_RE = re.compile(r'\banytext i?like $')
+
+# the columns not needed to list records, read only when a record is serialized
+DEFERRED_COLUMNS = ('xml', 'anytext')
+
+# how long the position of a page is remembered for keyset pagination
+KEYSET_TIMEOUT = 600
+
+
+def get_column(name):
+    return COLUMNS.get(name, name)
+
+
+def get_postgis_filter(wkt, predicate, distance, negated):
+    """
+    Returns the spatial filter written by pycsw for PostgreSQL with PostGIS and a WKT geometry column
+    ('postgresql+postgis+wkt' repositories), for the predicates not run on the spatial index.
+    """
+    if predicate == 'bbox':
+        predicate = 'intersects'
+    if predicate == 'beyond':
+        condition = "not st_dwithin(st_geomfromtext(wkt_geometry), st_geomfromtext('%s'), %f)" % (
+            wkt, float(distance))
+    elif predicate == 'dwithin':
+        condition = "st_dwithin(st_geomfromtext(wkt_geometry), st_geomfromtext('%s'), %f)" % (wkt, float(distance))
+    else:
+        condition = "st_%s(st_geomfromtext(wkt_geometry), st_geomfromtext('%s'))" % (predicate, wkt)
+    if negated:
+        return '(%s = false or wkt_geometry is null)' % condition
+    return '%s = true' % condition
+
+
+def translate_spatial_filter(match):
+    """
+    Translate a query_spatial filter of pycsw, which parses the WKT of every row, to a lookup of the
+    spatial index. The layer geometries are bboxes, so the bounds of the filter geometry are used.
+    Other predicates, or all of them without spatial index, are left to the query_spatial function
+    on SQLite, and to PostGIS on PostgreSQL.
+    """
+    wkt, predicate, distance, value = match.groups()
+    negated = value == 'false'
+    if predicate not in SPATIAL_INDEX_PREDICATES or not spatial.is_enabled():
+        if connection.vendor == 'sqlite':
+            # the query_spatial function registered by pycsw on sqlite
+            return match.group(0)
+        return get_postgis_filter(wkt, predicate, distance, negated)
+    index_predicate, negate = SPATIAL_INDEX_PREDICATES[predicate]
+    if negate:
+        negated = not negated
+    subquery = spatial.get_bbox_subquery(Layer, loads(wkt).bounds, index_predicate)
+    return '%s.id %sIN (%s)' % (Layer._meta.db_table, 'NOT ' if negated else '', subquery)
+
+
+def translate_where(where, values):
+    """
+    Translate the where clause built by pycsw, and its parameters, to indexed conditions on the layers table.
+    """
+    where = QUERY_SPATIAL_RE.sub(translate_spatial_filter, where)
+    where = COLUMNS_RE.sub(lambda match: COLUMNS[match.group(1)], where)
+    if not isinstance(values, list) or not fulltext.is_enabled():
+        return where, values
+    # text filters become lookups of the full-text index
+    parts = where.split('%s')
+    where = parts[0]
+    translated_values = []
+    for value, part in zip(values, parts[1:]):
+        match = ANYTEXT_RE.search(where)
+        query = fulltext.get_match_query(value) if match else None
+        if query is not None:
+            where = '%s%s.id IN (%s)' % (where[:match.start()], Layer._meta.db_table, fulltext.get_text_subquery(Layer))
+            translated_values.append(query)
+        else:
+            where = where + '%s'
+            translated_values.append(value)
+        where = where + part
+    return where, translated_values
+
+
+def get_catalog_filter(catalog):
+    """
+    Returns the repository filter of the layers of a catalog, a lookup of the indexed catalog_id
+    column of the catalogs membership table.
+    """
+    return '%s.id IN (SELECT layer_id FROM %s WHERE catalog_id = %d)' % (
+        Layer._meta.db_table, Layer.catalogs.through._meta.db_table, catalog.id)
+
+
+class HypermapRepository(HHypermapRepository):
+    """
+    pycsw repository running the CSW constraints as indexed queries on the layers: spatial and text
+    filters are lookups of the spatial and full-text indexes, virtual properties are mapped to columns,
+    the xml and anytext columns are deferred and pages without sorting are read with keyset pagination.
+    """
+
+    def __init__(self, context, repo_filter=None):
+        self.context = context
+        self.filter = repo_filter
+        self.fts = False
+        self.label = 'HHypermap'
+        self.local_ingest = True
+        # spatial filters are written by pycsw as generic query_spatial filters and translated, see
+        # translate_spatial_filter: PostGIS is only needed for the predicates not run on the spatial index
+        self.dbtype = connection.vendor
+
+        if connection.vendor == 'sqlite':
+            # load SQLite query bindings. sqlite refuses to register again a function used by
+            # cached statements, when the connection is reused: they are then already registered
+            connection.ensure_connection()
+            try:
+                connection.connection.create_function('query_spatial', 4, util.query_spatial)
+                connection.connection.create_function('get_anytext', 1, util.get_anytext)
+                connection.connection.create_function('get_geometry_area', 1, util.get_geometry_area)
+            except OperationalError:
+                pass
+
+        # generate core queryables db and obj bindings
+        self.queryables = {'_all': {}}
+        for tname in self.context.model['typenames']:
+            for qname, queryables in self.context.model['typenames'][tname]['queryables'].items():
+                self.queryables.setdefault(qname, {}).update(queryables)
+                self.queryables['_all'].update(queryables)
+        self.queryables['_all'].update(self.context.md_core_model['mappings'])
+
+        operations = self.context.model['operations']
+        if 'Harvest' in operations and 'Transaction' in operations:
+            operations['Harvest']['parameters']['ResourceType']['values'] = HYPERMAP_SERVICE_TYPES.keys()
+            operations['Transaction']['parameters']['TransactionSchemas']['values'] = HYPERMAP_SERVICE_TYPES.keys()
+
+    def get_layers(self):
+        return self._get_repo_filter(Layer.objects).defer(*DEFERRED_COLUMNS)
+
+    def query_ids(self, ids):
+        ''' Query by list of identifiers '''
+        return self.get_layers().filter(id__in=[identifier for identifier in ids if identifier.isdigit()])
+
+    def query_domain(self, domain, typenames, domainquerytype='list', count=False):
+        return super(HypermapRepository, self).query_domain(get_column(domain), typenames, domainquerytype, count)
+
+    def query_source(self, source):
+        return self.get_layers().filter(url=source)
+
+    def query(self, constraint, sortby=None, typenames=None, maxrecords=10, startposition=0):
+        ''' Query records from underlying repository '''
+        query = self.get_layers()
+        if 'where' in constraint:  # GetRecords with constraint
+            where, values = translate_where(constraint['where'], constraint['values'])
+            query = query.extra(where=[where], params=values)
+        total = query.count()
+        maxrecords = int(maxrecords)
+
+        if sortby is not None:
+            if 'spatial' in sortby and sortby['spatial']:  # spatial sort, on the area of the layer bbox
+                order_by = 'bbox_area'
+                query = query.extra(select={'bbox_area': '(bbox_x1 - bbox_x0) * (bbox_y1 - bbox_y0)'})
+            else:
+                order_by = get_column(sortby['propertyname'])
+            if sortby['order'] == 'DESC':
+                order_by = '-%s' % order_by
+            return [str(total), query.order_by(order_by, 'id')[startposition:startposition + maxrecords]]
+        return [str(total), self.get_page(query, constraint, startposition, maxrecords)]
+
+    def get_page(self, query, constraint, startposition, maxrecords):
+        """
+        Read a page of layers ordered by id. When the previous page was read, the page starts after
+        its last id (remembered in the cache) instead of skipping startposition rows. The positions are
+        remembered by generation of the catalogue, so that pages are not shifted by the layers added
+        or removed meanwhile.
+        """
+        key = 'csw-keyset-%s' % hashlib.md5(repr((
+            constraint.get('where'), constraint.get('values'), self.filter, caching.get_generation()
+        ))).hexdigest()
+        query = query.order_by('id')
+        cache = caching.get_shared_cache()
+        last_id = 0 if startposition == 0 else cache.get('%s-%s' % (key, startposition))
+        if last_id is not None:
+            page = list(query.filter(id__gt=last_id)[:maxrecords])
+        else:
+            page = list(query[startposition:startposition + maxrecords])
+        if len(page) == maxrecords:
+            cache.set('%s-%s' % (key, startposition + maxrecords), page[-1].id, KEYSET_TIMEOUT)
+        return page
@@ -1,3 +1,195 @@
-# from django.test import TestCase
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+"""
+Tests for the CSW endpoint and its repository.
+"""
+
+import copy
+import gzip
+import json
+from StringIO import StringIO
+
+from lxml import etree
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.db.models import signals
+
+from pycsw.core.config import StaticContext
+
+from hypermap.aggregator import caching
+from hypermap.aggregator.models import Catalog, Service, Layer, bbox2wktpolygon
+from hypermap.aggregator.models import layer_post_save, service_post_save
+from hypermap.search import csw
+from hypermap.search.repository import HypermapRepository, get_postgis_filter
+
+GETRECORDS_BBOX = """<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecords xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:ogc="http://www.opengis.net/ogc"
+    xmlns:gml="http://www.opengis.net/gml" service="CSW" version="2.0.2" resultType="results">
+  <csw:Query typeNames="csw:Record">
+    <csw:ElementSetName>brief</csw:ElementSetName>
+    <csw:Constraint version="1.1.0">
+      <ogc:Filter>
+        <ogc:BBOX>
+          <ogc:PropertyName>ows:BoundingBox</ogc:PropertyName>
+          <gml:Envelope>
+            <gml:lowerCorner>0 0</gml:lowerCorner>
+            <gml:upperCorner>50 110</gml:upperCorner>
+          </gml:Envelope>
+        </ogc:BBOX>
+      </ogc:Filter>
+    </csw:Constraint>
+  </csw:Query>
+</csw:GetRecords>
+"""
+
+
+def get_query_spatial(bbox, predicate='bbox', value='true'):
+    return "query_spatial(wkt_geometry,'%s','%s','false') = '%s'" % (bbox2wktpolygon(bbox), predicate, value)
+
+
+class RepositoryTestCase(TestCase):
+
+    def setUp(self):
+        signals.post_save.disconnect(layer_post_save, sender=Layer)
+        signals.post_save.disconnect(service_post_save, sender=Service)
+        service = Service.objects.create(url='http://fakeurl.com', title='Title', type='OGC:WMS')
+        for i, bbox in enumerate(([-10, -10, 10, 10], [100, 40, 120, 60], [-170, -80, -160, -70])):
+            Layer.objects.create(
+                service=service,
+                title='Layer %s' % i,
+                anytext=['Land use_maps of Ecuador', 'Roads of Ecuador', None][i],
+                bbox_x0=bbox[0], bbox_y0=bbox[1], bbox_x1=bbox[2], bbox_y1=bbox[3],
+                wkt_geometry=bbox2wktpolygon(bbox)
+            )
+        self.layers = list(Layer.objects.order_by('id'))
+        self.repository = HypermapRepository(StaticContext())
+
+    def tearDown(self):
+        signals.post_save.connect(layer_post_save, sender=Layer)
+        signals.post_save.connect(service_post_save, sender=Service)
+
+    def query(self, where, values=None, **kwargs):
+        total, records = self.repository.query({'where': where, 'values': values or []}, **kwargs)
+        return int(total), [record.id for record in records]
+
+    def test_spatial_filters(self):
+        self.assertEqual(self.query(get_query_spatial([0, 0, 110, 50])), (2, [self.layers[0].id, self.layers[1].id]))
+        self.assertEqual(self.query(get_query_spatial([0, 0, 110, 50], value='false')), (1, [self.layers[2].id]))
+        self.assertEqual(self.query(get_query_spatial([0, 0, 110, 50], 'disjoint')), (1, [self.layers[2].id]))
+        self.assertEqual(self.query(get_query_spatial([-20, -20, 20, 20], 'within')), (1, [self.layers[0].id]))
+        self.assertEqual(self.query(get_query_spatial([-175, -85, 180, 90], 'contains')), (0, []))
+        # combined with other filters and virtual properties
+        where = '%s and id_string = %%s' % get_query_spatial([0, 0, 110, 50])
+        self.assertEqual(self.query(where, [str(self.layers[1].id)]), (1, [self.layers[1].id]))
+
+    def test_postgis_filters(self):
+        # predicates not run on the spatial index are written as by pycsw for PostGIS
+        wkt = bbox2wktpolygon([0, 0, 110, 50])
+        self.assertEqual(get_postgis_filter(wkt, 'bbox', 'false', False),
+                         "st_intersects(st_geomfromtext(wkt_geometry), st_geomfromtext('%s')) = true" % wkt)
+        self.assertEqual(get_postgis_filter(wkt, 'touches', 'false', True),
+                         "(st_touches(st_geomfromtext(wkt_geometry), st_geomfromtext('%s')) = false "
+                         "or wkt_geometry is null)" % wkt)
+        self.assertEqual(get_postgis_filter(wkt, 'dwithin', '2', False),
+                         "st_dwithin(st_geomfromtext(wkt_geometry), st_geomfromtext('%s'), 2.000000) = true" % wkt)
+
+    def test_text_filters(self):
+        self.assertEqual(self.query('anytext like %s', ['%ecua%']), (2, [self.layers[0].id, self.layers[1].id]))
+        self.assertEqual(self.query('anytext like %s', ['%maps ecuador%']), (1, [self.layers[0].id]))
+        where = 'anytext like %s and title = %s'
+        self.assertEqual(self.query(where, ['%ecuador%', 'Layer 1']), (1, [self.layers[1].id]))
+        # the index follows the changes of anytext
+        self.layers[2].anytext = 'Ecuador rivers'
+        self.layers[2].save()
+        self.assertEqual(self.query('anytext like %s', ['%rivers%']), (1, [self.layers[2].id]))
+
+    def test_pages(self):
+        self.assertEqual(self.query('title like %s', ['Layer%'], maxrecords=2), (3, [l.id for l in self.layers[0:2]]))
+        # the next page starts after the last id of the first one
+        self.assertEqual(self.query('title like %s', ['Layer%'], maxrecords=2, startposition=2),
+                         (3, [self.layers[2].id]))
+        # positions remembered before a change of the catalogue are not used
+        self.layers[0].delete()
+        self.assertEqual(self.query('title like %s', ['Layer%'], maxrecords=2, startposition=2), (2, []))
+        self.assertEqual(self.query('title like %s', ['Layer%'], maxrecords=2, startposition=1),
+                         (2, [self.layers[2].id]))
+        sortby = {'propertyname': 'title', 'order': 'DESC'}
+        self.assertEqual(self.query('title like %s', ['Layer%'], sortby=sortby)[1],
+                         [self.layers[2].id, self.layers[1].id])
+
+    def get_records(self, body=GETRECORDS_BBOX, path='/search/csw'):
+        response = self.client.post(path, body, content_type='application/xml')
+        self.assertEqual(response.status_code, 200)
+        results = etree.fromstring(response.content).find('{http://www.opengis.net/cat/csw/2.0.2}SearchResults')
+        return results.get('numberOfRecordsMatched')
+
+    def test_getrecords(self):
+        caching.get_shared_cache().clear()
+        self.assertEqual(self.get_records(), '2')
+        # the same request, written differently, is answered from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_records(GETRECORDS_BBOX.replace('\n    ', ' ')), '2')
+        # until the catalogue changes
+        self.layers[1].delete()
+        self.assertEqual(self.get_records(), '1')
+
+    def export(self, **params):
+        response = self.client.get('/search/export', params)
+        self.assertEqual(response.status_code, 200)
+        return gzip.GzipFile(fileobj=StringIO(''.join(response.streaming_content))).read()
+
+    def test_export(self):
+        with self.settings(SEARCH_BULK_SIZE=2):
+            records = [json.loads(line) for line in self.export(format='jsonl').splitlines()]
+            self.assertEqual([record['identifier'] for record in records], [str(l.id) for l in self.layers])
+            self.assertEqual(records[1]['title'], 'Layer 1')
+            xml = etree.fromstring(self.export(format='xml'))
+            self.assertEqual(len(xml.xpath("//*[local-name()='Record']")), 3)
+        last_updated = self.layers[2].last_updated.isoformat()
+        records = self.export(format='jsonl', modified_since=last_updated).splitlines()
+        self.assertEqual([json.loads(line)['identifier'] for line in records], [str(self.layers[2].id)])
+        self.assertEqual(self.client.get('/search/export', {'format': 'pdf'}).status_code, 400)
+
+    def test_catalog(self):
+        catalog = Catalog.objects.create(name='Ecuador')
+        path = '/search/csw/%s/' % catalog.slug
+        self.assertEqual(self.get_records(path=path), '0')
+        self.layers[1].catalogs.add(catalog)
+        self.layers[2].catalogs.add(catalog)
+        self.assertEqual(self.get_records(path=path), '1')
+        self.assertEqual(self.query('title like %s', ['Layer%']), (3, [l.id for l in self.layers]))
+        response = self.client.get(path, {'service': 'CSW', 'request': 'GetCapabilities', 'version': '2.0.2'})
+        self.assertIn('search/csw/%s/' % catalog.slug, response.content)
+        self.assertEqual(self.client.get('/search/csw/other/').status_code, 404)
+
+
+class CswEngineTestCase(TestCase):
+
+    def setUp(self):
+        caching.get_shared_cache().clear()
+
+    def get_capabilities(self):
+        response = self.client.get('/search/csw', {'service': 'CSW', 'request': 'GetCapabilities', 'version': '2.0.2'})
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_engine(self):
+        engine = csw.get_engine()
+        self.assertIs(csw.get_engine(), engine)
+        self.assertFalse(engine.config.has_option('repository', 'mappings'))
+        self.assertIn('pycsw:Identifier', engine.get_csw({'QUERY_STRING': ''}).context.md_core_model['mappings'])
+
+    def test_capabilities_cache(self):
+        content = self.get_capabilities()
+        self.assertIn('HHypermap Catalogue', content)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_capabilities(), content)
+        # other requests are not cached
+        response = self.client.post('/search/csw', GETRECORDS_BBOX, content_type='application/xml')
+        self.assertIn('SearchResults', response.content)
+        # a change of the settings is a new version of the capabilities
+        pycsw = copy.deepcopy(settings.PYCSW)
+        pycsw['metadata:main']['identification_title'] = 'Other Catalogue'
+        with override_settings(PYCSW=pycsw):
+            self.assertIn('Other Catalogue', self.get_capabilities())
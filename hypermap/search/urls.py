@@ -7,6 +7,7 @@ urlpatterns = [
     url(r'^search/csw/(?P<catalog_slug>[\w-]+)/$', views.csw_global_dispatch_by_catalog,
         name='csw_global_dispatch_by_catalog'),
     url(r'^search/csw$', views.csw_global_dispatch, name='csw_global_dispatch'),
+    url(r'^search/export$', views.csw_export, name='csw_export'),
     url(r'^search/opensearch$', views.opensearch_dispatch, name='opensearch_dispatch')
 ]
 
@@ -4,96 +4,64 @@
 
 import os
 
+from dateutil.parser import parse
 from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import render_to_response
 from django.template import loader, RequestContext
 from django.views.decorators.csrf import csrf_exempt
 
-from pycsw import server
+from pycsw.plugins.repository.hhypermap import hhypermap
 
 from hypermap.aggregator.models import Catalog
+from hypermap.search import csw, export
+from hypermap.search.repository import HypermapRepository
+
+# pycsw loads its HHypermap repository by name, it is replaced by the one running indexed queries
+hhypermap.HHypermapRepository = HypermapRepository
 
 
 @csrf_exempt
 def csw_global_dispatch(request):
     """pycsw wrapper"""
 
-    msg = None
-
-    # test for authentication and authorization
-    if any(word in request.body for word in ['Harvest ', 'Transaction ']):
-        if not _is_authenticated():
-            msg = 'Not authenticated'
-        if not _is_authorized():
-            msg = 'Not authorized'
-
-        if msg is not None:
-            template = loader.get_template('search/csw-2.0.2-exception.xml')
-            context = RequestContext(request, {
-                'exception_text': msg
-            })
-            return HttpResponseForbidden(template.render(context), content_type='application/xml')
-
-    env = request.META.copy()
-
-    # TODO: remove this workaround
-    # HH should be able to pass env['wsgi.input'] without hanging
-    # details at https://github.com/cga-harvard/HHypermap/issues/94
-    if request.method == 'POST':
-        from StringIO import StringIO
-        env['wsgi.input'] = StringIO(request.body)
-
-    env.update({'local.app_root': os.path.dirname(__file__),
-                'REQUEST_URI': request.build_absolute_uri()})
-
-    csw = server.Csw(settings.PYCSW, env, version='2.0.2')
-
-    content = csw.dispatch_wsgi()
-
-    # pycsw 2.0 has an API break:
-    # pycsw < 2.0: content = xml_response
-    # pycsw >= 2.0: content = [http_status_code, content]
-    # deal with the API break
-
-    if isinstance(content, list):  # pycsw 2.0+
-        content = content[1]
-
-    response = HttpResponse(content, content_type=csw.contenttype)
-
-    response['Access-Control-Allow-Origin'] = '*'
-    return response
+    return _csw_dispatch(request)
 
 
 @csrf_exempt
 def csw_global_dispatch_by_catalog(request, catalog_slug):
-    """pycsw wrapper"""
+    """pycsw wrapper, on the layers of a catalog"""
 
     catalog = get_object_or_404(Catalog, slug=catalog_slug)
 
-    # TODO: Implement pycsw per catalog
-    if catalog:
-        pass
+    return _csw_dispatch(request, catalog)
 
-    env = request.META.copy()
-    env.update({'local.app_root': os.path.dirname(__file__),
-                'REQUEST_URI': request.build_absolute_uri()})
-
-    csw = server.Csw(settings.PYCSW, env, version='2.0.2')
 
-    content = csw.dispatch_wsgi()
+def csw_export(request):
+    """
+    Bulk export of the layer records, as a gzip file of CSW XML (format=xml) or JSON lines
+    (format=jsonl), optionally of the layers modified since a date or of a catalog.
+    """
 
-    # pycsw 2.0 has an API break:
-    # pycsw < 2.0: content = xml_response
-    # pycsw >= 2.0: content = [http_status_code, content]
-    # deal with the API break
+    export_format = request.GET.get('format', 'xml')
+    if export_format not in export.FORMATS:
+        return HttpResponseBadRequest('Unknown format: %s' % export_format)
 
-    if isinstance(content, list):  # pycsw 2.0+
-        content = content[1]
+    modified_since = None
+    if request.GET.get('modified_since'):
+        try:
+            modified_since = parse(request.GET['modified_since'])
+        except (ValueError, OverflowError):
+            return HttpResponseBadRequest('Invalid date: %s' % request.GET['modified_since'])
 
-    response = HttpResponse(content, content_type=csw.contenttype)
+    catalog = None
+    if request.GET.get('catalog'):
+        catalog = get_object_or_404(Catalog, slug=request.GET['catalog'])
 
+    layers = export.get_layers(modified_since, catalog)
+    response = StreamingHttpResponse(export.iter_export(layers, export_format), content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="records.%s.gz"' % export_format
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
@@ -115,6 +83,43 @@ def opensearch_dispatch(request):
                               content_type='application/opensearchdescription+xml')
 
 
+def _csw_dispatch(request, catalog=None):
+    msg = None
+
+    # test for authentication and authorization
+    if any(word in request.body for word in ['Harvest ', 'Transaction ']):
+        if not _is_authenticated():
+            msg = 'Not authenticated'
+        if not _is_authorized():
+            msg = 'Not authorized'
+
+        if msg is not None:
+            template = loader.get_template('search/csw-2.0.2-exception.xml')
+            context = RequestContext(request, {
+                'exception_text': msg
+            })
+            return HttpResponseForbidden(template.render(context), content_type='application/xml')
+
+    env = request.META.copy()
+
+    # TODO: remove this workaround
+    # HH should be able to pass env['wsgi.input'] without hanging
+    # details at https://github.com/cga-harvard/HHypermap/issues/94
+    if request.method == 'POST':
+        from StringIO import StringIO
+        env['wsgi.input'] = StringIO(request.body)
+
+    env.update({'local.app_root': os.path.dirname(__file__),
+                'REQUEST_URI': request.build_absolute_uri()})
+
+    content, contenttype = csw.dispatch(request, env, catalog)
+
+    response = HttpResponse(content, content_type=contenttype)
+
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
 def _is_authenticated():
     """stub to test for authenticated user TODO: implementation"""
 
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 import os
 import os.path
 import sys
+from datetime import timedelta
+from urlparse import urlparse
 
 
 def str2bool(v):
@@ -48,6 +50,23 @@ ALLOWED_HOSTS = []
 SEARCH_ENABLED = str2bool(os.getenv('SEARCH_ENABLED', 'False'))
 SEARCH_TYPE = 'solr'
 SEARCH_URL = os.getenv('SEARCH_URL', 'http://127.0.0.1:8983/solr/search')
+# other backends fed together with SEARCH_TYPE, as (type, url) pairs, i.e. when migrating from solr to es
+SEARCH_EXTRA_BACKENDS = []
+# full rebuilds are loaded in a new versioned collection/index, then the SEARCH_URL alias is swapped to it
+SEARCH_BULK_SIZE = int(os.getenv('SEARCH_BULK_SIZE', '500'))
+SEARCH_SOLR_CONFIG_NAME = os.getenv('SEARCH_SOLR_CONFIG_NAME', 'hypermap')
+SEARCH_SOLR_SHARDS = int(os.getenv('SEARCH_SOLR_SHARDS', '1'))
+SEARCH_SOLR_REPLICAS = int(os.getenv('SEARCH_SOLR_REPLICAS', '1'))
+# name of the solr alias swapped by the rebuilds, by default the collection of SEARCH_URL. A collection created
+# before aliases were used has that name: set a new alias name, rebuild, then point SEARCH_URL to the alias
+SEARCH_SOLR_ALIAS = os.getenv('SEARCH_SOLR_ALIAS', '')
+# number of previous versioned collections/indices kept after a rebuild, for rollback
+SEARCH_KEEP_VERSIONS = int(os.getenv('SEARCH_KEEP_VERSIONS', '2'))
+
+# keep the resource bboxes in a spatial index (rtree on sqlite, gist on postgresql)
+SPATIAL_INDEX_ENABLED = str2bool(os.getenv('SPATIAL_INDEX_ENABLED', 'True'))
+# keep the resource anytext in a full-text index (fts5 on sqlite, tsvector on postgresql)
+FULLTEXT_INDEX_ENABLED = str2bool(os.getenv('FULLTEXT_INDEX_ENABLED', 'True'))
 
 # Application definition
 
@@ -132,8 +151,95 @@ MEDIA_URL = '/media/'
 
 MAPPROXY_CONFIG = os.path.join(MEDIA_ROOT, 'mapproxy_config')
 
+# the shared cache, the in-process 'local' cache is used instead while memcached is not reachable
+MEMCACHED_LOCATION = os.getenv('MEMCACHED_LOCATION', '127.0.0.1:11211')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': MEMCACHED_LOCATION,
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
 # Celery and RabbitMQ stuff
 CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
+# delta indexing pushes to the search backend only the layers changed since the previous run
+SEARCH_DELTA_INTERVAL = int(os.getenv('SEARCH_DELTA_INTERVAL', '60'))
+# layers saved or checked are indexed in bulk by flushing the index buffer
+INDEX_BUFFER_INTERVAL = int(os.getenv('INDEX_BUFFER_INTERVAL', '15'))
+# layer checks are lightweight probes, thumbnails are generated again on a slower cadence
+THUMBNAILS_INTERVAL = int(os.getenv('THUMBNAILS_INTERVAL', '24'))
+CELERYBEAT_SCHEDULE = {
+    'index-delta-layers': {
+        'task': 'hypermap.aggregator.tasks.index_delta_layers',
+        'schedule': timedelta(seconds=SEARCH_DELTA_INTERVAL),
+    },
+    'flush-index-buffer': {
+        'task': 'hypermap.aggregator.tasks.flush_index_buffer',
+        'schedule': timedelta(seconds=INDEX_BUFFER_INTERVAL),
+    },
+    'update-thumbnails': {
+        'task': 'hypermap.aggregator.tasks.update_thumbnails',
+        'schedule': timedelta(hours=THUMBNAILS_INTERVAL),
+    },
+}
+# availability probe of the layers by type (see aggregator.probes): 'wms' (a 1x1 GetMap), 'wmts' (a tile),
+# 'esri' (the layer listed by its service), 'url' (a GET of the layer url, for the other types) or
+# 'thumbnail' (the thumbnail generated again, heavier)
+LAYER_PROBES = {
+    'OGC:WMS': 'wms',
+    'Hypermap:WARPER': 'wms',
+    'Hypermap:WorldMap': 'wms',
+    'OGC:WMTS': 'wmts',
+    'ESRI:ArcGIS:MapServer': 'esri',
+    'ESRI:ArcGIS:ImageServer': 'esri',
+}
+# each kind of work has its own queue and workers (see deploy), so that the tasks requested from the
+# pages (INTERACTIVE_QUEUE) and the checks do not wait behind the harvests, indexing or thumbnails,
+# and the delta indexing does not wait behind a full rebuild of the index
+INTERACTIVE_QUEUE = 'interactive'
+TASK_QUEUES = ('celery', INTERACTIVE_QUEUE, 'harvest', 'check', 'index', 'rebuild', 'thumbnail')
+CELERY_DEFAULT_QUEUE = 'celery'
+CELERY_ROUTES = {
+    'hypermap.aggregator.tasks.check_service': {'queue': 'harvest'},
+    'hypermap.aggregator.tasks.update_endpoint': {'queue': 'harvest'},
+    'hypermap.aggregator.tasks.update_endpoints': {'queue': 'harvest'},
+    'hypermap.aggregator.tasks.check_all_services': {'queue': 'check'},
+    'hypermap.aggregator.tasks.check_layer': {'queue': 'check'},
+    'hypermap.aggregator.tasks.index_service': {'queue': 'index'},
+    'hypermap.aggregator.tasks.index_layer': {'queue': 'index'},
+    'hypermap.aggregator.tasks.index_all_layers': {'queue': 'index'},
+    'hypermap.aggregator.tasks.index_delta_layers': {'queue': 'index'},
+    'hypermap.aggregator.tasks.rebuild_index': {'queue': 'rebuild'},
+    'hypermap.aggregator.tasks.unindex_layer': {'queue': 'index'},
+    'hypermap.aggregator.tasks.flush_index_buffer': {'queue': 'index'},
+    'clear_solr': {'queue': 'index'},
+    'clear_es': {'queue': 'index'},
+    'hypermap.aggregator.tasks.update_layer_thumbnail': {'queue': 'thumbnail'},
+    'hypermap.aggregator.tasks.update_thumbnails': {'queue': 'thumbnail'},
+}
+# (soft, hard) time limits of the tasks in seconds: at the soft limit the task is interrupted and the check
+# is recorded as timed out, at the hard limit the worker process running it is replaced
+TASK_TIME_LIMITS = {
+    'hypermap.aggregator.tasks.check_layer': (30, 45),
+    'hypermap.aggregator.tasks.check_service': (900, 960),
+    'hypermap.aggregator.tasks.update_layer_thumbnail': (60, 90),
+    'hypermap.aggregator.tasks.update_endpoint': (300, 360),
+    'hypermap.aggregator.tasks.index_layer': (60, 90),
+}
+CELERY_ANNOTATIONS = dict(
+    (task_name, {'soft_time_limit': soft, 'time_limit': hard}) for task_name, (soft, hard) in TASK_TIME_LIMITS.items()
+)
+# task progress is reported at most once every PROGRESS_REPORT_ITEMS items or PROGRESS_REPORT_INTERVAL seconds
+PROGRESS_REPORT_ITEMS = int(os.getenv('PROGRESS_REPORT_ITEMS', '500'))
+PROGRESS_REPORT_INTERVAL = int(os.getenv('PROGRESS_REPORT_INTERVAL', '5'))
+# seconds a task queued or running for a resource blocks the same task for the same resource, if it does
+# not return: at least TASK_LOCK_TIMEOUT, plus TASK_LOCK_QUEUED_SECONDS for each task before it in its queue.
+# A running task holds it for its time limit, or TASK_LOCK_TIMEOUT after its last progress report
+TASK_LOCK_TIMEOUT = int(os.getenv('TASK_LOCK_TIMEOUT', '600'))
+TASK_LOCK_QUEUED_SECONDS = float(os.getenv('TASK_LOCK_QUEUED_SECONDS', '1'))
 CELERY_RESULT_BACKEND = 'cache+memcached://127.0.0.1:11211/'
 CELERYD_PREFETCH_MULTIPLIER = 25
 
@@ -250,6 +356,10 @@ PYCSW = {
         'contact_role': 'pointOfContact'
     }
 }
+# seconds a GetCapabilities response is served from the cache, until the PYCSW settings change
+CSW_CAPABILITIES_CACHE_TIMEOUT = int(os.getenv('CSW_CAPABILITIES_CACHE_TIMEOUT', '600'))
+# seconds a GetRecords/GetRecordById response is cached, responses are stale as soon as the catalogue changes
+CSW_RESPONSE_CACHE_TIMEOUT = int(os.getenv('CSW_RESPONSE_CACHE_TIMEOUT', '300'))
 
 # hypermap settings
 
@@ -257,3 +367,25 @@ PYCSW = {
 # for each service are updated and checked
 DEBUG_SERVICES = str2bool(os.getenv('DEBUG_SERVICES', 'False'))
 DEBUG_LAYERS_NUMBER = int(os.getenv('DEBUG_LAYERS_NUMBER', '10'))
+
+# outbound HTTP calls, see hypermap.aggregator.httpclient
+# default timeouts (in seconds) to connect and to read a response
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+# retries on connection errors and 502/503/504 responses, waiting backoff * 2 ** (retry - 1) seconds in between
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+# number of hosts kept in the pool, and connections kept open by host
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '50'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '4'))
+# connections kept open for specific hosts, as {'host:port': size}
+HTTP_POOL_SIZES = {
+    urlparse(SEARCH_URL).netloc: int(os.getenv('HTTP_SEARCH_POOL_SIZE', '10')),
+}
+# (connect, read) timeouts in seconds of the operations calling upstream services, see hypermap.aggregator.budgets
+OPERATION_TIMEOUTS = {
+    'check': (5, 15),
+    'harvest': (10, 60),
+    'thumbnail': (5, 30),
+    'index': (5, 60),
+}
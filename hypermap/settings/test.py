@@ -17,3 +17,13 @@ SOLR_URL = 'http://localhost:8983/solr/hypermap_test'
 # CELERY_ALWAYS_EAGER = True
 # CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 # TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'local',
+    },
+}
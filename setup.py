@@ -73,6 +73,7 @@ setup(
         'pyelasticsearch==1.4',
         'django-celery==3.1.17',
         'nose==1.3.7',
+        'numpy==1.11.0',
         'OWSLib==0.10.3',
         'Paver==1.2.4',
         'Pillow==3.1.0.rc1',